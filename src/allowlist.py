@@ -0,0 +1,96 @@
+"""
+Allowlist of known reference files (Keil STARTUP.A51, the instructor's LCD driver, ...).
+
+Students often submit such files unmodified. Files whose content hash is on the
+allowlist are dropped in Step 1 before cleaning, so they neither dominate the
+similarity scores nor lengthen the compared sequences.
+
+Build an allowlist from a directory of reference files with:
+
+    python src/allowlist.py <reference_dir> [-o allowlist.json]
+"""
+import argparse
+import hashlib
+import json
+import os
+import sys
+
+from loader import load_text_file
+
+ALLOWLIST_VERSION = 1
+
+# Default allowlist file: <repo root>/allowlist.json
+DEFAULT_ALLOWLIST_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir, 'allowlist.json'))
+
+# Only these files are ingested as source, so only they need to be listed
+SOURCE_EXTENSIONS = ('.a51', '.asm', '.c')
+
+
+def text_hash(content):
+    """
+    Hash of decoded source text that ignores encoding, line endings and trailing whitespace,
+    so a reference file re-saved by an editor still matches.
+    """
+    normalized = '\n'.join(line.rstrip() for line in content.split('\n')).strip()
+    return hashlib.sha256(normalized.encode('utf-8')).hexdigest()
+
+
+def build_allowlist(reference_dir):
+    """
+    Hashes every source file under reference_dir.
+
+    Returns:
+        dict: text_hash -> path of the reference file relative to reference_dir
+    """
+    allowlist = {}
+    for root, dirs, files in os.walk(reference_dir):
+        dirs.sort()
+        for file in sorted(files):
+            if not file.lower().endswith(SOURCE_EXTENSIONS):
+                continue
+            path = os.path.join(root, file)
+            content, content_hash, _ = load_text_file(path)
+            if content_hash is None or not content.strip():
+                continue
+            allowlist.setdefault(text_hash(content), os.path.relpath(path, reference_dir).replace(os.sep, '/'))
+    return allowlist
+
+
+class AllowlistError(ValueError):
+    """
+    An allowlist file written by another ALLOWLIST_VERSION.
+    """
+
+
+def save_allowlist(allowlist, path):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({'version': ALLOWLIST_VERSION, 'files': allowlist}, f, ensure_ascii=False, indent=2)
+
+
+def load_allowlist(path):
+    """
+    Returns: dict text_hash -> reference file name
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    if data.get('version') != ALLOWLIST_VERSION:
+        raise AllowlistError(f"Unsupported allowlist version in {path}: {data.get('version')}")
+    return data['files']
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build a reference file allowlist from a directory.")
+    parser.add_argument('reference_dir', help="Directory containing the reference files")
+    parser.add_argument('-o', '--output', default=DEFAULT_ALLOWLIST_PATH, help="Allowlist file to write")
+    args = parser.parse_args(argv)
+
+    if not os.path.isdir(args.reference_dir):
+        parser.error(f"Not a directory: {args.reference_dir}")
+    allowlist = build_allowlist(args.reference_dir)
+    save_allowlist(allowlist, args.output)
+    print(f"Wrote {len(allowlist)} reference files to {args.output}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
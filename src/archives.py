@@ -0,0 +1,122 @@
+"""
+Helpers for reading submission archives (.zip, .tar, .tar.gz, .tgz) in place.
+
+Archive members are addressed with virtual paths: the archive's path followed by
+the member name, e.g. `Lab6/student/submission.zip/src/main.a51`. Such paths
+can be used anywhere a file path is expected by loader.read_file_bytes;
+loader.read_files_bytes reads several members of an archive in one pass.
+"""
+import os
+import tarfile
+import threading
+import zipfile
+
+ARCHIVE_EXTENSIONS = ('.zip', '.tar.gz', '.tgz', '.tar')
+
+# Member listings keyed by archive path, invalidated when size or mtime change
+_listing_cache = {}
+_listing_lock = threading.Lock()
+
+
+def is_archive(path):
+    """
+    Returns True if the file name has a supported archive extension.
+    """
+    return path.lower().endswith(ARCHIVE_EXTENSIONS)
+
+
+def strip_archive_extension(name):
+    """
+    Returns the file name without its archive extension (used as student ID).
+    """
+    lowered = name.lower()
+    for ext in ARCHIVE_EXTENSIONS:
+        if lowered.endswith(ext):
+            return name[:-len(ext)]
+    return name
+
+
+def list_archive_members(archive_path):
+    """
+    Lists the regular files inside an archive.
+    The listing is cached per archive until its size or mtime changes.
+
+    Returns:
+        list of (str, int): virtual path (see module docstring) and uncompressed size of each member
+    """
+    st = os.stat(archive_path)
+    stamp = (st.st_size, st.st_mtime_ns)
+    with _listing_lock:
+        cached = _listing_cache.get(archive_path)
+        if cached and cached[0] == stamp:
+            return cached[1]
+
+    if archive_path.lower().endswith('.zip'):
+        with zipfile.ZipFile(archive_path) as zf:
+            names = [(info.filename, info.file_size) for info in zf.infolist() if not info.is_dir()]
+    else:
+        with tarfile.open(archive_path) as tf:
+            names = [(member.name, member.size) for member in tf.getmembers() if member.isfile()]
+
+    members = [(os.path.join(archive_path, *name.split('/')), size) for name, size in names if name]
+    with _listing_lock:
+        _listing_cache[archive_path] = (stamp, members)
+    return members
+
+
+def split_archive_path(path):
+    """
+    Splits a virtual member path into (archive_path, member_name).
+    Returns None if the path does not point inside an existing archive.
+    """
+    lowered = path.lower()
+    for ext in ARCHIVE_EXTENSIONS:
+        start = 0
+        while True:
+            idx = lowered.find(ext + os.sep, start)
+            if idx < 0:
+                break
+            archive_path = path[:idx + len(ext)]
+            if os.path.isfile(archive_path):
+                member = path[idx + len(ext) + 1:]
+                return archive_path, member.replace(os.sep, '/')
+            start = idx + 1
+    return None
+
+
+def iter_archive_members(archive_path, members):
+    """
+    Reads the wanted members of an archive in one pass, without extracting them
+    to disk: a .tar/.tar.gz stream is decompressed once, however many members
+    are wanted. Members not found in the archive are left out.
+
+    Yields:
+        (str, bytes): member name and content, in archive order
+    """
+    wanted = set(members)
+    try:
+        if archive_path.lower().endswith('.zip'):
+            with zipfile.ZipFile(archive_path) as zf:
+                for info in zf.infolist():
+                    if info.filename in wanted:
+                        yield info.filename, zf.read(info)
+            return
+        with tarfile.open(archive_path) as tf:
+            for info in tf:
+                if info.name not in wanted or not info.isfile():
+                    continue
+                yield info.name, tf.extractfile(info).read()
+                wanted.discard(info.name)
+                if not wanted:
+                    break
+    except (zipfile.BadZipFile, tarfile.TarError, EOFError) as e:
+        raise OSError(f"Cannot read {archive_path}: {e}") from e
+
+
+def read_archive_member(archive_path, member):
+    """
+    Reads one member of an archive into memory without extracting it to disk.
+    """
+    for _, data in iter_archive_members(archive_path, [member]):
+        return data
+    raise OSError(f"Cannot read {member} from {archive_path}: not found")
@@ -0,0 +1,126 @@
+"""
+Versioned intermediate artifacts of the staged CLI (src/cli.py).
+
+Each stage writes one JSON file into the run directory and the next stage
+loads it, so a later stage can be repeated (new thresholds, a re-rendered
+report) without rerunning the stages before it. Later artifacts record the
+fingerprint of the ingest artifact they were built from, so rerunning
+`ingest` alone makes them stale instead of silently mismatched.
+"""
+import base64
+import hashlib
+import json
+import os
+import time
+from array import array
+
+# Bump whenever the layout of an artifact changes, so stale run directories are rejected
+ARTIFACT_VERSION = 2
+
+# Stage -> artifact file written by that stage
+ARTIFACT_FILES = {
+    'ingest': 'students.json',
+    'score': 'comparisons.json',
+    'analyze': 'results.json',
+}
+
+
+class ArtifactError(ValueError):
+    """
+    An artifact that cannot be used: unreadable, from another ARTIFACT_VERSION or
+    stage, or built from other Step 1 output than the one in the run directory.
+    """
+
+
+def artifact_path(run_dir, stage):
+    return os.path.join(run_dir, ARTIFACT_FILES[stage])
+
+
+def _encode(value):
+    # Token offset tables (array('I')) are stored as base64 of their raw bytes
+    if isinstance(value, array):
+        return {'__array__': value.typecode, 'data': base64.b64encode(value.tobytes()).decode('ascii')}
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def _decode(obj):
+    if '__array__' in obj:
+        values = array(obj['__array__'])
+        values.frombytes(base64.b64decode(obj['data']))
+        return values
+    return obj
+
+
+def save_artifact(run_dir, stage, data, params):
+    """
+    Writes the artifact of a stage (atomically, so an interrupted stage leaves
+    the previous artifact intact).
+
+    Args:
+        data: Stage output
+        params (dict): Settings the artifact was produced with, passed on to later stages
+    """
+    artifact = {
+        'artifact': stage,
+        'version': ARTIFACT_VERSION,
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'params': params,
+        'data': data,
+    }
+    os.makedirs(run_dir, exist_ok=True)
+    path = artifact_path(run_dir, stage)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(artifact, f, ensure_ascii=False, default=_encode)
+    os.replace(tmp_path, path)
+    return path
+
+
+def load_artifact(run_dir, stage, students_fingerprint=None):
+    """
+    Loads the artifact of a stage.
+
+    Args:
+        students_fingerprint (str, optional): Fingerprint of the current ingest
+            artifact; the artifact must have been built from it
+
+    Returns:
+        tuple: (data, params)
+
+    Raises:
+        FileNotFoundError: The stage has not been run in run_dir
+        ArtifactError: The artifact is unreadable, from another ARTIFACT_VERSION or
+            stage, or stale (built before the ingest stage was rerun)
+    """
+    path = artifact_path(run_dir, stage)
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"{path} not found; run the '{stage}' stage first")
+    with open(path, 'r', encoding='utf-8') as f:
+        try:
+            artifact = json.load(f, object_hook=_decode)
+        except ValueError as e:
+            raise ArtifactError(f"Unreadable artifact {path}: {e}; rerun the '{stage}' stage") from e
+    if artifact.get('version') != ARTIFACT_VERSION or artifact.get('artifact') != stage:
+        raise ArtifactError(f"Unsupported artifact in {path}: {artifact.get('artifact')} "
+                            f"version {artifact.get('version')}; rerun the '{stage}' stage")
+    params = artifact['params']
+    if students_fingerprint is not None and params.get('students_fingerprint') != students_fingerprint:
+        raise ArtifactError(f"Stale artifact {path}: built from an earlier 'ingest' run; "
+                            f"rerun the '{stage}' stage")
+    return artifact['data'], params
+
+
+def students_fingerprint(student_data):
+    """
+    Fingerprint of Step 1 output: the student ids and the code compared in Step 2.
+
+    Args:
+        student_data (dict): {student id: record dict (records.Student.to_dict())}
+    """
+    digest = hashlib.sha256()
+    for student in sorted(student_data):
+        record = student_data[student]
+        for value in (student, record['source'], record['asm_source'], record['hex']):
+            digest.update(value.encode('utf-8'))
+            digest.update(b'\0')
+    return digest.hexdigest()
@@ -0,0 +1,121 @@
+"""
+Content-addressed on-disk cache backed by SQLite.
+Values are JSON documents; entries are evicted least-recently-used first once the
+cache grows beyond its size limit.
+"""
+import json
+import os
+import sqlite3
+import time
+
+# Default cache directory: <repo root>/.cache
+DEFAULT_CACHE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir, '.cache'))
+
+# Default size limit for a cache database
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+
+# Pending writes are committed after this many puts
+COMMIT_EVERY = 200
+
+
+class DiskCache:
+    """
+    Key/value cache stored in a single SQLite file.
+
+    Args:
+        path (str): Database file; parent directories are created
+        max_bytes (int): Size limit of the stored values before LRU eviction
+        ttl (float, optional): Seconds after which an entry is treated as missing
+    """
+
+    def __init__(self, path, max_bytes=DEFAULT_MAX_BYTES, ttl=None):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._pending = 0
+        self._conn = sqlite3.connect(path)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            " key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL,"
+            " created REAL NOT NULL, accessed REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)")
+        self._size = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+
+    def get(self, key):
+        """
+        Returns the cached value for key, or None on a miss.
+        """
+        row = self._conn.execute("SELECT value, created FROM entries WHERE key = ?", (key,)).fetchone()
+        now = time.time()
+        if row is None or (self.ttl is not None and now - row[1] > self.ttl):
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._conn.execute("UPDATE entries SET accessed = ? WHERE key = ?", (now, key))
+        self._mark_dirty()
+        return json.loads(row[0])
+
+    def put(self, key, value):
+        """
+        Stores a JSON-serializable value under key, evicting old entries if needed.
+        """
+        data = json.dumps(value, ensure_ascii=False)
+        size = len(data.encode('utf-8'))
+        now = time.time()
+        old = self._conn.execute("SELECT size FROM entries WHERE key = ?", (key,)).fetchone()
+        if old:
+            self._size -= old[0]
+        self._conn.execute(
+            "INSERT OR REPLACE INTO entries (key, value, size, created, accessed) VALUES (?, ?, ?, ?, ?)",
+            (key, data, size, now, now)
+        )
+        self._size += size
+        if self._size > self.max_bytes:
+            self._evict()
+        self._mark_dirty()
+
+    def _evict(self):
+        """
+        Deletes least-recently-used entries until the cache is back under 90% of max_bytes.
+        """
+        target = self.max_bytes * 0.9
+        rows = self._conn.execute("SELECT key, size FROM entries ORDER BY accessed").fetchall()
+        evicted = []
+        for key, size in rows:
+            if self._size <= target:
+                break
+            evicted.append((key,))
+            self._size -= size
+        self._conn.executemany("DELETE FROM entries WHERE key = ?", evicted)
+
+    def _mark_dirty(self):
+        self._pending += 1
+        if self._pending >= COMMIT_EVERY:
+            self._conn.commit()
+            self._pending = 0
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def summary(self):
+        """
+        One-line hit/miss summary for progress output.
+        """
+        return f"{self.hits} hits, {self.misses} misses ({self.hit_rate() * 100:.1f}% hit rate)"
+
+    def close(self):
+        self._conn.commit()
+        self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,125 @@
+"""
+Crash-safe checkpoint of Step 2 pair scores.
+
+Scores are appended to a JSONL file in batches while Step 2 runs. The first
+line records SCORING_VERSION and the student fingerprints; every further line
+is one scored pair. After a crash or Ctrl-C, a resumed run loads the pairs
+whose two students are unchanged and only scores the rest. A torn last line
+from an interrupted write is ignored.
+"""
+import json
+import os
+
+from manifest import SCORING_VERSION
+
+# Pairs buffered before they are written to the checkpoint
+CHECKPOINT_BATCH = 5000
+
+# When written batches are forced to disk:
+#   "batch"  - fsync after every batch (survives power loss, losing at most one batch)
+#   "always" - fsync after every pair (slowest)
+#   "never"  - leave it to the OS (survives a crashed process, not a crashed machine)
+FSYNC_POLICIES = ('batch', 'always', 'never')
+
+
+def load_checkpoint(path, fingerprints):
+    """
+    Reads the pair scores of an interrupted run.
+
+    Args:
+        fingerprints (dict): student -> student_fingerprint of the current run
+
+    Returns:
+        dict: (student1, student2) -> (token_seq, levenshtein, hex_levenshtein) for
+        pairs whose students are unchanged; empty if the checkpoint is missing or outdated
+    """
+    scores = {}
+    try:
+        f = open(path, 'r', encoding='utf-8')
+    except OSError:
+        return scores
+    with f:
+        try:
+            header = json.loads(f.readline())
+        except ValueError:
+            return scores
+        if header.get('version') != SCORING_VERSION:
+            return scores
+        previous = header['students']
+        unchanged = {student for student, fp in fingerprints.items() if previous.get(student) == fp}
+        for line in f:
+            try:
+                student1, student2, token_seq, levenshtein, hex_lev = json.loads(line)
+            except ValueError:
+                break  # Torn write at the end of the file
+            if student1 in unchanged and student2 in unchanged:
+                scores[(student1, student2)] = (token_seq, levenshtein, hex_lev)
+    return scores
+
+
+class CheckpointWriter:
+    """
+    Appends pair scores to a checkpoint file.
+
+    The file is rewritten on open with the current fingerprints and the scores
+    carried over from a previous checkpoint, so it always describes this run.
+
+    Args:
+        path (str): Checkpoint file; parent directories are created
+        fingerprints (dict): student -> student_fingerprint of the current run
+        scores (dict, optional): Scores already known, e.g. from load_checkpoint
+        batch_size (int): Pairs buffered between writes
+        fsync (str): One of FSYNC_POLICIES
+    """
+
+    def __init__(self, path, fingerprints, scores=None, batch_size=CHECKPOINT_BATCH, fsync='batch'):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f"Unknown fsync policy: {fsync}")
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.batch_size = 1 if fsync == 'always' else batch_size
+        self.fsync = fsync
+        self._pending = []
+
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(json.dumps({'version': SCORING_VERSION, 'students': fingerprints}, ensure_ascii=False) + '\n')
+            for (student1, student2), value in (scores or {}).items():
+                f.write(json.dumps([student1, student2, *value], ensure_ascii=False) + '\n')
+            f.flush()
+            if fsync != 'never':
+                os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        self._file = open(path, 'a', encoding='utf-8')
+
+    def add(self, student1, student2, scores):
+        self._pending.append(json.dumps([student1, student2, *scores], ensure_ascii=False) + '\n')
+        if len(self._pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self._pending:
+            self._file.write(''.join(self._pending))
+            self._pending = []
+        self._file.flush()
+        if self.fsync != 'never':
+            os.fsync(self._file.fileno())
+
+    def close(self):
+        if self._file.closed:
+            return
+        self.flush()
+        self._file.close()
+
+    def remove(self):
+        """
+        Closes and deletes the checkpoint once the run has finished.
+        """
+        self.close()
+        os.remove(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
@@ -0,0 +1,197 @@
+"""
+Staged command line interface.
+
+Each stage saves its output as an artifact in the run directory and the next
+stage loads it, so only the stages after a changed setting need to be rerun:
+
+    python src/cli.py ingest "Lab 6"                 # Step 1 -> students.json
+    python src/cli.py score                          # Step 2 -> comparisons.json
+    python src/cli.py analyze --mode top_percent     # Steps 3-4 -> results.json
+    python src/cli.py report --lab-name "Lab 6"      # HTML report from results.json
+
+Changing the thresholds only needs `analyze` and `report`; a re-rendered report only needs `report`.
+"""
+import argparse
+import os
+import sys
+
+from allowlist import AllowlistError
+from artifacts import ArtifactError, save_artifact, load_artifact, students_fingerprint
+from cache import DEFAULT_CACHE_DIR
+from checkpoint import CHECKPOINT_BATCH, FSYNC_POLICIES
+from llm_analyzer import LLMClient, LLMBudget, open_llm_cache
+from llm_backends import HttpBackend
+from preprocessor import GUARD_POLICIES, CRAWL_IGNORE, CRAWL_MAX_DEPTH, CRAWL_MAX_FILE_BYTES, CRAWL_MAX_FILES
+from records import Student, PairResult
+from reporter import generate_html_report
+from main import run_ingest, score_pairs, filter_pairs, analyze_pairs, collect_student_lists
+
+# Default run directory: <repo root>/runs/latest
+DEFAULT_RUN_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir, 'runs', 'latest'))
+
+TOP_METRICS = ('avg_score', 'token_seq', 'levenshtein')
+
+# Per-student Step 1 details written by `ingest`
+DEBUG_LOG = 'debug.log'
+
+# Step 2 scores are appended here while `score` runs, so an interrupted run can be resumed
+CHECKPOINT_FILE = 'comparisons.ckpt.jsonl'
+
+
+def cmd_ingest(args):
+    cache_dir = None if args.no_cache else args.cache_dir
+    root_path = os.path.abspath(args.root_path)
+    # One debug log per ingest run, next to its artifact
+    os.makedirs(args.run_dir, exist_ok=True)
+    debug_log = os.path.join(args.run_dir, DEBUG_LOG)
+    if os.path.exists(debug_log):
+        os.remove(debug_log)
+    crawl_limits = {'ignore': list(CRAWL_IGNORE) + (args.ignore or []), 'max_depth': args.max_depth,
+                    'max_file_bytes': args.max_file_bytes, 'max_files': args.max_files}
+    student_data = run_ingest(root_path, args.keil, args.keil_path, ingest_workers=args.workers,
+                              cache_dir=cache_dir, guard_policy=args.guard_policy,
+                              allowlist_path=args.allowlist, debug_log=debug_log, crawl_limits=crawl_limits)
+    data = {student: record.to_dict() for student, record in student_data.items()}
+    params = {'root_path': root_path, 'use_keil_compilation': args.keil, 'guard_policy': args.guard_policy,
+              'allowlist_path': args.allowlist, 'crawl_limits': crawl_limits,
+              'students_fingerprint': students_fingerprint(data)}
+    path = save_artifact(args.run_dir, 'ingest', data, params)
+    print(f"Ingested {len(student_data)} students -> {path}")
+
+
+def _load_students(run_dir):
+    data, params = load_artifact(run_dir, 'ingest')
+    return {student: Student.from_dict(record) for student, record in data.items()}, params
+
+
+def cmd_score(args):
+    student_data, params = _load_students(args.run_dir)
+    cache_dir = None if args.no_cache else args.cache_dir
+    all_comparisons = score_pairs(student_data, params['use_keil_compilation'], root_path=params['root_path'],
+                                  cache_dir=cache_dir, incremental=not args.full,
+                                  checkpoint_path=os.path.join(args.run_dir, CHECKPOINT_FILE), resume=args.resume,
+                                  checkpoint_batch=args.checkpoint_batch, fsync=args.fsync)
+    path = save_artifact(args.run_dir, 'score', [comp.to_dict() for comp in all_comparisons], params)
+    print(f"Scored {len(all_comparisons)} pairs -> {path}")
+
+
+def cmd_analyze(args):
+    student_data, ingest_params = _load_students(args.run_dir)
+    comparisons, params = load_artifact(args.run_dir, 'score', ingest_params['students_fingerprint'])
+    all_comparisons = [PairResult.from_dict(comp) for comp in comparisons]
+    filtered_pairs = filter_pairs(all_comparisons, args.mode, args.hex_threshold, args.src_threshold,
+                                  args.top_metric, args.top_percent)
+    llm_cache = open_llm_cache(args.cache_dir) if not args.no_llm_cache else None
+    try:
+        llm_client = LLMClient(backend=HttpBackend(args.llm_url)) if args.llm_url else None
+        limits = (args.llm_max_requests, args.llm_max_tokens, args.llm_max_seconds)
+        llm_budget = LLMBudget(*limits) if any(limit is not None for limit in limits) else None
+        results = analyze_pairs(filtered_pairs, student_data, llm_workers=args.llm_workers, llm_cache=llm_cache,
+                                llm_client=llm_client, llm_batch_size=args.llm_batch_size, llm_budget=llm_budget,
+                                llm_rps=args.llm_rps)
+    finally:
+        if llm_cache:
+            llm_cache.close()
+    illegal_students, anomaly_students, excluded_students = collect_student_lists(student_data)
+    params = dict(params, filter_mode=args.mode, hex_threshold=args.hex_threshold,
+                  src_threshold=args.src_threshold, top_metric=args.top_metric, top_percent=args.top_percent)
+    data = {
+        'results': [result.to_dict() for result in results],
+        'illegal_students': illegal_students,
+        'anomaly_students': anomaly_students,
+        'excluded_students': excluded_students,
+    }
+    path = save_artifact(args.run_dir, 'analyze', data, params)
+    print(f"Found {len(results)} suspicious pairs -> {path}")
+
+
+def cmd_report(args):
+    student_data, ingest_params = _load_students(args.run_dir)
+    data, params = load_artifact(args.run_dir, 'analyze', ingest_params['students_fingerprint'])
+    results = [PairResult.from_dict(result) for result in data['results']]
+    lab_name = args.lab_name or os.path.basename(params['root_path'])
+    generate_html_report(results, params['hex_threshold'], params['src_threshold'],
+                         data['illegal_students'], data['anomaly_students'], lab_name,
+                         filter_mode=params['filter_mode'], top_metric=params['top_metric'],
+                         top_percent=params['top_percent'], use_keil_compilation=params['use_keil_compilation'],
+                         excluded_students=data['excluded_students'], students=student_data)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Plagiarism check for 8051 lab submissions, one stage at a time.")
+    parser.add_argument('--run-dir', default=DEFAULT_RUN_DIR, help="Directory holding the stage artifacts")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    ingest = subparsers.add_parser('ingest', help="Step 1: crawl and preprocess submissions")
+    ingest.add_argument('root_path', help="Assignment directory with one folder per student")
+    ingest.add_argument('--keil', action='store_true', help="Compile C sources with Keil C51")
+    ingest.add_argument('--keil-path', help="Keil installation path if not in the default locations")
+    ingest.add_argument('--workers', type=int, help="Preprocessing processes (default: CPU count, 1 = serial)")
+    ingest.add_argument('--guard-policy', choices=GUARD_POLICIES, default='cap',
+                        help="Handling of oversized source files")
+    ingest.add_argument('--allowlist', help="Reference file allowlist built with src/allowlist.py")
+    ingest.add_argument('--ignore', action='append', metavar='GLOB',
+                        help="Also skip files and folders matching this glob, case-insensitive (repeatable)")
+    ingest.add_argument('--max-depth', type=int, default=CRAWL_MAX_DEPTH,
+                        help="Deepest directory level entered, the student folder being level 1")
+    ingest.add_argument('--max-file-bytes', type=int, default=CRAWL_MAX_FILE_BYTES,
+                        help="Skip source, hex and archive files larger than this")
+    ingest.add_argument('--max-files', type=int, default=CRAWL_MAX_FILES,
+                        help="Files collected per student before the rest is skipped")
+    ingest.set_defaults(func=cmd_ingest)
+
+    score = subparsers.add_parser('score', help="Step 2: calculate pair similarities")
+    score.add_argument('--full', action='store_true', help="Rescore every pair instead of reusing the manifest")
+    score.add_argument('--resume', action='store_true',
+                       help="Skip pairs already scored by an interrupted run (crash or Ctrl-C)")
+    score.add_argument('--checkpoint-batch', type=int, default=CHECKPOINT_BATCH,
+                       help="Pairs written to the checkpoint at a time")
+    score.add_argument('--fsync', choices=FSYNC_POLICIES, default='batch',
+                       help="When checkpoint writes are forced to disk")
+    score.set_defaults(func=cmd_score)
+
+    for stage in (ingest, score):
+        stage.add_argument('--cache-dir', default=DEFAULT_CACHE_DIR, help="On-disk cache directory")
+        stage.add_argument('--no-cache', action='store_true', help="Disable the on-disk cache")
+
+    analyze = subparsers.add_parser('analyze', help="Steps 3-4: filter pairs and decide verdicts")
+    analyze.add_argument('--mode', choices=('threshold', 'top_percent'), default='threshold')
+    analyze.add_argument('--hex-threshold', type=float, default=0.7)
+    analyze.add_argument('--src-threshold', type=float, default=0.8)
+    analyze.add_argument('--top-metric', choices=TOP_METRICS, default='avg_score')
+    analyze.add_argument('--top-percent', type=float, default=0.05)
+    analyze.add_argument('--llm-workers', type=int, default=0,
+                         help="Concurrent, rate-limited LLM requests (0 = one at a time, inline)")
+    analyze.add_argument('--llm-rps', type=float,
+                         help="LLM requests per second, inline or concurrent (default: LLM_REQUESTS_PER_SECOND)")
+    analyze.add_argument('--llm-batch-size', type=int, default=0,
+                         help="Related pairs judged per LLM request (0 = one pair per request)")
+    analyze.add_argument('--llm-url', help="HTTP/JSON LLM endpoint to use instead of Gemini, "
+                                           "e.g. a local src/llm_stub_server.py")
+    analyze.add_argument('--llm-max-requests', type=int,
+                         help="Stop sending LLM requests after this many; the most suspicious pairs go first")
+    analyze.add_argument('--llm-max-tokens', type=int, help="Stop after this many estimated prompt tokens")
+    analyze.add_argument('--llm-max-seconds', type=float, help="Stop sending new LLM requests after this many seconds")
+    analyze.add_argument('--cache-dir', default=DEFAULT_CACHE_DIR, help="Directory of the LLM verdict cache")
+    analyze.add_argument('--no-llm-cache', action='store_true',
+                         help="Ask the LLM again instead of reusing cached verdicts")
+    analyze.set_defaults(func=cmd_analyze)
+
+    report = subparsers.add_parser('report', help="Render the HTML report")
+    report.add_argument('--lab-name', help="Report title (default: name of the assignment directory)")
+    report.set_defaults(func=cmd_report)
+    return parser
+
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    try:
+        args.func(args)
+    except (FileNotFoundError, ArtifactError, AllowlistError) as e:
+        parser.error(str(e))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
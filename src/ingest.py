@@ -0,0 +1,474 @@
+"""
+Step 1 ingestion: read, decode, clean and validate every student's submission.
+
+Work is pipelined across students: a thread pool prefetches and decodes file bytes
+(I/O bound, e.g. on a network share) while a process pool runs the CPU-bound
+preprocessing. Results are consumed in crawl order, so the resulting student_data
+is identical to the serial path.
+
+Preprocessing results are cached on disk, keyed by file content hash and
+PREPROCESSOR_VERSION, so unchanged files are not cleaned or parsed again.
+"""
+import base64
+import os
+import time
+from array import array
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from preprocessor import (
+    clean_and_validate, normalize_hex, validate_source_code, guard_source, enforce_token_budget,
+    remap_sampled_lines, PREPROCESSOR_VERSION, GUARD_POLICY, GUARD_MAX_SOURCE_CHARS, GUARD_MAX_STUDENT_TOKENS
+)
+from archives import split_archive_path
+from loader import read_files_bytes, decode_file, decode_content, hash_content
+from c51_compiler import compile_and_extract_asm
+from cache import DiskCache
+from allowlist import text_hash
+from records import Student
+
+# Threads used to prefetch file bytes
+IO_THREADS = 8
+
+# File name of the preprocessing cache inside the cache directory
+CACHE_FILENAME = 'preprocess.sqlite'
+
+
+def _load_student_files(files, guard=(GUARD_POLICY, GUARD_MAX_SOURCE_CHARS), allowlist=None):
+    """
+    Reads, hashes and decodes one student's source and hex files (runs in an I/O thread).
+    The encoding detected for one file is tried first for the student's next files.
+    Decoded sources on the allowlist are dropped; the others go through the input
+    guard (policy, max_chars) before anything else.
+
+    Returns: {'source': [record], 'hex': [record]} where every record has
+        'path', 'error', 'hash' and 'size'; source records also carry the decoded
+        'content' and its 'encoding', hex records the raw 'data'. Oversized
+        sources carry their OVERSIZED_FILE anomaly in 'guard', dropped sources
+        the matching reference file name in 'allowlisted' (and no content).
+    """
+    encoding = None
+    payloads = {'source': [], 'hex': []}
+    # Hex files and archive members as bytes (each archive read in one pass); plain
+    # source files are decoded by decode_file, from a memory map when large
+    contents = read_files_bytes(files['hex'] + [path for path in files['source'] if split_archive_path(path)])
+    for kind in payloads:
+        for path in files[kind]:
+            record = {'path': path, 'error': None, 'hash': None, 'size': 0}
+            payloads[kind].append(record)
+            if path in contents:
+                data = contents[path]
+                if isinstance(data, OSError):
+                    record['error'] = str(data)
+                    continue
+                record['hash'] = hash_content(data)
+                record['size'] = len(data)
+                if kind == 'hex':
+                    record['data'] = data
+                    continue
+                content, record['encoding'] = decode_content(data, encoding)
+            else:
+                try:
+                    content, record['hash'], record['encoding'], record['size'] = decode_file(path, encoding)
+                except OSError as e:
+                    record['error'] = str(e)
+                    continue
+            encoding = record['encoding'] or encoding
+            reference = allowlist.get(text_hash(content)) if allowlist else None
+            if reference:
+                record['allowlisted'] = reference
+                record['content'] = ""
+                continue
+            record['content'], anomaly = guard_source(content, *guard)
+            if anomaly:
+                anomaly['details'].update(file=os.path.basename(path), sha256=record['hash'])
+                record['guard'] = anomaly
+    return payloads
+
+
+def preprocess_files(jobs):
+    """
+    CPU-bound part of Step 1 (runs in a worker process).
+
+    Args:
+        jobs: list of ('source', ext, content) or ('hex', ext, data)
+
+    Returns:
+        list of results, one per job:
+            source: {'cleaned', 'anomalies', 'offsets'} (or {'error'}), where offsets
+                    is an array('I') of (line, column) per cleaned token
+            hex:    {'hex', 'hex_info'} (or {'error'})
+    """
+    results = []
+    for kind, ext, content in jobs:
+        try:
+            if kind == 'hex':
+                hex_data, hex_info = normalize_hex(content)
+                results.append({'hex': hex_data, 'hex_info': hex_info})
+            else:
+                result = {'cleaned': None}
+                if ext in ['.c', '.a51', '.asm']:
+                    # Cleaning and quality validation share one pass over the source
+                    result['offsets'] = array('I')
+                    result['cleaned'], result['anomalies'] = clean_and_validate(content, ext, result['offsets'])
+                else:
+                    result['anomalies'] = validate_source_code(content, ext)
+                results.append(result)
+        except Exception as e:
+            results.append({'error': str(e)})
+    return results
+
+
+def _cache_key(kind, record):
+    """
+    Content-addressed cache key, or None if the file has nothing to preprocess.
+    """
+    ext = os.path.splitext(record['path'])[1].lower()  # Lowercase for case-insensitive comparison
+    if kind == 'hex':
+        if not record.get('data'):
+            return None
+        return f"v{PREPROCESSOR_VERSION}:hex:{record['hash']}"
+    if not record.get('content'):
+        return None
+    key = f"v{PREPROCESSOR_VERSION}:src:{ext}:{record['encoding']}:{record['hash']}"
+    if 'guard' in record:
+        # The cleaned text depends on how the guard reduced the file
+        details = record['guard']['details']
+        key += f":{details['policy']}:{details['limit']}"
+    return key
+
+
+def _plan_student(payloads, cache):
+    """
+    Fills cached results into the records and returns the remaining work as
+    (jobs, pending records, cache keys).
+    """
+    jobs, pending, keys = [], [], []
+    for kind, records in payloads.items():
+        for record in records:
+            key = _cache_key(kind, record)
+            if key is None:
+                continue
+            cached = cache.get(key) if cache else None
+            if cached is not None:
+                if 'offsets' in cached:
+                    cached['offsets'] = array('I', base64.b64decode(cached['offsets']))
+                record.update(cached)
+                continue
+            ext = os.path.splitext(record['path'])[1].lower()
+            jobs.append((kind, ext, record['data'] if kind == 'hex' else record['content']))
+            pending.append(record)
+            keys.append(key)
+    return jobs, pending, keys
+
+
+def _finish_student(pending, keys, results, cache):
+    """
+    Merges worker results into their records and stores successful ones in the cache.
+    """
+    for record, key, result in zip(pending, keys, results):
+        record.update(result)
+        if cache and 'error' not in result:
+            if 'offsets' in result:
+                # Offset tables are stored as the raw bytes of the array
+                result = dict(result, offsets=base64.b64encode(result['offsets'].tobytes()).decode('ascii'))
+            cache.put(key, result)
+
+
+def _iter_preprocessed(student_files, workers, cache, guard=(GUARD_POLICY, GUARD_MAX_SOURCE_CHARS),
+                       allowlist=None):
+    """
+    Yields (student, files, payloads) in crawl order with every record preprocessed.
+    With workers > 1, loads run ahead in the I/O threads and preprocessing in the
+    process pool; at most 2 * workers students are in flight per stage.
+    """
+    if workers <= 1:
+        for student, files in student_files:
+            payloads = _load_student_files(files, guard, allowlist)
+            jobs, pending, keys = _plan_student(payloads, cache)
+            _finish_student(pending, keys, preprocess_files(jobs), cache)
+            yield student, files, payloads
+        return
+
+    prefetch = workers * 2
+    with ThreadPoolExecutor(IO_THREADS) as io_pool, ProcessPoolExecutor(workers) as cpu_pool:
+        loads = deque()
+        jobs_in_flight = deque()
+
+        def start_job():
+            student, files, future = loads.popleft()
+            payloads = future.result()
+            jobs, pending, keys = _plan_student(payloads, cache)
+            future = cpu_pool.submit(preprocess_files, jobs) if jobs else None
+            jobs_in_flight.append((student, files, payloads, pending, keys, future))
+
+        def finish_job():
+            student, files, payloads, pending, keys, future = jobs_in_flight.popleft()
+            if future is not None:
+                _finish_student(pending, keys, future.result(), cache)
+            return student, files, payloads
+
+        for student, files in student_files:
+            loads.append((student, files, io_pool.submit(_load_student_files, files, guard, allowlist)))
+            if len(loads) > prefetch:
+                start_job()
+            if len(jobs_in_flight) > prefetch:
+                yield finish_job()
+
+        while loads:
+            start_job()
+        while jobs_in_flight:
+            yield finish_job()
+
+
+def build_student_entry(student, files, payloads, use_keil_compilation=False, keil_path=None,
+                        max_student_tokens=GUARD_MAX_STUDENT_TOKENS):
+    """
+    Assembles one student's Student record from the preprocessed file records.
+    The compared source is cut to max_student_tokens tokens before Step 2.
+
+    'source_offsets' is an array('I') with the (file index, line, column) of every
+    token of 'source', where the file index points into files['source'].
+    """
+    entry = {
+        'source': "",
+        'hex': "",
+        'original_source': "",
+        'asm_source': "",         # Compiled assembly or raw assembly
+        'illegal_submission': False,
+        'illegal_reason': "",
+        'hex_anomalies': [],      # List of hex anomalies
+        'source_anomalies': [],   # List of source code anomalies
+        'has_anomaly': False,     # Flag for any anomaly
+        'hex_length': 0,          # Hex data length
+        'source_offsets': array('I'),  # (file index, line, column) per source token
+        'excluded_files': [],     # Source files dropped by the reference allowlist
+        'hex_info': {}            # Hex validation info
+    }
+
+    # Check for illegal submission (no valid source files or no hex files)
+    # Determine valid extensions based on configuration
+    valid_extensions = ['.a51', '.asm', '.c']
+
+    has_valid_source = False
+    allowlisted = []  # Valid source files that are all reference files do not count
+    for record in payloads['source']:
+        ext = os.path.splitext(record['path'])[1].lower()
+        if ext in valid_extensions:
+            if 'allowlisted' in record:
+                allowlisted.append(record)
+                continue
+            has_valid_source = True
+            break
+
+    if not has_valid_source:
+        entry['illegal_submission'] = True
+        if allowlisted:
+            names = ', '.join(os.path.basename(record['path']) for record in allowlisted)
+            entry['illegal_reason'] = f"無效提交：原始碼皆為允許清單中的參考檔案 ({names})"
+            entry['source_anomalies'].append({
+                'code': 'ONLY_REFERENCE_FILES',
+                'severity': 'error',
+                'message': f'原始碼皆為參考檔案，未參與比對：{names}',
+                'details': {'files': [{'path': record['path'], 'reference': record['allowlisted']}
+                                      for record in allowlisted]}
+            })
+        elif files['all_files']:
+            # Found files but not valid source
+            exts = set([os.path.splitext(f)[1] for f in files['all_files']])
+            entry['illegal_reason'] = f"無效提交：找到 {', '.join(exts)} 檔案，但需要 (C 或 A51) 檔案"
+        else:
+            entry['illegal_reason'] = "未找到任何檔案"
+
+    # Combine all source files
+    full_source = ""
+    full_asm_source = ""  # For compiled assembly from C files
+    full_original_source = ""
+
+    c_files_for_compilation = []  # Track C files to compile if needed
+    asm_files_cleaned = []  # Track regular assembly files
+
+    for file_index, record in enumerate(payloads['source']):
+        src_file = record['path']
+        if record.get('error'):
+            print(f"Error reading {src_file}: {record['error']}")
+            continue
+        if 'allowlisted' in record:
+            entry['excluded_files'].append({'path': src_file, 'reference': record['allowlisted']})
+            continue
+        if 'guard' in record:
+            entry['source_anomalies'].append(record['guard'])
+            print(f"Warning: {src_file} is oversized: {record['guard']['message']}")
+        content = record['content']
+        if not content:
+            if 'guard' in record:  # Fingerprint only
+                continue
+            print(f"Warning: Could not read {src_file} or file is empty")
+            continue
+
+        ext = os.path.splitext(src_file)[1].lower()
+
+        # Store original content with filename header for display
+        filename = os.path.basename(src_file)
+        full_original_source += f"--- {filename} ---\n{content}\n\n"
+
+        if ext in ['.c', '.a51', '.asm']:
+            offsets = record['offsets']
+            line_map = record.get('guard', {}).get('details', {}).get('line_map')
+            if line_map:
+                # Sampled file: lines of the joined excerpts -> lines of the submitted file
+                offsets = remap_sampled_lines(offsets, line_map)
+            _extend_offsets(entry['source_offsets'], file_index, offsets)
+        if ext in ['.c']:
+            full_source += record['cleaned'] + " "
+            if use_keil_compilation:
+                c_files_for_compilation.append(src_file)
+        elif ext in ['.a51', '.asm']:
+            full_source += record['cleaned'] + " "
+            asm_files_cleaned.append(record['cleaned'])
+
+        entry['source_anomalies'].extend(record['anomalies'])
+
+    # If we need to compile C to assembly
+    if use_keil_compilation and c_files_for_compilation:
+        print(f"Compiling C files to assembly for student {student}...")
+        for c_file in c_files_for_compilation:
+            success, asm_code, error = compile_and_extract_asm(c_file, keil_path)
+            if success:
+                full_asm_source += asm_code + " "
+            else:
+                print(f"  Failed to compile {c_file}: {error}")
+
+    # Add regular assembly files to asm_source as well
+    for cleaned in asm_files_cleaned:
+        full_asm_source += cleaned + " "
+
+    entry['source'], anomaly = enforce_token_budget(full_source.strip(), max_student_tokens)
+    entry['asm_source'], asm_anomaly = enforce_token_budget(full_asm_source.strip(), max_student_tokens)
+    if anomaly:
+        del entry['source_offsets'][3 * max_student_tokens:]
+    if anomaly or asm_anomaly:
+        entry['source_anomalies'].append(anomaly or asm_anomaly)
+    entry['original_source'] = full_original_source.strip()
+
+    # Combine all hex files and collect validation info
+    full_hex = ""
+    all_hex_info = {
+        'has_eof': False,
+        'format_errors': [],
+        'valid_lines': 0,
+        'data_length': 0,
+        'checksum_errors': 0
+    }
+
+    for record in payloads['hex']:
+        if record.get('error'):
+            print(f"Error reading {record['path']}: {record['error']}")
+            continue
+        if 'hex' not in record:  # Empty file
+            continue
+
+        full_hex += record['hex']
+
+        # Aggregate hex info
+        hex_info = record['hex_info']
+        if hex_info['has_eof']:
+            all_hex_info['has_eof'] = True
+        all_hex_info['format_errors'].extend(hex_info['format_errors'])
+        all_hex_info['valid_lines'] += hex_info['valid_lines']
+        all_hex_info['checksum_errors'] += hex_info['checksum_errors']
+
+    entry['hex'] = full_hex
+    entry['hex_length'] = len(full_hex)
+    all_hex_info['data_length'] = len(full_hex)
+    entry['hex_info'] = all_hex_info
+
+    # Check if hex is empty (illegal submission - not anomaly)
+    if not full_hex or full_hex.strip() == "":
+        entry['illegal_submission'] = True
+        if entry['illegal_reason']:
+            entry['illegal_reason'] += " | 未找到有效的 hex 檔案"
+        else:
+            entry['illegal_reason'] = "無效提交：未找到有效的 hex 檔案"
+
+    return Student(student, **entry)
+
+
+def _extend_offsets(student_offsets, file_index, offsets):
+    """
+    Appends a file's (line, column) table to the student's table as
+    (file index, line, column) triples.
+    """
+    count = len(offsets) // 2
+    merged = array('I', bytes(student_offsets.itemsize * 3 * count))
+    merged[0::3] = array('I', [file_index]) * count
+    merged[1::3] = offsets[0::2]
+    merged[2::3] = offsets[1::2]
+    student_offsets.extend(merged)
+
+
+def ingest_students(student_files, use_keil_compilation=False, keil_path=None, workers=None,
+                    cache_dir=None, guard_policy=GUARD_POLICY, max_source_chars=GUARD_MAX_SOURCE_CHARS,
+                    max_student_tokens=GUARD_MAX_STUDENT_TOKENS, allowlist=None, debug_log=None):
+    """
+    Runs Step 1 for every student.
+
+    Args:
+        student_files: dict as returned by crawl_directory, or an iterable of
+            (student, files) pairs such as iter_student_files
+        use_keil_compilation (bool): Compile C files to assembly with Keil C51
+        keil_path (str, optional): Path to Keil C51 installation
+        workers (int, optional): Preprocessing processes; None uses os.cpu_count(), 1 runs serially
+        cache_dir (str, optional): Directory of the preprocessing cache; None disables caching
+        guard_policy (str): 'cap', 'sample' or 'fingerprint' for sources over max_source_chars
+        max_source_chars (int): Size limit of one decoded source file
+        max_student_tokens (int): Tokens of cleaned source compared per student
+        allowlist (dict, optional): Reference file hashes (see allowlist.py); matching
+            source files are dropped before cleaning
+        debug_log (str, optional): File the files and illegal status of every student are appended to
+
+    Returns:
+        tuple: (student_data: dict student -> Student, stats: dict with 'files', 'bytes', 'seconds',
+                'cache_hits', 'cache_misses')
+    """
+    if isinstance(student_files, dict):
+        student_files = student_files.items()
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    cache = DiskCache(os.path.join(cache_dir, CACHE_FILENAME)) if cache_dir else None
+    log = open(debug_log, 'a', encoding='utf-8') if debug_log else None
+    student_data = {}
+    stats = {'files': 0, 'bytes': 0, 'seconds': 0.0, 'cache_hits': 0, 'cache_misses': 0}
+    start = time.perf_counter()
+
+    try:
+        guard = (guard_policy, max_source_chars)
+        for student, files, payloads in _iter_preprocessed(student_files, workers, cache, guard, allowlist):
+            for records in payloads.values():
+                for record in records:
+                    if record['hash'] is not None:
+                        stats['files'] += 1
+                        stats['bytes'] += record['size']
+            student_data[student] = build_student_entry(student, files, payloads, use_keil_compilation,
+                                                        keil_path, max_student_tokens)
+
+            if log:
+                log.write(f"DEBUG: Student {student} - Illegal: {student_data[student].illegal_submission}, Reason: {student_data[student].illegal_reason}\n")
+                log.write(f"DEBUG: Files: {files}\n")
+    finally:
+        if log:
+            log.close()
+        if cache:
+            stats['cache_hits'], stats['cache_misses'] = cache.hits, cache.misses
+            cache.close()
+
+    stats['seconds'] = time.perf_counter() - start
+    elapsed = stats['seconds'] or 1e-9
+    megabytes = stats['bytes'] / (1024 * 1024)
+    print(f"Preprocessed {stats['files']} files ({megabytes:.2f} MB) in {stats['seconds']:.2f}s: "
+          f"{stats['files'] / elapsed:.1f} files/s, {megabytes / elapsed:.2f} MB/s")
+    if cache:
+        print(f"Preprocessing cache: {cache.summary()}")
+
+    return student_data, stats
@@ -1,5 +1,20 @@
 """LLM analyzer (moved to src root)."""
+import asyncio
+import difflib
+import hashlib
+import itertools
+import json
+import math
 import os
+import random
+import re
+import threading
+import time
+from concurrent.futures import Future
+
+from cache import DiskCache
+from llm_backends import GeminiBackend
+
 
 def get_llm_prompt(code1, code2):
     """
@@ -33,73 +48,879 @@ Use Traditional Chinese to respond.
 """
     return prompt.strip()
 
-import json
-import re
 
-import json
-import re
-import os
+def get_llm_diff_prompt(summary, regions):
+    """
+    Generates a prompt from the aligned regions of two code snippets that are too
+    long to send in full (see build_llm_prompt).
+    """
+    prompt = f"""
+You are an expert code plagiarism detector for 8051 assembly and C.
+The following two code snippets are too long to send in full. They were aligned token by token;
+below is a summary and the aligned regions: "=" regions are identical in both, with long ones shortened,
+"~" regions differ and show both sides. Determine if they are plagiarized.
+The codes are implemented for the same project, thus it is acceptable for algorithms to be very very similar, as long as some part of logic is different.
+Ignore variable renaming, comment changes, or whitespace differences.
+Focus on logic, use of registers, control flow, and algorithm structure.
+
+摘要:
+{summary}
+
+對齊區段:
+```
+{regions}
+```
+
+Analyze the similarities and differences.
+Conclude with a JSON object in the following format:
+{{
+    "reasoning": "Brief explanation of why...",
+    "is_plagiarized": true/false
+}}
+
+Use Traditional Chinese to respond.
+"""
+    return prompt.strip()
+
+
+def get_llm_batch_prompt(codes, pairs):
+    """
+    Generates a prompt asking for a verdict on several pairs at once; each
+    distinct code snippet is included once.
+
+    Args:
+        codes (list): (label, code) of the snippets
+        pairs (list): (pair id, label1, label2) of the pairs to judge
+    """
+    snippets = '\n\n'.join(f"程式碼 {label}:\n```\n{code}\n```" for label, code in codes)
+    pair_list = '\n'.join(f"- {pair_id}: {label1} 與 {label2}" for pair_id, label1, label2 in pairs)
+    prompt = f"""
+You are an expert code plagiarism detector for 8051 assembly and C.
+Below are several code snippets, followed by the pairs of snippets to compare.
+For every pair, determine if the two snippets are plagiarized; judge each pair independently.
+The codes are implemented for the same project, thus it is acceptable for algorithms to be very very similar, as long as some part of logic is different.
+Ignore variable renaming, comment changes, or whitespace differences.
+Focus on logic, use of registers, control flow, and algorithm structure.
+
+{snippets}
+
+待比對配對:
+{pair_list}
+
+Analyze the similarities and differences of each pair.
+Conclude with a JSON object in the following format, with exactly one verdict per pair listed above:
+{{
+    "verdicts": [
+        {{"pair": "C1-C2", "reasoning": "Brief explanation of why...", "is_plagiarized": true/false}}
+    ]
+}}
+
+Use Traditional Chinese to respond.
+"""
+    return prompt.strip()
+
+
+# Model used for all requests
+LLM_MODEL = 'gemini-2.5-flash-lite' # Use a fast and capable model
+
+# Bump whenever the prompts or LLM_PROMPT_TOKEN_BUDGET change, so cached verdicts of the old prompt are not reused
+PROMPT_VERSION = 2
+
+# Estimated tokens per request; longer pairs get a diff-focused prompt (build_llm_prompt)
+LLM_PROMPT_TOKEN_BUDGET = 6000
+# Tokens kept at each end of a shortened identical region
+PROMPT_EQUAL_CONTEXT = 8
+# Tokens shown per side of a differing region
+PROMPT_DIFF_TOKENS = 60
+
+# Verdict cache: <cache_dir>/llm.sqlite; entries expire after LLM_CACHE_TTL seconds
+LLM_CACHE_FILENAME = 'llm.sqlite'
+LLM_CACHE_TTL = 30 * 24 * 3600
+LLM_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+# Reasoning prefixes of the result dicts returned when no verdict was obtained
+_ERROR_PREFIXES = ("Google Generative AI library not installed", "No API Key provided",
+                   "LLM API Error:", "Failed to parse LLM response:")
+
+# Requests in flight at once
+LLM_CONCURRENCY = 4
+# Sustained request rate (token bucket refill) and burst size, shared by every request of a
+# run (LLMClient.limiter). Requests take a few seconds each, so LLM_CONCURRENCY workers stay
+# well under this rate and it only bites on bursts of fast replies (600 requests/min).
+LLM_REQUESTS_PER_SECOND = 10.0
+LLM_BURST = LLM_CONCURRENCY
+# Seconds before a single request is abandoned
+LLM_TIMEOUT = 60.0
+# Retries of a throttled (429), failed (5xx) or timed out request, with exponential backoff
+LLM_MAX_RETRIES = 4
+LLM_BACKOFF_BASE = 1.0
+LLM_BACKOFF_MAX = 30.0
+# Consecutive failed pairs after which the circuit breaker stops calling the API
+LLM_FAILURE_THRESHOLD = 5
+
+# Result of a pair not sent because the LLMBudget is used up; it gets the algorithmic fallback
+BUDGET_SKIPPED = {'skipped': 'budget'}
+
+# Structured response of a batched request: one verdict per pair id
+BATCH_RESPONSE_SCHEMA = {
+    'type': 'object',
+    'properties': {
+        'verdicts': {
+            'type': 'array',
+            'items': {
+                'type': 'object',
+                'properties': {
+                    'pair': {'type': 'string'},
+                    'reasoning': {'type': 'string'},
+                    'is_plagiarized': {'type': 'boolean'},
+                },
+                'required': ['pair', 'reasoning', 'is_plagiarized'],
+            },
+        },
+    },
+    'required': ['verdicts'],
+}
+
+# Error classes (see classify_error) worth retrying
+RETRYABLE_ERRORS = ('throttled', 'server', 'timeout', 'network')
 
-try:
-    import google.generativeai as genai
-except ImportError:
-    genai = None
 
 def analyze_pair_with_llm(code1, code2, api_key=None):
     """
     Sends the code pair to an LLM for analysis using Google Gemini API.
+    For a single pair; a run should create one LLMClient and reuse it.
+    """
+    return LLMClient(api_key).analyze(code1, code2)
+
+
+async def analyze_pair_with_llm_async(code1, code2, api_key=None, limiter=None, timeout=LLM_TIMEOUT,
+                                      max_retries=LLM_MAX_RETRIES):
+    """
+    Async analyze_pair_with_llm: same result dicts, plus rate limiting, a per-request
+    timeout and backoff on 429/5xx.
+    """
+    client = LLMClient(api_key, timeout=timeout, max_retries=max_retries)
+    return await client.analyze_async(code1, code2, limiter)
+
+
+def parse_llm_response(content):
+    """
+    Extracts the JSON verdict from the model's reply.
+    """
+    try:
+        # Clean up markdown code blocks if present
+        content = content.replace('```json', '').replace('```', '')
+        result = json.loads(content)
+        return result
+    except json.JSONDecodeError:
+        # Fallback if not valid JSON (try to extract json block)
+        match = re.search(r'\{.*\}', content, re.DOTALL)
+        if match:
+            return json.loads(match.group(0))
+        else:
+            return {
+                "is_plagiarized": False,
+                "confidence_score": 0.0,
+                "reasoning": f"Failed to parse LLM response: {content[:100]}..."
+            }
+
+
+def is_llm_error(result):
+    """
+    True if the result dict reports a failure (no library or key, API error,
+    unparsable reply) rather than a verdict of the model.
+    """
+    if not isinstance(result, dict) or 'is_plagiarized' not in result:
+        return True
+    return str(result.get('reasoning', '')).startswith(_ERROR_PREFIXES)
+
+
+def open_llm_cache(cache_dir, ttl=LLM_CACHE_TTL, max_bytes=LLM_CACHE_MAX_BYTES):
+    return DiskCache(os.path.join(cache_dir, LLM_CACHE_FILENAME), max_bytes=max_bytes, ttl=ttl)
+
+
+def llm_cache_key(code1, code2, model=LLM_MODEL, prompt_version=PROMPT_VERSION,
+                  token_budget=LLM_PROMPT_TOKEN_BUDGET, kind=None):
+    """
+    Cache key of a verdict; the order of the two codes does not matter.
+    The verdict depends on the prompt it was asked with, so the key also names the
+    prompt token budget and kind: "single" (full prompt), "diff" (build_llm_prompt
+    summary of a pair over the budget) or "batch" (several pairs per request).
+    kind defaults to the one build_llm_prompt picks for this pair.
+    """
+    hashes = sorted(hashlib.sha256(code.encode('utf-8')).hexdigest() for code in (code1, code2))
+    if kind is None:
+        kind = 'single' if estimate_tokens(get_llm_prompt(code1, code2)) <= token_budget else 'diff'
+    return f"v{prompt_version}:{model}:{kind}:{token_budget}:{hashes[0]}:{hashes[1]}"
+
+
+def estimate_tokens(text):
+    """
+    Rough token count of a prompt: about 4 ASCII characters per token, one token
+    per other character (the Chinese instructions).
+    """
+    ascii_chars = len(text.encode('ascii', 'ignore'))
+    return math.ceil(ascii_chars / 4) + len(text) - ascii_chars
+
+
+def _shorten(tokens, head, tail, label):
+    if len(tokens) <= head + tail:
+        return ' '.join(tokens)
+    parts = tokens[:head] + [f"…({len(tokens) - head - tail} {label})…"] + (tokens[-tail:] if tail else [])
+    return ' '.join(parts)
+
+
+def build_llm_prompt(code1, code2, budget=LLM_PROMPT_TOKEN_BUDGET):
+    """
+    Prompt for one pair within an estimated token budget.
+
+    Pairs whose full prompt fits are sent in full (get_llm_prompt). Longer pairs
+    are aligned with difflib and sent as a summary plus the aligned regions:
+    differing regions with up to PROMPT_DIFF_TOKENS tokens per side, identical
+    regions shortened to PROMPT_EQUAL_CONTEXT tokens at each end. Regions are
+    added in order until the budget is used up; the rest are counted as omitted.
+
+    Returns:
+        tuple: (prompt, estimated tokens of the full prompt)
+    """
+    full_prompt = get_llm_prompt(code1, code2)
+    full_tokens = estimate_tokens(full_prompt)
+    if full_tokens <= budget:
+        return full_prompt, full_tokens
+
+    tokens1, tokens2 = code1.split(), code2.split()
+    opcodes = difflib.SequenceMatcher(None, tokens1, tokens2, autojunk=False).get_opcodes()
+    equal = [op for op in opcodes if op[0] == 'equal']
+    matched = sum(i2 - i1 for _, i1, i2, _, _ in equal)
+    total = len(tokens1) + len(tokens2)
+    summary = (f"- 左部分 {len(tokens1)} tokens，右部分 {len(tokens2)} tokens\n"
+               f"- 相同區段 {len(equal)} 段，共 {matched} tokens（相似度 {2 * matched / total if total else 1.0:.0%}）；"
+               f"相異區段 {len(opcodes) - len(equal)} 段")
+
+    blocks = []
+    for tag, i1, i2, j1, j2 in opcodes:
+        position = f"左[{i1}:{i2}] 右[{j1}:{j2}]"
+        if tag == 'equal':
+            text = _shorten(tokens1[i1:i2], PROMPT_EQUAL_CONTEXT, PROMPT_EQUAL_CONTEXT, "tokens 相同")
+            blocks.append(f"= {position}\n  {text}")
+        else:
+            left = _shorten(tokens1[i1:i2], PROMPT_DIFF_TOKENS, 0, "tokens") or "(無)"
+            right = _shorten(tokens2[j1:j2], PROMPT_DIFF_TOKENS, 0, "tokens") or "(無)"
+            blocks.append(f"~ {position}\n  左: {left}\n  右: {right}")
+
+    remaining = budget - estimate_tokens(get_llm_diff_prompt(summary, ""))
+    kept = []
+    for block in blocks:
+        cost = estimate_tokens(block) + 1
+        if cost > remaining:
+            break
+        kept.append(block)
+        remaining -= cost
+    if len(kept) < len(blocks):
+        kept.append(f"…(另有 {len(blocks) - len(kept)} 個區段因長度限制省略)")
+    return get_llm_diff_prompt(summary, '\n'.join(kept)), full_tokens
+
+
+def group_llm_batches(pairs, batch_size, budget=LLM_PROMPT_TOKEN_BUDGET):
+    """
+    Packs pairs into batched requests.
+
+    Pairs sharing a code snippet (e.g. a ring of students copying from each other)
+    are kept next to each other, so a batch carries each snippet once. A batch
+    takes at most batch_size pairs and, by estimate, budget prompt tokens; a pair
+    too long for any batch gets a request of its own.
+
+    Args:
+        pairs (list): (code1, code2) per pair
+
+    Returns:
+        list: Lists of indices into pairs, one per request
+    """
+    # Connected components of the "shares a snippet" graph, in order of first appearance
+    parent = {}
+
+    def find(code):
+        parent.setdefault(code, code)
+        while parent[code] != code:
+            parent[code] = parent[parent[code]]
+            code = parent[code]
+        return code
+
+    for code1, code2 in pairs:
+        parent[find(code1)] = find(code2)
+    clusters = {}
+    for index, (code1, _) in enumerate(pairs):
+        clusters.setdefault(find(code1), []).append(index)
+
+    def cost(indices, known):
+        codes = set(itertools.chain.from_iterable(pairs[i] for i in indices)) - known
+        return sum(estimate_tokens(code) for code in codes) + 20 * len(indices), codes
+
+    overhead = estimate_tokens(get_llm_batch_prompt([], []))
+    batches, batch, codes, tokens = [], [], set(), overhead
+    for cluster in clusters.values():
+        # Start a new request rather than split a cluster that fits in one
+        if batch and (len(batch) + len(cluster) > batch_size or tokens + cost(cluster, codes)[0] > budget):
+            batches.append(batch)
+            batch, codes, tokens = [], set(), overhead
+        for index in cluster:
+            pair_cost, new_codes = cost([index], codes)
+            if batch and (len(batch) >= batch_size or tokens + pair_cost > budget):
+                batches.append(batch)
+                batch, codes, tokens = [], set(), overhead
+                pair_cost, new_codes = cost([index], codes)
+            batch.append(index)
+            codes |= new_codes
+            tokens += pair_cost
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def _pair_key(pair_id):
+    return re.sub(r'[\s_:/]+', '', str(pair_id)).upper().replace('與', '-')
+
+
+def parse_batch_response(content, pair_ids):
     """
-    if not genai:
-        return {
-            "is_plagiarized": False,
-            "reasoning": "Google Generative AI library not installed. Please run `pip install google-generativeai`."
-        }
-        
-    # Try to get API key from env if not provided
-    if not api_key:
-        api_key = os.getenv("GEMINI_API_KEY")
-        
-    if not api_key:
-        return {
-            "is_plagiarized": False,
-            "reasoning": "No API Key provided. Please set GEMINI_API_KEY environment variable."
-        }
+    Maps the verdicts of a batched reply back to their pairs.
+
+    Pair ids are matched ignoring case, spaces and order ("c2 - C1" is "C1-C2");
+    entries without a boolean verdict, unknown ids and repeated ids are skipped.
 
+    Returns:
+        dict: pair id -> result dict; pairs without a usable verdict are missing
+    """
+    content = content.replace('```json', '').replace('```', '')
     try:
-        genai.configure(api_key=api_key)
-        model = genai.GenerativeModel('gemini-2.5-flash-lite') # Use a fast and capable model
-        
-        prompt = get_llm_prompt(code1, code2)
-        # Force JSON format in prompt if not already clear, though the prompt function does it.
-        # Gemini doesn't have a strict 'json_object' mode like OpenAI, so we rely on the prompt.
-        
-        response = model.generate_content(prompt)
-        content = response.text
-        
-        # Parse JSON response
+        data = json.loads(content)
+    except json.JSONDecodeError:
+        match = re.search(r'[\[{].*[\]}]', content, re.DOTALL)
         try:
-            # Clean up markdown code blocks if present
-            content = content.replace('```json', '').replace('```', '')
-            result = json.loads(content)
-            return result
+            data = json.loads(match.group(0)) if match else None
         except json.JSONDecodeError:
-            # Fallback if not valid JSON (try to extract json block)
-            match = re.search(r'\{.*\}', content, re.DOTALL)
-            if match:
-                return json.loads(match.group(0))
+            data = None
+    items = data.get('verdicts', []) if isinstance(data, dict) else data
+    if not isinstance(items, list):
+        return {}
+
+    lookup = {}
+    for pair_id in pair_ids:
+        label1, label2 = pair_id.split('-')
+        lookup[_pair_key(pair_id)] = pair_id
+        lookup[_pair_key(f"{label2}-{label1}")] = pair_id
+    verdicts = {}
+    for item in items:
+        if not isinstance(item, dict):
+            continue
+        pair = item.get('pair')
+        if isinstance(pair, (list, tuple)):
+            pair = '-'.join(map(str, pair))
+        pair_id = lookup.get(_pair_key(pair))
+        verdict = item.get('is_plagiarized')
+        if isinstance(verdict, str) and verdict.lower() in ('true', 'false'):
+            verdict = verdict.lower() == 'true'
+        if pair_id is None or pair_id in verdicts or not isinstance(verdict, bool):
+            continue
+        verdicts[pair_id] = {'is_plagiarized': verdict, 'reasoning': str(item.get('reasoning', ''))}
+    return verdicts
+
+
+def _batch_prompt(pairs):
+    """
+    Returns (prompt, pair id per pair); identical snippets get one label.
+    """
+    labels = {}
+    for pair in pairs:
+        for code in pair:
+            labels.setdefault(code, f"C{len(labels) + 1}")
+    pair_ids = [f"{labels[code1]}-{labels[code2]}" for code1, code2 in pairs]
+    listed = dict(zip(pair_ids, pairs))
+    prompt = get_llm_batch_prompt([(label, code) for code, label in labels.items()],
+                                  [(pair_id, labels[code1], labels[code2])
+                                   for pair_id, (code1, code2) in listed.items()])
+    return prompt, pair_ids
+
+
+def _api_error(e):
+    return {
+        "is_plagiarized": False,
+        "confidence_score": 0.0,
+        "reasoning": f"LLM API Error: {str(e)}"
+    }
+
+
+def classify_error(e):
+    """
+    Classifies a failed request: 'throttled' (429), 'auth' (rejected key), 'client'
+    (other 4xx), 'server' (5xx), 'timeout', 'network' or 'unknown'.
+    google.api_core exceptions carry the HTTP status in `code`.
+    """
+    if isinstance(e, (asyncio.TimeoutError, TimeoutError)):
+        return 'timeout'
+    code = getattr(e, 'code', None)
+    if isinstance(code, int):
+        if code == 429:
+            return 'throttled'
+        if code in (401, 403) or (code == 400 and 'API key' in str(e)):
+            return 'auth'
+        if 400 <= code < 500:
+            return 'client'
+        if code >= 500:
+            return 'server'
+    if isinstance(e, (ConnectionError, OSError)):
+        return 'network'
+    return 'unknown'
+
+
+def is_retryable(e):
+    """
+    True for throttling (429), server errors (5xx), timeouts and network errors.
+    """
+    return classify_error(e) in RETRYABLE_ERRORS
+
+
+def _backoff_delay(attempt, backoff_base, backoff_max):
+    # Exponential backoff with jitter
+    return min(backoff_max, backoff_base * 2 ** attempt) * random.uniform(0.5, 1.0)
+
+
+async def call_with_retries(request, limiter=None, timeout=LLM_TIMEOUT, max_retries=LLM_MAX_RETRIES,
+                            backoff_base=LLM_BACKOFF_BASE, backoff_max=LLM_BACKOFF_MAX):
+    """
+    Awaits request() (a coroutine function) under the rate limiter and timeout,
+    retrying retryable errors with exponential backoff and jitter.
+    The last error is raised once the retries are used up.
+    """
+    attempt = 0
+    while True:
+        if limiter:
+            await limiter.acquire()
+        try:
+            return await asyncio.wait_for(request(), timeout)
+        except Exception as e:
+            if attempt >= max_retries or not is_retryable(e):
+                raise
+            await asyncio.sleep(_backoff_delay(attempt, backoff_base, backoff_max))
+            attempt += 1
+
+
+def call_with_retries_sync(request, limiter=None, max_retries=LLM_MAX_RETRIES, backoff_base=LLM_BACKOFF_BASE,
+                           backoff_max=LLM_BACKOFF_MAX):
+    """
+    Blocking call_with_retries; the timeout is left to request() itself.
+    """
+    attempt = 0
+    while True:
+        if limiter:
+            limiter.acquire_sync()
+        try:
+            return request()
+        except Exception as e:
+            if attempt >= max_retries or not is_retryable(e):
+                raise
+            time.sleep(_backoff_delay(attempt, backoff_base, backoff_max))
+            attempt += 1
+
+
+class LLMClient:
+    """
+    LLM session shared by all pairs of a run, sending requests through a backend
+    (llm_backends.GeminiBackend unless another one is given).
+
+    Failed requests are classified with classify_error and retryable ones are
+    retried with backoff. After failure_threshold consecutive failed pairs, or a
+    rejected API key, the circuit breaker opens: analyze() then returns None at
+    once, so every remaining pair gets the algorithmic fallback.
+
+    Args:
+        api_key (str, optional): Gemini API key, defaults to GEMINI_API_KEY
+        model (str): Gemini model name
+        timeout (float): Seconds per request
+        max_retries (int): Retries of 429/5xx/timeouts/network errors
+        failure_threshold (int): Consecutive failures that open the circuit breaker
+        token_budget (int): Estimated prompt tokens per request (build_llm_prompt)
+        backend (optional): e.g. llm_backends.HttpBackend; api_key and model are then unused
+        budget (LLMBudget, optional): Caps requests, tokens or time; pairs past it get BUDGET_SKIPPED
+        requests_per_second (float), burst (int): Token bucket (self.limiter) every request waits
+            for, inline or concurrent; None sends requests unthrottled
+    """
+
+    def __init__(self, api_key=None, model=LLM_MODEL, timeout=LLM_TIMEOUT, max_retries=LLM_MAX_RETRIES,
+                 failure_threshold=LLM_FAILURE_THRESHOLD, token_budget=LLM_PROMPT_TOKEN_BUDGET, backend=None,
+                 budget=None, requests_per_second=LLM_REQUESTS_PER_SECOND, burst=LLM_BURST):
+        self.backend = backend or GeminiBackend(model, api_key)
+        self.budget = budget
+        self.limiter = TokenBucket(requests_per_second, burst) if requests_per_second else None
+        self.model_name = self.backend.name
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.failure_threshold = failure_threshold
+        self.token_budget = token_budget
+        self.requests = 0
+        self.prompt_tokens = 0      # estimated tokens of the prompts sent
+        self.full_prompt_tokens = 0 # estimated tokens had every pair been sent in full
+        self.diff_prompts = 0       # pairs sent as a diff-focused prompt
+        self.batched_pairs = 0      # pairs sent in batched requests (analyze_batch)
+        self.batch_fallbacks = 0    # of these, pairs asked about again one at a time
+        self.errors = {}            # error class -> failed requests
+        self.consecutive_failures = 0
+        self.breaker_open = False
+        self.skipped = 0            # pairs sent to the fallback by the open breaker
+        self.over_budget = 0        # pairs sent to the fallback by the used up budget
+        self._lock = threading.Lock()
+
+        # Result returned for every pair when the backend cannot be used
+        self.unavailable = None
+        if self.backend.unavailable:
+            self.unavailable = {"is_plagiarized": False, "reasoning": self.backend.unavailable}
+
+    def _admit(self, prompt, full_tokens, pairs=1):
+        """
+        Checks the circuit breaker and the budget before prompt is sent for `pairs` pairs.
+        Returns (send, result): whether to send it, and the result to return instead if not.
+        """
+        tokens = estimate_tokens(prompt)
+        with self._lock:
+            if self.breaker_open:
+                self.skipped += pairs
+                return False, None
+            if self.budget and not self.budget.charge(tokens):
+                self.over_budget += pairs
+                return False, dict(BUDGET_SKIPPED)
+            self.requests += 1
+            self.prompt_tokens += tokens
+            self.full_prompt_tokens += full_tokens
+            if pairs > 1:
+                self.batched_pairs += pairs
+            elif tokens < full_tokens:
+                self.diff_prompts += 1
+        return True, None
+
+    def _record(self, error=None):
+        with self._lock:
+            if error is None:
+                self.consecutive_failures = 0
+                return
+            kind = classify_error(error)
+            self.errors[kind] = self.errors.get(kind, 0) + 1
+            if kind == 'client':
+                return  # Specific to this pair (e.g. prompt too long), not a sign of an outage
+            self.consecutive_failures += 1
+            if not self.breaker_open and (kind == 'auth' or self.consecutive_failures >= self.failure_threshold):
+                self.breaker_open = True
+                print(f"LLM circuit breaker opened after {self.consecutive_failures} failed requests "
+                      f"({kind}: {error}); remaining pairs use the algorithmic fallback")
+
+    def _send(self, prompt, schema=None):
+        """
+        Sends a prompt with retries; returns (reply text, None) or (None, error dict).
+        """
+        try:
+            text = call_with_retries_sync(lambda: self.backend.generate(prompt, self.timeout, schema),
+                                          self.limiter, self.max_retries)
+        except Exception as e:
+            self._record(e)
+            return None, _api_error(e)
+        self._record()
+        return text, None
+
+    async def _send_async(self, prompt, limiter, schema=None):
+        try:
+            text = await call_with_retries(lambda: self.backend.generate_async(prompt, self.timeout, schema),
+                                           limiter or self.limiter, self.timeout, self.max_retries)
+        except Exception as e:
+            self._record(e)
+            return None, _api_error(e)
+        self._record()
+        return text, None
+
+    @staticmethod
+    def _parse(text):
+        try:
+            return parse_llm_response(text)
+        except Exception as e:
+            return _api_error(e)
+
+    def analyze(self, code1, code2):
+        """
+        Returns the verdict dict, an error dict, BUDGET_SKIPPED once the budget is used
+        up, or None once the circuit breaker is open.
+        """
+        if self.unavailable:
+            return dict(self.unavailable)
+        prompt, full_tokens = build_llm_prompt(code1, code2, self.token_budget)
+        send, result = self._admit(prompt, full_tokens)
+        if not send:
+            return result
+        text, error = self._send(prompt)
+        return error or self._parse(text)
+
+    async def analyze_async(self, code1, code2, limiter=None):
+        """
+        Async analyze(); limiter (TokenBucket) replaces self.limiter for this request.
+        """
+        if self.unavailable:
+            return dict(self.unavailable)
+        prompt, full_tokens = build_llm_prompt(code1, code2, self.token_budget)
+        send, result = self._admit(prompt, full_tokens)
+        if not send:
+            return result
+        text, error = await self._send_async(prompt, limiter)
+        return error or self._parse(text)
+
+    def _prepare_batch(self, pairs):
+        """
+        Returns (prompt, pair ids, None), or (None, None, result for every pair) if no request is sent.
+        """
+        if self.unavailable:
+            return None, None, self.unavailable
+        prompt, pair_ids = _batch_prompt(pairs)
+        full_tokens = sum(build_llm_prompt(code1, code2, self.token_budget)[1] for code1, code2 in pairs)
+        send, result = self._admit(prompt, full_tokens, len(pairs))
+        if not send:
+            return None, None, result
+        return prompt, pair_ids, None
+
+    def _batch_results(self, pairs, pair_ids, text, error):
+        """
+        Results of a batched request, with None for the pairs to ask about again one at a time.
+        """
+        if error:
+            return [dict(error) for _ in pairs]
+        try:
+            verdicts = parse_batch_response(text, pair_ids)
+        except Exception:
+            verdicts = {}
+        results = [verdicts.get(pair_id) for pair_id in pair_ids]
+        with self._lock:
+            self.batch_fallbacks += results.count(None)
+        return results
+
+    def analyze_batch(self, pairs):
+        """
+        Judges several pairs in one request with a structured (JSON schema) response.
+        Pairs the reply has no usable verdict for are sent again as single-pair requests.
+
+        Args:
+            pairs (list): (code1, code2) per pair
+
+        Returns:
+            list: One analyze() result per pair
+        """
+        if len(pairs) == 1:
+            return [self.analyze(*pairs[0])]
+        prompt, pair_ids, skipped = self._prepare_batch(pairs)
+        if prompt is None:
+            return [dict(skipped) if skipped else None for _ in pairs]
+        text, error = self._send(prompt, BATCH_RESPONSE_SCHEMA)
+        results = self._batch_results(pairs, pair_ids, text, error)
+        return [result if result is not None else self.analyze(code1, code2)
+                for result, (code1, code2) in zip(results, pairs)]
+
+    async def analyze_batch_async(self, pairs, limiter=None):
+        """
+        Async analyze_batch(); limiter (TokenBucket) replaces self.limiter for its requests.
+        """
+        if len(pairs) == 1:
+            return [await self.analyze_async(*pairs[0], limiter)]
+        prompt, pair_ids, skipped = self._prepare_batch(pairs)
+        if prompt is None:
+            return [dict(skipped) if skipped else None for _ in pairs]
+        text, error = await self._send_async(prompt, limiter, BATCH_RESPONSE_SCHEMA)
+        results = self._batch_results(pairs, pair_ids, text, error)
+        retried = await asyncio.gather(*(self.analyze_async(code1, code2, limiter)
+                                         for result, (code1, code2) in zip(results, pairs) if result is None))
+        retried = iter(retried)
+        return [result if result is not None else next(retried) for result in results]
+
+    def summary(self):
+        """
+        One-line request/error summary for progress output.
+        """
+        if self.unavailable:
+            return f"unavailable ({self.unavailable['reasoning']})"
+        failed = sum(self.errors.values())
+        text = f"{self.requests} requests, {failed} failed"
+        if self.errors:
+            text += " (" + ", ".join(f"{kind}: {count}" for kind, count in sorted(self.errors.items())) + ")"
+        if self.batched_pairs:
+            text += f"; {self.batched_pairs} pairs batched, {self.batch_fallbacks} asked again one at a time"
+        if self.requests:
+            text += f"; ~{self.prompt_tokens} prompt tokens"
+            if self.diff_prompts or self.batched_pairs:
+                text += (f" (diff-focused prompts and batching saved "
+                         f"~{self.full_prompt_tokens - self.prompt_tokens} of {self.full_prompt_tokens})")
+        if self.breaker_open:
+            text += f"; circuit breaker open, {self.skipped} pairs used the fallback"
+        if self.over_budget:
+            text += f"; {self.budget.exhausted} budget used up, {self.over_budget} pairs used the fallback"
+        return text
+
+
+class LLMBudget:
+    """
+    Cap on the LLM work of a run. Once any limit would be exceeded, no further
+    request is sent, so with requests ordered by suspicion the least suspicious
+    pairs are the ones left to the algorithmic fallback.
+
+    Args:
+        max_requests (int, optional): Requests sent, batched requests counting once
+        max_tokens (int, optional): Estimated prompt tokens sent
+        max_seconds (float, optional): Seconds after start() at which no new request is sent
+    """
+
+    def __init__(self, max_requests=None, max_tokens=None, max_seconds=None):
+        self.max_requests = max_requests
+        self.max_tokens = max_tokens
+        self.max_seconds = max_seconds
+        self.requests = 0
+        self.tokens = 0
+        self.exhausted = None       # 'requests', 'tokens' or 'time' once used up
+        self._deadline = None
+
+    def start(self):
+        """
+        Starts the clock of max_seconds; called when the first request is about to be sent.
+        """
+        if self.max_seconds is not None and self._deadline is None:
+            self._deadline = time.monotonic() + self.max_seconds
+
+    def charge(self, tokens):
+        """
+        Counts a request of `tokens` estimated prompt tokens.
+        Returns False (and sends nothing more) if it does not fit the budget.
+        Not thread-safe; LLMClient calls it under its lock.
+        """
+        if self.exhausted:
+            return False
+        self.start()
+        if self.max_requests is not None and self.requests + 1 > self.max_requests:
+            self.exhausted = 'requests'
+        elif self.max_tokens is not None and self.tokens + tokens > self.max_tokens:
+            self.exhausted = 'tokens'
+        elif self._deadline is not None and time.monotonic() > self._deadline:
+            self.exhausted = 'time'
+        else:
+            self.requests += 1
+            self.tokens += tokens
+            return True
+        return False
+
+
+class TokenBucket:
+    """
+    Token bucket shared by inline and event loop requests: acquire() (async) and
+    acquire_sync() (blocking) wait until a request may be sent.
+
+    Args:
+        rate (float): Tokens added per second
+        capacity (int): Bucket size, i.e. the largest burst
+    """
+
+    def __init__(self, rate=LLM_REQUESTS_PER_SECOND, capacity=LLM_BURST):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _reserve(self):
+        """
+        Takes a token, going into debt if the bucket is empty.
+        Returns the seconds to wait before the token may be used.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            return max(0.0, -self._tokens / self.rate)
+
+    async def acquire(self):
+        delay = self._reserve()
+        if delay:
+            await asyncio.sleep(delay)
+
+    def acquire_sync(self):
+        delay = self._reserve()
+        if delay:
+            time.sleep(delay)
+
+
+class AsyncLLMAnalyzer:
+    """
+    Runs LLMClient.analyze_async on a private event loop thread, at most
+    `concurrency` requests at a time. submit() can be called from synchronous code
+    and returns a concurrent.futures.Future with the result.
+
+    Args:
+        client (LLMClient): Shared session (circuit breaker and rate limiter) of the run
+        concurrency (int): Requests in flight at once
+    """
+
+    def __init__(self, client, concurrency=LLM_CONCURRENCY):
+        self.client = client
+        self._loop = asyncio.new_event_loop()
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._thread = threading.Thread(target=self._loop.run_forever, name="llm-analyzer", daemon=True)
+        self._thread.start()
+
+    async def _analyze(self, code1, code2):
+        async with self._semaphore:
+            return await self.client.analyze_async(code1, code2)
+
+    def submit(self, code1, code2):
+        return asyncio.run_coroutine_threadsafe(self._analyze(code1, code2), self._loop)
+
+    async def _analyze_batch(self, pairs):
+        async with self._semaphore:
+            return await self.client.analyze_batch_async(pairs)
+
+    def submit_batch(self, pairs):
+        """
+        Sends pairs as one batched request (LLMClient.analyze_batch_async).
+        Returns one concurrent.futures.Future per pair.
+        """
+        batch = asyncio.run_coroutine_threadsafe(self._analyze_batch(pairs), self._loop)
+        futures = [Future() for _ in pairs]
+
+        def done(batch):
+            try:
+                results = batch.result()
+            except BaseException as e:
+                for future in futures:
+                    future.set_exception(e)
             else:
-                return {
-                    "is_plagiarized": False,
-                    "confidence_score": 0.0,
-                    "reasoning": f"Failed to parse LLM response: {content[:100]}..."
-                }
-                
-    except Exception as e:
-        return {
-            "is_plagiarized": False,
-            "confidence_score": 0.0,
-            "reasoning": f"LLM API Error: {str(e)}"
-        }
+                for future, result in zip(futures, results):
+                    future.set_result(result)
+
+        batch.add_done_callback(done)
+        return futures
+
+    async def _cancel_pending(self):
+        tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def close(self):
+        """
+        Cancels requests still pending and stops the event loop thread.
+        """
+        if self._loop.is_closed():
+            return
+        asyncio.run_coroutine_threadsafe(self._cancel_pending(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
 
 def analyze_pair_dummy(code1, code2):
     """
@@ -0,0 +1,109 @@
+"""
+LLM backends used by llm_analyzer.LLMClient.
+
+A backend turns a prompt into the model's reply text:
+
+    backend.name                               # identifies the model in verdict cache keys
+    backend.unavailable                        # None, or why no request can be sent
+    backend.generate(prompt, timeout, schema)  # reply text; raises on failure
+    await backend.generate_async(prompt, timeout, schema)
+
+schema is a JSON schema the reply must follow (batched requests), or None.
+Failures are raised as is; exceptions carrying an HTTP status in `code`
+(google.api_core errors, urllib.error.HTTPError) are classified by
+llm_analyzer.classify_error.
+"""
+import asyncio
+import json
+import os
+import urllib.request
+
+try:
+    import google.generativeai as genai
+except ImportError:
+    genai = None
+
+
+class GeminiBackend:
+    """
+    Google Gemini through google-generativeai; the API is configured and the
+    model constructed once.
+
+    Args:
+        model (str): Gemini model name
+        api_key (str, optional): Defaults to GEMINI_API_KEY
+    """
+
+    def __init__(self, model, api_key=None):
+        self.name = model
+        self.unavailable = None
+        self._model = None
+
+        if not genai:
+            self.unavailable = ("Google Generative AI library not installed. "
+                                "Please run `pip install google-generativeai`.")
+            return
+
+        # Try to get API key from env if not provided
+        api_key = api_key or os.getenv("GEMINI_API_KEY")
+        if not api_key:
+            self.unavailable = "No API Key provided. Please set GEMINI_API_KEY environment variable."
+            return
+
+        try:
+            genai.configure(api_key=api_key)
+            self._model = genai.GenerativeModel(model)
+        except Exception as e:
+            self.unavailable = f"LLM API Error: {str(e)}"
+
+    @staticmethod
+    def _options(schema):
+        if not schema:
+            # Gemini doesn't have a strict 'json_object' mode like OpenAI, so we rely on the prompt.
+            return {}
+        return {'generation_config': {'response_mime_type': 'application/json', 'response_schema': schema}}
+
+    def generate(self, prompt, timeout, schema=None):
+        response = self._model.generate_content(prompt, request_options={'timeout': timeout},
+                                                **self._options(schema))
+        return response.text
+
+    async def generate_async(self, prompt, timeout, schema=None):
+        response = await self._model.generate_content_async(prompt, **self._options(schema))
+        return response.text
+
+
+class HttpBackend:
+    """
+    Any service speaking a minimal JSON protocol, e.g. llm_stub_server.py or a
+    small proxy in front of another provider:
+
+        POST <url>  {"model": ..., "prompt": ..., "response_schema": ... or null}
+        200         {"text": "<reply of the model>"}
+
+    Other statuses are raised as urllib.error.HTTPError (429 = throttled).
+
+    Args:
+        url (str): Endpoint receiving the POST requests
+        model (str): Sent along as "model"
+        api_key (str, optional): Sent as a bearer token; defaults to LLM_API_KEY
+    """
+
+    def __init__(self, url, model='default', api_key=None):
+        self.url = url
+        self.model = model
+        self.name = f"{model}@{url}"
+        self.unavailable = None
+        self.api_key = api_key or os.getenv("LLM_API_KEY")
+
+    def generate(self, prompt, timeout, schema=None):
+        body = json.dumps({'model': self.model, 'prompt': prompt, 'response_schema': schema}).encode('utf-8')
+        headers = {'Content-Type': 'application/json'}
+        if self.api_key:
+            headers['Authorization'] = f"Bearer {self.api_key}"
+        request = urllib.request.Request(self.url, data=body, headers=headers, method='POST')
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            return json.loads(response.read().decode('utf-8'))['text']
+
+    async def generate_async(self, prompt, timeout, schema=None):
+        return await asyncio.to_thread(self.generate, prompt, timeout, schema)
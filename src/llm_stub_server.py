@@ -0,0 +1,208 @@
+"""
+Local stand-in for an LLM API, for load testing Step 4 with no network.
+
+It speaks the llm_backends.HttpBackend protocol and answers every prompt with a
+made-up verdict after a configurable latency. It can also fail a share of the
+requests with 503, and throttle clients above a request rate with 429. This
+exercises the concurrency limits, retries, circuit breaker, verdict cache and
+batch fallback of llm_analyzer:
+
+    python src/llm_stub_server.py --port 8765 --latency 0.5 --error-rate 0.05 --rate-limit 5
+    python src/cli.py analyze --llm-url http://127.0.0.1:8765/ --llm-workers 8
+
+GET /stats returns the request counters as JSON.
+"""
+import argparse
+import hashlib
+import json
+import random
+import re
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Pair lines of a batched prompt (llm_analyzer.get_llm_batch_prompt)
+_BATCH_PAIR = re.compile(r'^- (C\d+-C\d+):', re.MULTILINE)
+
+
+class StubConfig:
+    """
+    Behaviour of the stub server.
+
+    Args:
+        latency (float): Mean seconds before a reply
+        jitter (float): Latency varies uniformly by up to this many seconds either way
+        error_rate (float): Share of requests failed with 503
+        rate_limit (float): Requests per second above which clients get 429 (0 = unlimited)
+        burst (int): Requests allowed at once before rate_limit applies
+        plagiarism_rate (float): Share of pairs judged plagiarized
+        drop_rate (float): Share of pairs left out of batched replies
+        seed (int, optional): Seed of the error and drop draws
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, rate_limit=0.0, burst=1, plagiarism_rate=0.5,
+                 drop_rate=0.0, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.burst = burst
+        self.plagiarism_rate = plagiarism_rate
+        self.drop_rate = drop_rate
+        self.seed = seed
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, config):
+        super().__init__(address, StubHandler)
+        self.config = config
+        self.stats = {'requests': 0, 'ok': 0, 'errors': 0, 'throttled': 0}
+        self._rng = random.Random(config.seed)
+        self._lock = threading.Lock()
+        self._tokens = float(config.burst)
+        self._updated = time.monotonic()
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/"
+
+    def admit(self):
+        """
+        Returns the HTTP status of the next request: 200, 429 (throttled) or 503 (injected error).
+        """
+        config = self.config
+        with self._lock:
+            self.stats['requests'] += 1
+            if config.rate_limit:
+                now = time.monotonic()
+                self._tokens = min(config.burst, self._tokens + (now - self._updated) * config.rate_limit)
+                self._updated = now
+                if self._tokens < 1:
+                    self.stats['throttled'] += 1
+                    return 429
+                self._tokens -= 1
+            if self._rng.random() < config.error_rate:
+                self.stats['errors'] += 1
+                return 503
+            self.stats['ok'] += 1
+            return 200
+
+    def delay(self):
+        with self._lock:
+            jitter = self._rng.uniform(-self.config.jitter, self.config.jitter)
+        return max(0.0, self.config.latency + jitter)
+
+    def dropped(self):
+        with self._lock:
+            return self._rng.random() < self.config.drop_rate
+
+    def verdict(self, text):
+        # Deterministic per prompt or pair, so repeated runs agree
+        digest = hashlib.sha256(text.encode('utf-8')).digest()
+        return int.from_bytes(digest[:4], 'big') / 2 ** 32 < self.config.plagiarism_rate
+
+    def reply(self, prompt, schema):
+        if not schema:
+            plagiarized = self.verdict(prompt)
+            return json.dumps({'reasoning': f"Stub verdict: {'抄襲' if plagiarized else '未抄襲'}",
+                               'is_plagiarized': plagiarized}, ensure_ascii=False)
+        verdicts = []
+        for pair_id in _BATCH_PAIR.findall(prompt):
+            if self.dropped():
+                continue
+            plagiarized = self.verdict(prompt + pair_id)
+            verdicts.append({'pair': pair_id, 'reasoning': f"Stub verdict: {'抄襲' if plagiarized else '未抄襲'}",
+                             'is_plagiarized': plagiarized})
+        return json.dumps({'verdicts': verdicts}, ensure_ascii=False)
+
+
+class StubHandler(BaseHTTPRequestHandler):
+
+    def _send_json(self, status, data, headers=None):
+        body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.rstrip('/') != '/stats':
+            self._send_json(404, {'error': 'not found'})
+            return
+        with self.server._lock:
+            stats = dict(self.server.stats)
+        self._send_json(200, stats)
+
+    def do_POST(self):
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            prompt = request['prompt']
+        except (ValueError, KeyError, TypeError):
+            self._send_json(400, {'error': 'expected {"prompt": ...}'})
+            return
+
+        status = self.server.admit()
+        if status == 429:
+            self._send_json(429, {'error': 'rate limit exceeded'}, {'Retry-After': '1'})
+            return
+        time.sleep(self.server.delay())
+        if status != 200:
+            self._send_json(status, {'error': 'injected failure'})
+            return
+        self._send_json(200, {'text': self.server.reply(prompt, request.get('response_schema'))})
+
+    def log_message(self, format, *args):
+        pass  # Keep load tests quiet
+
+
+def start_stub_server(config=None, host='127.0.0.1', port=0):
+    """
+    Starts a stub server on a background thread (port 0 picks a free port).
+    Stop it with server.shutdown() and server.server_close().
+
+    Returns:
+        StubServer: server.url is the endpoint to pass to HttpBackend
+    """
+    server = StubServer((host, port), config or StubConfig())
+    threading.Thread(target=server.serve_forever, args=(0.05,), name="llm-stub-server", daemon=True).start()
+    return server
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Local LLM stub server for offline load tests.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0.5, help="Mean seconds before a reply")
+    parser.add_argument('--jitter', type=float, default=0.0, help="Latency varies by up to this many seconds")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Share of requests failed with 503")
+    parser.add_argument('--rate-limit', type=float, default=0.0,
+                        help="Requests per second above which clients get 429 (0 = unlimited)")
+    parser.add_argument('--burst', type=int, default=1, help="Requests allowed at once before the rate limit")
+    parser.add_argument('--plagiarism-rate', type=float, default=0.5, help="Share of pairs judged plagiarized")
+    parser.add_argument('--drop-rate', type=float, default=0.0, help="Share of pairs left out of batched replies")
+    parser.add_argument('--seed', type=int, help="Seed of the error and drop draws")
+    args = parser.parse_args(argv)
+
+    config = StubConfig(args.latency, args.jitter, args.error_rate, args.rate_limit, args.burst,
+                        args.plagiarism_rate, args.drop_rate, args.seed)
+    server = StubServer((args.host, args.port), config)
+    print(f"LLM stub server listening on {server.url} (Ctrl-C to stop)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(f"Stats: {json.dumps(server.stats)}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
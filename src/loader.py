@@ -0,0 +1,149 @@
+"""
+File loading helpers.
+Each file is read from disk exactly once; encoding detection happens in memory.
+"""
+import hashlib
+import mmap
+import os
+
+from archives import split_archive_path, read_archive_member, iter_archive_members
+
+# Candidate encodings: UTF-8, then CP950 (Big5), then latin-1 which never fails
+ENCODINGS = ['utf-8', 'cp950', 'latin-1']
+
+# Files at least this large are mapped into memory instead of read
+MMAP_THRESHOLD = 4 * 1024 * 1024
+
+
+def read_file_bytes(file_path):
+    """
+    Reads the raw bytes of a file in a single read.
+    Paths inside a .zip/.tar.gz archive are read from the archive without extracting it.
+    """
+    member = split_archive_path(file_path)
+    if member:
+        return read_archive_member(*member)
+    with open(file_path, 'rb') as f:
+        return f.read()
+
+
+def read_files_bytes(file_paths):
+    """
+    Reads the raw bytes of several files, e.g. all of a student's files.
+    Members of the same archive are read in one pass over it (iter_archive_members)
+    rather than reopening and rescanning the archive for each member.
+
+    Returns:
+        dict: {path: bytes, or the OSError raised while reading it}
+    """
+    results = {}
+    archives = {}  # archive path -> {member name: virtual path}
+    for path in file_paths:
+        member = split_archive_path(path)
+        if member:
+            archives.setdefault(member[0], {})[member[1]] = path
+            continue
+        try:
+            with open(path, 'rb') as f:
+                results[path] = f.read()
+        except OSError as e:
+            results[path] = e
+
+    for archive_path, wanted in archives.items():
+        error = None
+        try:
+            for member, data in iter_archive_members(archive_path, wanted):
+                results[wanted[member]] = data
+        except OSError as e:
+            error = e
+        for member, path in wanted.items():
+            if path not in results:
+                results[path] = error or OSError(f"Cannot read {member} from {archive_path}: not found")
+    return results
+
+
+def hash_content(data):
+    """
+    Returns the content hash used to identify a file across runs.
+    """
+    return hashlib.sha256(data).hexdigest()
+
+
+def decode_content(data, preferred_encoding=None):
+    """
+    Decodes raw file content, trying the candidate encodings in memory.
+
+    UTF-8 is always tried first because a strict UTF-8 decode practically never
+    succeeds on Big5 bytes, while CP950 happily decodes UTF-8 into garbage.
+    The preferred encoding (e.g. the one detected for the student's other files)
+    is tried next, then the remaining candidates. A preferred latin-1 is ignored:
+    it never fails, so moving it ahead of CP950 would turn every later Big5
+    file of the student into mojibake.
+
+    Line endings are normalized to '\\n' as when reading in text mode.
+
+    Returns:
+        tuple: (text: str, encoding: str)
+    """
+    encodings = ENCODINGS
+    if preferred_encoding and preferred_encoding not in (encodings[0], encodings[-1]):
+        encodings = [encodings[0], preferred_encoding] + [enc for enc in encodings[1:] if enc != preferred_encoding]
+
+    for enc in encodings:
+        try:
+            text = str(data, enc)
+        except UnicodeDecodeError:
+            continue
+        if '\r' in text:
+            text = text.replace('\r\n', '\n').replace('\r', '\n')
+        return text, enc
+    return "", None
+
+
+def decode_file(file_path, preferred_encoding=None):
+    """
+    Reads a file (not an archive member) once, hashing and decoding it in memory.
+    Files of MMAP_THRESHOLD bytes or more are hashed and decoded straight from a
+    read-only memory map instead of being copied into a bytes object first.
+
+    Returns:
+        tuple: (text: str, content_hash: str, encoding: str, size: int)
+
+    Raises:
+        OSError: The file cannot be read
+    """
+    with open(file_path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size >= MMAP_THRESHOLD:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                text, encoding = decode_content(data, preferred_encoding)
+                return text, hash_content(data), encoding, size
+        data = f.read()
+    text, encoding = decode_content(data, preferred_encoding)
+    return text, hash_content(data), encoding, len(data)
+
+
+def load_text_file(file_path, preferred_encoding=None):
+    """
+    Reads a file once and decodes it in memory (see decode_file).
+    Archive members are read from the archive in memory.
+
+    Args:
+        file_path (str): Path to the file
+        preferred_encoding (str, optional): Encoding to try right after UTF-8
+
+    Returns:
+        tuple: (text: str, content_hash: str, encoding: str)
+               ("", None, None) if the file cannot be read
+    """
+    try:
+        member = split_archive_path(file_path)
+        if not member:
+            return decode_file(file_path, preferred_encoding)[:3]
+        data = read_archive_member(*member)
+    except (OSError, ValueError) as e:
+        print(f"Error reading {file_path}: {e}")
+        return "", None, None
+
+    text, encoding = decode_content(data, preferred_encoding)
+    return text, hash_content(data), encoding
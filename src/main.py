@@ -1,183 +1,103 @@
 import os
+import heapq
 import itertools
+from concurrent.futures import Future
 from tqdm import tqdm
-from preprocessor import crawl_directory, clean_code, normalize_hex, validate_source_code, check_hex_integrity
+from preprocessor import iter_student_files, check_hex_integrity
 from detector import calculate_combined_similarity, calculate_levenshtein_similarity
-from llm_analyzer import analyze_pair_with_llm
+from llm_analyzer import (LLMClient, AsyncLLMAnalyzer, open_llm_cache, llm_cache_key, is_llm_error,
+                          group_llm_batches, TokenBucket, BUDGET_SKIPPED, LLM_BURST)
+from llm_backends import HttpBackend
 from reporter import generate_html_report
-from c51_compiler import compile_and_extract_asm, find_keil_c51
+from ingest import ingest_students
+from records import PairResult
+from cache import DEFAULT_CACHE_DIR
+from allowlist import load_allowlist
+from manifest import default_manifest_path, student_fingerprint, load_manifest, reusable_scores, ManifestWriter
+from checkpoint import load_checkpoint, CheckpointWriter, CHECKPOINT_BATCH
 
 
-def read_file_with_encoding(file_path):
-    """
-    Try to read file with UTF-8, then CP950 (Big5).
-    """
-    encodings = ['utf-8', 'cp950', 'latin-1']
-    for enc in encodings:
-        try:
-            with open(file_path, 'r', encoding=enc) as f:
-                return f.read()
-        except UnicodeDecodeError:
-            continue
-        except Exception as e:
-            print(f"Error reading {file_path} with {enc}: {e}")
-            return ""
-    return ""
-
 def check_plagiarism(root_path, filter_mode="threshold", 
                     hex_threshold=0.7, src_threshold=0.8, 
                     top_metric="avg_score", top_percent=0.05,
-                    lab_name="Lab", use_keil_compilation=False, keil_path=None):
+                    lab_name="Lab", use_keil_compilation=False, keil_path=None,
+                    ingest_workers=None, cache_dir=DEFAULT_CACHE_DIR, guard_policy="cap",
+                    incremental=True, allowlist_path=None, checkpoint_path=None, resume=False,
+                    llm_workers=0, use_llm_cache=True, llm_batch_size=0, llm_url=None, llm_budget=None,
+                    debug_log=None, llm_rps=None, crawl_limits=None):
 
     """
     Main function to check plagiarism.
+    ingest_workers: processes used for Step 1 preprocessing (None = CPU count, 1 = serial)
+    cache_dir: directory of the on-disk preprocessing cache (None disables it)
+    guard_policy: handling of oversized source files: "cap", "sample" or "fingerprint"
+    incremental: keep a manifest in cache_dir and only rescore pairs involving changed students
+    allowlist_path: reference file allowlist built with `python src/allowlist.py` (None disables it)
+    checkpoint_path: JSONL file Step 2 scores are appended to while it runs (None disables it)
+    resume: reuse the scores in checkpoint_path left by an interrupted run
+    llm_workers: concurrent LLM requests sent in the background while pairs are still being
+    scored (0 calls the LLM inline, one at a time)
+    use_llm_cache: reuse LLM verdicts stored in cache_dir for unchanged code pairs
+    llm_batch_size: judge up to this many related pairs per LLM request (0 = one pair per request)
+    llm_url: send LLM requests to this HTTP/JSON endpoint (llm_backends.HttpBackend, e.g.
+    src/llm_stub_server.py) instead of Gemini
+    llm_budget: llm_analyzer.LLMBudget capping LLM requests, tokens or time; the most suspicious
+    pairs are sent first and the rest get the algorithmic fallback
+    debug_log: file the Step 1 files and illegal status of every student are appended to (None disables it)
+    llm_rps: LLM requests per second, inline or concurrent (None = llm_analyzer.LLM_REQUESTS_PER_SECOND)
+    crawl_limits: dict of preprocessor.iter_student_files limits, e.g. {'max_files': 200} (None = CRAWL_* defaults)
+
+    Runs all stages in one go; src/cli.py runs them one at a time with saved artifacts.
     """
-    print("Step 1: Crawling and preprocessing...")
-    student_files = crawl_directory(root_path)
-    student_data = {}
-
-    # Preprocess all data
-    for student, files in student_files.items():
-        student_data[student] = {
-            'source': "", 
-            'hex': "", 
-            'original_source': "", 
-            'asm_source': "",         # Compiled assembly or raw assembly
-            'illegal_submission': False, 
-            'illegal_reason': "",
-            'hex_anomalies': [],      # List of hex anomalies
-            'source_anomalies': [],   # List of source code anomalies
-            'has_anomaly': False,     # Flag for any anomaly
-            'hex_length': 0,          # Hex data length
-            'hex_info': {}            # Hex validation info
-        }
-        
-        # Check for illegal submission (no valid source files or no hex files)
-        # Determine valid extensions based on configuration
-        valid_extensions = ['.a51', '.asm', '.c']
-        # if use_keil_compilation:
-        #     valid_extensions.append('.c')
-            
-        has_valid_source = False
-        for src_file in files['source']:
-            ext = os.path.splitext(src_file)[1].lower()
-            if ext in valid_extensions:
-                has_valid_source = True
-                break
-                
-        if not has_valid_source:
-            student_data[student]['illegal_submission'] = True
-            if files['all_files']:
-                # Found files but not valid source
-                exts = set([os.path.splitext(f)[1] for f in files['all_files']])
-                student_data[student]['illegal_reason'] = f"無效提交：找到 {', '.join(exts)} 檔案，但需要 (C 或 A51) 檔案"
-            else:
-                student_data[student]['illegal_reason'] = "未找到任何檔案"
-        
-        # Combine all source files
-        full_source = ""
-        full_asm_source = ""  # For compiled assembly from C files
-        full_original_source = ""
-        
-        c_files_for_compilation = []  # Track C files to compile if needed
-        asm_files_content = []  # Track regular assembly files
-
-        for src_file in files['source']:
-            try:
-                content = read_file_with_encoding(src_file)
-                if not content:
-                    print(f"Warning: Could not read {src_file} or file is empty")
-                    continue
-                    
-                ext = os.path.splitext(src_file)[1].lower()  # Lowercase for case-insensitive comparison
-                
-                # Store original content with filename header for display
-                filename = os.path.basename(src_file)
-                full_original_source += f"--- {filename} ---\n{content}\n\n"  
-                
-                if ext in ['.c']:
-                    cleaned = clean_code(content, ext)
-                    full_source += cleaned + " "
-                    if use_keil_compilation:
-                        c_files_for_compilation.append(src_file)
-                elif ext in ['.a51', '.asm']:
-                    cleaned = clean_code(content, ext)
-                    full_source += cleaned + " "
-                    asm_files_content.append(content)
-                
-                # Validate source code quality
-                anomalies = validate_source_code(content, ext)
-                student_data[student]['source_anomalies'].extend(anomalies)
-            except Exception as e:
-                print(f"Error reading {src_file}: {e}")      
-
-        # If we need to compile C to assembly
-        if use_keil_compilation and c_files_for_compilation:
-            print(f"Compiling C files to assembly for student {student}...")
-            for c_file in c_files_for_compilation:
-                success, asm_code, error = compile_and_extract_asm(c_file, keil_path)
-                if success:
-                    full_asm_source += asm_code + " "
-                    # print(f"  Successfully compiled {c_file} to assembly")
-                else:
-                    print(f"  Failed to compile {c_file}: {error}")
+    student_data = run_ingest(root_path, use_keil_compilation, keil_path, ingest_workers=ingest_workers,
+                              cache_dir=cache_dir, guard_policy=guard_policy, allowlist_path=allowlist_path,
+                              debug_log=debug_log, crawl_limits=crawl_limits)
+    # Steps 2-4 are chained generators: pairs are scored, filtered and analyzed one at a time
+    comparisons = iter_pair_scores(student_data, use_keil_compilation, root_path=root_path,
+                                   cache_dir=cache_dir, incremental=incremental,
+                                   checkpoint_path=checkpoint_path, resume=resume)
+    filtered_pairs = filter_pairs(comparisons, filter_mode, hex_threshold, src_threshold, top_metric, top_percent,
+                                  total_pairs=pair_count(len(student_data)))
+    llm_cache = open_llm_cache(cache_dir) if use_llm_cache and cache_dir else None
+    try:
+        llm_client = LLMClient(backend=HttpBackend(llm_url)) if llm_url else None
+        results = analyze_pairs(filtered_pairs, student_data, llm_workers=llm_workers, llm_cache=llm_cache,
+                                llm_client=llm_client, llm_batch_size=llm_batch_size, llm_budget=llm_budget,
+                                llm_rps=llm_rps)
+    finally:
+        if llm_cache:
+            llm_cache.close()
+    illegal_students, anomaly_students, excluded_students = collect_student_lists(student_data)
 
-        # Add regular assembly files to asm_source as well
-        for asm_content in asm_files_content:
-            full_asm_source += clean_code(asm_content, '.a51') + " "
+    # Generate Report
+    generate_html_report(results, hex_threshold, src_threshold, illegal_students, anomaly_students, lab_name,
+                        filter_mode=filter_mode, top_metric=top_metric, top_percent=top_percent,
+                        use_keil_compilation=use_keil_compilation, excluded_students=excluded_students,
+                        students=student_data)
+    
+    return results
 
-        student_data[student]['source'] = full_source.strip()
-        student_data[student]['asm_source'] = full_asm_source.strip()
-        student_data[student]['original_source'] = full_original_source.strip()
-        
-        # Combine all hex files and collect validation info
-        full_hex = ""
-        all_hex_info = {
-            'has_eof': False,
-            'format_errors': [],
-            'valid_lines': 0,
-            'data_length': 0
-        }
-        
-        for hex_file in files['hex']:
-            try:
-                content = read_file_with_encoding(hex_file)
-                if not content:
-                    continue
-                    
-                hex_data, hex_info = normalize_hex(content)
-                full_hex += hex_data
-                
-                # Aggregate hex info
-                if hex_info['has_eof']:
-                    all_hex_info['has_eof'] = True
-                all_hex_info['format_errors'].extend(hex_info['format_errors'])
-                all_hex_info['valid_lines'] += hex_info['valid_lines']
-
-            except Exception as e:
-                print(f"Error reading {hex_file}: {e}")
-
-        student_data[student]['hex'] = full_hex
-        student_data[student]['hex_length'] = len(full_hex)
-        all_hex_info['data_length'] = len(full_hex)
-        student_data[student]['hex_info'] = all_hex_info
-        
 
-        # Check if hex is empty (illegal submission - not anomaly)
-        if not full_hex or full_hex.strip() == "":
-            student_data[student]['illegal_submission'] = True
-            if student_data[student]['illegal_reason']:
-                student_data[student]['illegal_reason'] += " | 未找到有效的 hex 檔案"
-            else:
-                student_data[student]['illegal_reason'] = "無效提交：未找到有效的 hex 檔案"
-        
-        with open('debug.log', 'a', encoding='utf-8') as f:
-            f.write(f"DEBUG: Student {student} - Illegal: {student_data[student]['illegal_submission']}, Reason: {student_data[student]['illegal_reason']}\n")
-            f.write(f"DEBUG: Files: {files}\n")
-        
-    
+def run_ingest(root_path, use_keil_compilation=False, keil_path=None, ingest_workers=None,
+               cache_dir=DEFAULT_CACHE_DIR, guard_policy="cap", allowlist_path=None, debug_log=None,
+               crawl_limits=None):
+    """
+    Step 1: crawls root_path, preprocesses every student and flags hex/source anomalies.
+    crawl_limits: keyword arguments of preprocessor.iter_student_files (ignore, max_depth,
+    max_file_bytes, max_files) replacing the CRAWL_* defaults
+
+    Returns: dict student -> Student
+    """
+    print("Step 1: Crawling and preprocessing...")
+    # Students are crawled lazily, so preprocessing starts with the first student found
+    student_files = iter_student_files(root_path, **(crawl_limits or {}))
+    allowlist = load_allowlist(allowlist_path) if allowlist_path else None
+    student_data, _ = ingest_students(student_files, use_keil_compilation, keil_path,
+                                      workers=ingest_workers, cache_dir=cache_dir,
+                                      guard_policy=guard_policy, allowlist=allowlist, debug_log=debug_log)
+
     # Find median hex length across all students (excluding empty ones)
-    hex_lengths = [data['hex_length'] for data in student_data.values() if data['hex_length'] > 0]
+    hex_lengths = [data.hex_length for data in student_data.values() if data.hex_length > 0]
     median_hex_length = 0
     
     if hex_lengths:
@@ -190,196 +110,358 @@ def check_plagiarism(root_path, filter_mode="threshold",
     
     # Check hex integrity for all students (as anomalies, not illegal submissions)
     for student, data in student_data.items():
-        if data['hex_length'] > 0:
+        if data.hex_length > 0:
             hex_anomalies = check_hex_integrity(
-                data['hex_info'], 
-                data['hex_length'], 
+                data.hex_info, 
+                data.hex_length, 
                 median_hex_length
             )
-            student_data[student]['hex_anomalies'].extend(hex_anomalies)
+            student_data[student].hex_anomalies.extend(hex_anomalies)
     
     # Mark students with anomalies
     for student, data in student_data.items():
-        if data['hex_anomalies'] or data['source_anomalies']:
-            student_data[student]['has_anomaly'] = True
-        
+        if data.hex_anomalies or data.source_anomalies:
+            student_data[student].has_anomaly = True
+
+    return student_data
+
+
+def pair_count(n_students):
+    return n_students * (n_students - 1) // 2
+
+
+def score_pairs(student_data, use_keil_compilation=False, **kwargs):
+    """
+    Step 2: scores every pair of students (see iter_pair_scores for the options).
+
+    Returns: list of PairResult (scores only) in pair order
+    """
+    return list(iter_pair_scores(student_data, use_keil_compilation, **kwargs))
+
+
+def iter_pair_scores(student_data, use_keil_compilation=False, root_path=None, cache_dir=DEFAULT_CACHE_DIR,
+                     incremental=True, checkpoint_path=None, resume=False, checkpoint_batch=CHECKPOINT_BATCH,
+                     fsync='batch'):
+    """
+    Step 2 as a generator: scores every pair of students, yielding each PairResult as soon as it is scored.
+    root_path names the incremental manifest; without it every pair is rescored.
+    checkpoint_path: newly scored pairs are appended there in batches of checkpoint_batch,
+    forced to disk per fsync policy (see checkpoint.FSYNC_POLICIES); deleted once all pairs are scored
+    resume: reuse the scores of an interrupted run found in checkpoint_path
 
+    Yields: PairResult (scores only) in pair order
+    """
     print("Step 2: Calculating similarities...")
     students = list(student_data.keys())
-    pairs = list(itertools.combinations(students, 2))
+    total_pairs = pair_count(len(students))
+    pairs = itertools.combinations(students, 2)
+    src_key = 'asm_source' if use_keil_compilation else 'source'
 
-    all_comparisons = []
+    # Incremental run: reuse scores of pairs whose students did not change
+    manifest_path = default_manifest_path(cache_dir, root_path) if incremental and cache_dir and root_path else None
+    fingerprints = {student: student_fingerprint(getattr(data, src_key), data.hex)
+                    for student, data in student_data.items()}
+    previous_scores, changed = reusable_scores(load_manifest(manifest_path) if manifest_path else None,
+                                               fingerprints)
+    if manifest_path:
+        print(f"Incremental run: {len(changed)} of {len(students)} students changed, "
+              f"reusing {len(previous_scores)} of {total_pairs} pair scores")
 
-    for student1, student2 in tqdm(pairs, desc="Calculating pairs", unit="pair"):
-        # Source comparison
-        if use_keil_compilation:
-            src1 = student_data[student1]['asm_source']
-            src2 = student_data[student2]['asm_source']
-        else:
-            src1 = student_data[student1]['source']
-            src2 = student_data[student2]['source']
-            
-        src_sim = {'token_seq': 0, 'levenshtein': 0}
-
-        if src1 and src2:
-            src_sim = calculate_combined_similarity(src1, src2)
-
-        # Hex comparison - only use Levenshtein
-        hex1 = student_data[student1]['hex']
-        hex2 = student_data[student2]['hex']
-        hex_lev = 0
-        if hex1 and hex2:
-            hex_lev = calculate_levenshtein_similarity(hex1, hex2)
-   
-        # Calculate scores
-        max_hex_sim = hex_lev
-        avg_score = (src_sim['token_seq'] + src_sim['levenshtein']) / 2.0
-        
-        # Store all data for filtering
-        all_comparisons.append({
-            'student1': student1,
-            'student2': student2,
-            'source_similarity': src_sim,
-            'hex_levenshtein': hex_lev,
-            'max_hex_sim': max_hex_sim,
-            'avg_score': avg_score
-        })
-
-    print(f"Step 3: Filtering pairs (Mode: {filter_mode})...")
+    # Crash safety: resume from the checkpoint of an interrupted run, then append as we go
+    checkpoint_scores = load_checkpoint(checkpoint_path, fingerprints) if checkpoint_path and resume else {}
+    if checkpoint_path and resume:
+        print(f"Resuming: {len(checkpoint_scores)} pair scores restored from {checkpoint_path}")
+    previous_scores.update(checkpoint_scores)
+    checkpoint = CheckpointWriter(checkpoint_path, fingerprints, checkpoint_scores, batch_size=checkpoint_batch,
+                                  fsync=fsync) if checkpoint_path else None
+    # Every score goes straight to the new manifest, so memory does not grow with the pair count
+    manifest = ManifestWriter(manifest_path, fingerprints) if manifest_path else None
+
+    try:
+        for student1, student2 in tqdm(pairs, total=total_pairs, desc="Calculating pairs", unit="pair"):
+            scores = previous_scores.get((student1, student2))
+            if scores is not None:
+                src_sim = {'token_seq': scores[0], 'levenshtein': scores[1]}
+                hex_lev = scores[2]
+            else:
+                # Source comparison
+                src1 = getattr(student_data[student1], src_key)
+                src2 = getattr(student_data[student2], src_key)
+
+                src_sim = {'token_seq': 0, 'levenshtein': 0}
+
+                if src1 and src2:
+                    src_sim = calculate_combined_similarity(src1, src2)
+
+                # Hex comparison - only use Levenshtein
+                hex1 = student_data[student1].hex
+                hex2 = student_data[student2].hex
+                hex_lev = 0
+                if hex1 and hex2:
+                    hex_lev = calculate_levenshtein_similarity(hex1, hex2)
+                if checkpoint:
+                    checkpoint.add(student1, student2, (src_sim['token_seq'], src_sim['levenshtein'], hex_lev))
+            if manifest:
+                manifest.add(student1, student2, (src_sim['token_seq'], src_sim['levenshtein'], hex_lev))
+
+            # Calculate scores
+            max_hex_sim = hex_lev
+            avg_score = (src_sim['token_seq'] + src_sim['levenshtein']) / 2.0
+
+            yield PairResult(student1, student2, src_sim, hex_lev, max_hex_sim, avg_score)
+        if manifest:
+            manifest.commit()
+    finally:
+        if checkpoint:
+            checkpoint.close()
+        if manifest:
+            manifest.close()
+
+    if checkpoint:
+        checkpoint.remove()
+
+
+def filter_pairs(comparisons, filter_mode="threshold", hex_threshold=0.7, src_threshold=0.8,
+                 top_metric="avg_score", top_percent=0.05, total_pairs=None):
+    """
+    Step 3: selects the suspicious pairs passed on to Step 4.
+    comparisons may be a list or a generator such as iter_pair_scores; total_pairs
+    is needed for top_percent mode when it has no len().
+
+    Returns: a generator in threshold mode (pairs pass through as they are scored),
+    otherwise a list
+    """
+    if filter_mode == "top_percent" and total_pairs is None:
+        total_pairs = len(comparisons)
+    comparisons = _started(comparisons)
+    tqdm.write(f"Step 3: Filtering pairs (Mode: {filter_mode})...")
     filtered_pairs = []
 
     if filter_mode == "threshold":
         # Filter by threshold
         # Mode 1: Check if Average Score > SRC_THRESHOLD OR Hex > HEX_THRESHOLD
-        for comp in all_comparisons:
-            if comp['max_hex_sim'] > hex_threshold or comp['avg_score'] > src_threshold:
-                filtered_pairs.append(comp)
+        return (comp for comp in comparisons
+                if comp.max_hex_sim > hex_threshold or comp.avg_score > src_threshold)
                 
     elif filter_mode == "top_percent":
         # Sort and take top N%
-        total_pairs = len(all_comparisons)
         top_n = int(total_pairs * top_percent)
         if top_n < 1: top_n = 1
         
         # Determine sort key
         def get_sort_key(comp):
             if top_metric == "avg_score":
-                return comp['avg_score'] # Average of 2 source metrics
+                return comp.avg_score # Average of 2 source metrics
             elif top_metric == "levenshtein":
-                return comp['source_similarity']['levenshtein'] # Ignore Hex levenshtein
-            elif top_metric in comp['source_similarity']:
-                return comp['source_similarity'][top_metric]
+                return comp.source_similarity['levenshtein'] # Ignore Hex levenshtein
+            elif top_metric in comp.source_similarity:
+                return comp.source_similarity[top_metric]
             else:
-                return comp['avg_score'] # Fallback
+                return comp.avg_score # Fallback
         
-        all_comparisons.sort(key=get_sort_key, reverse=True)
-        filtered_pairs = all_comparisons[:top_n]
+        # Bounded heap of top_n pairs; gives the same pairs in the same order as a
+        # stable sort by key, descending, followed by [:top_n]
+        filtered_pairs = heapq.nlargest(top_n, comparisons, key=get_sort_key)
         print(f"Selected top {top_n} pairs ({top_percent*100}%) based on {top_metric}")
 
-    
-    print(f"Step 4: Analyzing {len(filtered_pairs)} suspicious pairs...")
-    results = []
-    
-    for comp in tqdm(filtered_pairs, desc="Analyzing pairs", unit="pair"):
-        student1 = comp['student1']
-        student2 = comp['student2']
-        
-        llm_result = None
-        llm_triggered = False
-        verdict = "未抄襲"
-        verdict_reason = ""
-        
-        # Rule 1: Hex max score = 1.0 OR Source avg score = 1.0 → Definite plagiarism, skip LLM
-        if comp['max_hex_sim'] == 1.0 or comp['avg_score'] == 1.0:
-            verdict = "抄襲"
-            verdict_reason = "Hex檔案或原始碼完全相同 (100%)"
-            llm_triggered = False
+    return filtered_pairs
 
-        # Rule 2: Trigger LLM for ALL suspicious pairs (except definite plagiarism)
-        else:
-            llm_triggered = True
+
+def _started(items):
+    """
+    Returns an iterator over items whose first item has already been produced.
+    For a generator (e.g. iter_pair_scores) this runs the stage producing it up to
+    its first result, so its banner is printed before the next stage's banner.
+    """
+    items = iter(items)
+    return itertools.chain(list(itertools.islice(items, 1)), items)
+
+
+def analyze_pairs(filtered_pairs, student_data, llm_workers=0, llm_cache=None, llm_client=None, llm_batch_size=0,
+                  llm_budget=None, llm_rps=None):
+    """
+    Step 4: applies the verdict rules (LLM where needed) to the filtered pairs.
+    llm_workers: 0 calls the LLM inline; N > 0 sends up to N concurrent, rate-limited
+    requests from a background event loop (llm_analyzer.AsyncLLMAnalyzer), so in threshold
+    mode Step 2 keeps scoring while requests are in flight.
+    Verdicts and their order are the same either way.
+    llm_cache: DiskCache from llm_analyzer.open_llm_cache; verdicts found there are not
+    requested again, and new verdicts (not errors) are stored
+    llm_client: llm_analyzer.LLMClient shared by all requests (created if not given); once
+    its circuit breaker opens, the remaining pairs get the algorithmic fallback
+    llm_batch_size: N > 0 packs up to N pairs, grouped by shared students, into one request
+    (llm_analyzer.group_llm_batches); requests are then sent once all pairs are filtered
+    llm_budget: llm_analyzer.LLMBudget; requests are then sent once all pairs are filtered, most
+    suspicious first (llm_priority), until the budget is used up
+    llm_rps: replaces the client's rate limit (requests per second, shared by inline and
+    concurrent requests)
+
+    Returns: PairResult list with verdicts, sorted by average score, highest first
+    """
+    if isinstance(filtered_pairs, list):
+        print(f"Step 4: Analyzing {len(filtered_pairs)} suspicious pairs...")
+    else:
+        filtered_pairs = _started(filtered_pairs)
+        tqdm.write("Step 4: Analyzing suspicious pairs as they are found...")
+    client = llm_client or LLMClient()
+    if llm_budget:
+        client.budget = llm_budget
+    if llm_rps:
+        client.limiter = TokenBucket(llm_rps, max(LLM_BURST, llm_workers))
+    deferred = bool(llm_batch_size or llm_budget)
+    pool = AsyncLLMAnalyzer(client, concurrency=llm_workers) if llm_workers else None
+    # Verdicts from batched requests are cached apart from single-pair ones
+    prompt_kind = 'batch' if llm_batch_size > 1 else None
+    requested = False
+    analyses = []  # (comp, llm_triggered, LLM result or its Future, cache key of a new request)
+    deferred_pairs = []  # (index into analyses, src1, src2) of requests sent after filtering
+
+    try:
+        for comp in tqdm(filtered_pairs, desc="Analyzing pairs", unit="pair"):
+            # Rule 1: Hex max score = 1.0 OR Source avg score = 1.0 → Definite plagiarism, skip LLM
+            if comp.max_hex_sim == 1.0 or comp.avg_score == 1.0:
+                analyses.append((comp, False, None, None))
+                continue
+
+            # Rule 2: Trigger LLM for ALL suspicious pairs (except definite plagiarism)
             # Need to retrieve source code again
-            src1 = student_data[student1]['source']
-            src2 = student_data[student2]['source']
-            
-            llm_result = analyze_pair_with_llm(src1, src2)
-            
-            # Rule 3: Use LLM result if available
-            if llm_result and 'is_plagiarized' in llm_result:
-                verdict = "抄襲" if llm_result['is_plagiarized'] else "未抄襲"
-                verdict_reason = f"LLM分析: {llm_result.get('reasoning', 'N/A')}"
+            src1 = student_data[comp.student1].source
+            src2 = student_data[comp.student2].source
+            cache_key = llm_cache_key(src1, src2, model=client.model_name, token_budget=client.token_budget,
+                                      kind=prompt_kind) if llm_cache else None
+            cached = llm_cache.get(cache_key) if llm_cache else None
+            if cached is not None:
+                analyses.append((comp, True, cached, None))
+                continue
+            requested = True
+            if deferred:
+                deferred_pairs.append((len(analyses), src1, src2))
+                analyses.append((comp, True, None, cache_key))
+            elif pool:
+                analyses.append((comp, True, pool.submit(src1, src2), cache_key))
             else:
-                # LLM unavailable, fallback to algorithm
-                verdict = "抄襲" if comp['avg_score'] > 0.85 else "未抄襲"
-                verdict_reason = f"LLM分析不可用 - 演算法分析: Hex={comp['max_hex_sim']:.2f}, Source Avg={comp['avg_score']:.2f}"
-        
-        
-        # Check for illegal submission - but only override if NOT plagiarized
-        if (student_data[student1]['illegal_submission'] or student_data[student2]['illegal_submission']) and verdict != "抄襲":
-            verdict = "無效提交"
-            illegal_names = []
-            if student_data[student1]['illegal_submission']:
-                illegal_names.append(student1)
-            if student_data[student2]['illegal_submission']:
-                illegal_names.append(student2)
-            verdict_reason = f"無效提交: {', '.join(illegal_names)}"
-        
-        # Merge comparison data with analysis results
-        result_entry = comp.copy()
-        result_entry.update({
-            'llm_analysis': llm_result,
-            'llm_triggered': llm_triggered,
-            'final_verdict': verdict,
-            'verdict_reason': verdict_reason,
-            'source_code1': student_data[student1]['source'],
-            'source_code2': student_data[student2]['source'],
-            'original_source1': student_data[student1]['original_source'],
-            'original_source2': student_data[student2]['original_source'],
-            'illegal_submission1': student_data[student1]['illegal_submission'],
-            'illegal_reason1': student_data[student1]['illegal_reason'],
-            'illegal_submission2': student_data[student2]['illegal_submission'],
-            'illegal_reason2': student_data[student2]['illegal_reason'],
-            'illegal_reason2': student_data[student2]['illegal_reason'],
-            'hex_code1': student_data[student1]['hex'],
-            'hex_code2': student_data[student2]['hex'],
-            'asm_source1': student_data[student1]['asm_source'],
-            'asm_source2': student_data[student2]['asm_source']
-        })
-        
-        results.append(result_entry)
-            
+                analyses.append((comp, True, client.analyze(src1, src2), cache_key))
+
+        if deferred_pairs:
+            if llm_budget:
+                deferred_pairs.sort(key=lambda pair: llm_priority(analyses[pair[0]][0]), reverse=True)
+            pairs = [(src1, src2) for _, src1, src2 in deferred_pairs]
+            batches = group_llm_batches(pairs, llm_batch_size, client.token_budget) if llm_batch_size \
+                else [[i] for i in range(len(pairs))]
+            for batch in batches:
+                batch_pairs = [pairs[i] for i in batch]
+                if len(batch) > 1:
+                    batch_results = pool.submit_batch(batch_pairs) if pool else client.analyze_batch(batch_pairs)
+                else:
+                    batch_results = [pool.submit(*batch_pairs[0]) if pool else client.analyze(*batch_pairs[0])]
+                for i, llm_result in zip(batch, batch_results):
+                    index = deferred_pairs[i][0]
+                    comp, llm_triggered, _, cache_key = analyses[index]
+                    analyses[index] = (comp, llm_triggered, llm_result, cache_key)
+
+        results = []
+        for comp, llm_triggered, llm_result, cache_key in analyses:
+            if isinstance(llm_result, Future):
+                llm_result = llm_result.result()
+            # Errors and unparsable replies are not cached, so the next run retries them
+            if cache_key and not is_llm_error(llm_result):
+                llm_cache.put(cache_key, llm_result)
+            results.append(_pair_verdict(comp, llm_triggered, llm_result, student_data))
+    finally:
+        if pool:
+            pool.close()
+
+    if requested:
+        print(f"LLM requests: {client.summary()}")
+    if llm_cache:
+        print(f"LLM verdict cache: {llm_cache.summary()}")
+
+    # Sort by average score descending
+    results.sort(key=lambda x: x.avg_score, reverse=True)
+    return results
+
+
+def llm_priority(comp):
+    """
+    Suspicion of a pair, highest first when an LLM budget limits which pairs are sent:
+    the larger of its hex and source scores, ties broken by the source score.
+    """
+    return (max(comp.avg_score, comp.max_hex_sim), comp.avg_score)
+
+
+def _pair_verdict(comp, llm_triggered, llm_result, student_data):
+    """
+    Final verdict of one pair from its scores and LLM result.
+    """
+    student1 = comp.student1
+    student2 = comp.student2
+
+    if not llm_triggered:
+        verdict = "抄襲"
+        verdict_reason = "Hex檔案或原始碼完全相同 (100%)"
+
+    # Rule 3: Use LLM result if available
+    elif not is_llm_error(llm_result):
+        verdict = "抄襲" if llm_result['is_plagiarized'] else "未抄襲"
+        verdict_reason = f"LLM分析: {llm_result.get('reasoning', 'N/A')}"
+    else:
+        # LLM unavailable, failed or over budget, fallback to algorithm
+        verdict = "抄襲" if comp.avg_score > 0.85 else "未抄襲"
+        status = "LLM預算已用完" if llm_result == BUDGET_SKIPPED else "LLM分析不可用"
+        verdict_reason = f"{status} - 演算法分析: Hex={comp.max_hex_sim:.2f}, Source Avg={comp.avg_score:.2f}"
+    
+    
+    # Check for illegal submission - but only override if NOT plagiarized
+    if (student_data[student1].illegal_submission or student_data[student2].illegal_submission) and verdict != "抄襲":
+        verdict = "無效提交"
+        illegal_names = []
+        if student_data[student1].illegal_submission:
+            illegal_names.append(student1)
+        if student_data[student2].illegal_submission:
+            illegal_names.append(student2)
+        verdict_reason = f"無效提交: {', '.join(illegal_names)}"
+    
+    # Pairs refer to students by id; the reporter looks their code up in student_data
+    return PairResult(student1, student2, comp.source_similarity, comp.hex_levenshtein,
+                      comp.max_hex_sim, comp.avg_score, llm_analysis=llm_result,
+                      llm_triggered=llm_triggered, final_verdict=verdict, verdict_reason=verdict_reason)
 
+
+def collect_student_lists(student_data):
+    """
+    Returns: (illegal_students, anomaly_students, excluded_students) for the report
+    """
     # Identify illegal students
     illegal_students = []
     for student, data in student_data.items():
-        if data['illegal_submission']:
+        if data.illegal_submission:
             illegal_students.append({
                 'student': student,
-                'reason': data['illegal_reason'],
-                'files': data.get('all_files', [])
+                'reason': data.illegal_reason
             })
     
     # Identify students with anomalies (but not illegal)
     anomaly_students = []
     for student, data in student_data.items():
-        if data['has_anomaly'] and not data['illegal_submission']:
+        if data.has_anomaly and not data.illegal_submission:
             anomaly_students.append({
                 'student': student,
-                'hex_anomalies': data['hex_anomalies'],
-                'source_anomalies': data['source_anomalies'],
-                'original_source': data['original_source'],
-                'hex': data['hex']
+                'hex_anomalies': data.hex_anomalies,
+                'source_anomalies': data.source_anomalies,
+                'original_source': data.original_source,
+                'hex': data.hex
             })
 
-    # Sort by average score descending
-    results.sort(key=lambda x: x['avg_score'], reverse=True)
-    
-    # Generate Report
-    generate_html_report(results, hex_threshold, src_threshold, illegal_students, anomaly_students, lab_name,
-                        filter_mode=filter_mode, top_metric=top_metric, top_percent=top_percent,
-                        use_keil_compilation=use_keil_compilation)
-    
-    return results
+    # Students whose reference files (e.g. STARTUP.A51) were left out of the comparison
+    excluded_students = []
+    for student, data in student_data.items():
+        if data.excluded_files:
+            excluded_students.append({
+                'student': student,
+                'files': data.excluded_files
+            })
+
+    return illegal_students, anomaly_students, excluded_students
 
 
 if __name__ == "__main__":
@@ -402,6 +484,7 @@ if __name__ == "__main__":
     # C51 Compilation Configuration
     USE_KEIL_COMPILATION = False  # Set to True to enable C compilation
     KEIL_PATH = None              # Set path if not in default locations
+    DEBUG_LOG = "debug.log"       # Per-student Step 1 details (None to disable)
     # ---------------------
 
     repo_root = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
@@ -417,7 +500,8 @@ if __name__ == "__main__":
         top_percent=TOP_PERCENT,
         lab_name=LAB_NAME,
         use_keil_compilation=USE_KEIL_COMPILATION,
-        keil_path=KEIL_PATH
+        keil_path=KEIL_PATH,
+        debug_log=DEBUG_LOG
     )
     
 
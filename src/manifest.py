@@ -0,0 +1,141 @@
+"""
+Submission manifest for incremental runs.
+
+The manifest records a fingerprint of every student's Step 2 inputs (compared
+source and hex) together with the pair scores of the previous run. On a rerun,
+pairs whose two students are unchanged reuse their stored scores, so only pairs
+involving changed students are rescored.
+"""
+import hashlib
+import json
+import os
+
+# Bump whenever the similarity computation in detector.py changes,
+# so scores from older runs are not reused
+SCORING_VERSION = 1
+
+# Manifests are stored in this subdirectory of the cache directory
+MANIFEST_DIRNAME = 'manifests'
+
+
+def default_manifest_path(cache_dir, root_path):
+    """
+    Returns the manifest file for an assignment directory inside cache_dir.
+    """
+    root_path = os.path.abspath(root_path)
+    digest = hashlib.sha1(root_path.encode('utf-8')).hexdigest()[:12]
+    return os.path.join(cache_dir, MANIFEST_DIRNAME, f"{os.path.basename(root_path)}-{digest}.json")
+
+
+def student_fingerprint(source, hex_data):
+    """
+    Hash of everything a pair score depends on for one student.
+    """
+    h = hashlib.sha256()
+    h.update(source.encode('utf-8'))
+    h.update(b'\0')
+    h.update(hex_data.encode('ascii'))
+    return h.hexdigest()
+
+
+def _pair_key(student1, student2):
+    return f"{student1}\t{student2}"
+
+
+def load_manifest(path):
+    """
+    Loads a manifest; returns None if it is missing, unreadable or from another SCORING_VERSION.
+    """
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if manifest.get('version') != SCORING_VERSION:
+        return None
+    return manifest
+
+
+def reusable_scores(manifest, fingerprints):
+    """
+    Selects the stored pair scores that are still valid.
+
+    Args:
+        manifest (dict): As returned by load_manifest (may be None)
+        fingerprints (dict): student -> student_fingerprint of the current run
+
+    Returns:
+        tuple: (scores: dict (student1, student2) -> (token_seq, levenshtein, hex_levenshtein),
+                changed: set of students that are new or changed)
+    """
+    previous = manifest['students'] if manifest else {}
+    changed = {student for student, fp in fingerprints.items() if previous.get(student) != fp}
+    scores = {}
+    if manifest:
+        for key, value in manifest['pairs'].items():
+            student1, student2 = key.split('\t')
+            if student1 in fingerprints and student2 in fingerprints \
+                    and student1 not in changed and student2 not in changed:
+                scores[(student1, student2)] = tuple(value)
+    return scores, changed
+
+
+def save_manifest(path, fingerprints, scores):
+    """
+    Writes the manifest of the current run (atomically, so an interrupted run
+    leaves the previous manifest intact).
+
+    Args:
+        fingerprints (dict): student -> student_fingerprint
+        scores (dict): (student1, student2) -> (token_seq, levenshtein, hex_levenshtein)
+    """
+    with ManifestWriter(path, fingerprints) as writer:
+        for (student1, student2), value in scores.items():
+            writer.add(student1, student2, value)
+        writer.commit()
+
+
+class ManifestWriter:
+    """
+    Streams the manifest of the current run to a temporary file as pairs are scored,
+    so Step 2 does not keep every pair score in memory. commit() replaces the
+    previous manifest; closing without it (an interrupted run) leaves it intact.
+
+    Args:
+        path (str): Manifest file; parent directories are created
+        fingerprints (dict): student -> student_fingerprint of the current run
+    """
+
+    def __init__(self, path, fingerprints):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self._tmp_path = path + '.tmp'
+        self._file = open(self._tmp_path, 'w', encoding='utf-8')
+        self._file.write('{"version": %d, "students": %s, "pairs": {'
+                         % (SCORING_VERSION, json.dumps(fingerprints, ensure_ascii=False)))
+        self._separator = ''
+
+    def add(self, student1, student2, scores):
+        self._file.write(f'{self._separator}{json.dumps(_pair_key(student1, student2), ensure_ascii=False)}: '
+                         f'{json.dumps(list(scores))}')
+        self._separator = ', '
+
+    def commit(self):
+        self._file.write('}}')
+        self._file.close()
+        os.replace(self._tmp_path, self.path)
+
+    def close(self):
+        """
+        Discards the manifest unless it was committed.
+        """
+        if self._file.closed:
+            return
+        self._file.close()
+        os.remove(self._tmp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
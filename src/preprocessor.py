@@ -1,148 +1,420 @@
 """Preprocessor utilities (moved to src root)."""
+import binascii
+import bisect
+import fnmatch
+import itertools
 import os
 import re
+import sys
+import tarfile
+import zipfile
+from array import array
 
-def crawl_directory(root_path):
+from archives import is_archive, strip_archive_extension, list_archive_members
+
+# Bump whenever clean_code, normalize_hex or validate_source_code output changes,
+# so cached preprocessing results from older versions are not reused
+PREPROCESSOR_VERSION = 3
+
+# Assembly lexemes: a newline, a `;` comment up to the end of the line, or a word.
+# Quoted literals are lexed as part of the word so that a `;` inside
+# `DB 'a;b'` is not mistaken for the start of a comment.
+_ASM_LEXEME_RE = re.compile(r"""(?P<newline>\n)|(?P<comment>;[^\n]*)|(?P<word>(?:[^\s;'"]+|'[^'\n]*'|"[^"\n]*"|['"])+)""")
+# Line breaks of str.splitlines() other than \n, which the lexer treats as whitespace
+_ASM_OTHER_LINE_BREAK_RE = re.compile('[\r\x0b\x0c\x1c\x1d\x1e\x85\u2028\u2029]')
+_NON_SPACE_RE = re.compile(r'\S+')
+# Key assembly instructions to look for
+_ASM_KEY_INSTRUCTIONS = frozenset(['org', 'end', 'mov', 'jmp', 'call', 'ret'])
+# Hex immediates: 0x?? -> ??h, but not when already followed by h or another word character
+_ASM_HEX_PREFIX_RE = re.compile(r'\b0x([0-9a-f]+)(?!\w)')
+# Leading zeros of hex values ending in h
+_ASM_LEADING_ZERO_RE = re.compile(r'\b0+([0-9a-f]+h)')
+
+# C lexemes.  Line splices (backslash-newline) are matched first so they are
+# honoured everywhere, including inside comments and string literals.  A word
+# runs to the next character that may start another lexeme, so it can include
+# inner whitespace.
+_C_LEXEME_RE = re.compile(r"""
+    (?P<splice>\\\s*\n)
+  | (?P<newline>\n)
+  | (?P<space>[^\S\n]+)
+  | (?P<block>/\*.*?\*/)
+  | (?P<line>//(?:\\\s*\n|[^\n])*)
+  | (?P<literal>"(?:\\.|[^"\\\n])*"|'(?:\\.|[^'\\\n])*')
+  | (?P<word>[^\s/"'\\\#][^\n/"'\\]*)
+  | (?P<char>.)
+""", re.VERBOSE | re.DOTALL)
+_C_SPLICE_RE = re.compile(r'\\\s*\n')
+_C_DIRECTIVE_NAME_RE = re.compile(r'\w+')
+_C_LEADING_ZERO_RE = re.compile(r'\b0+([0-9a-f]+)')
+_NEWLINE_RE = re.compile('\n')
+# preprocess_c_code states
+_C_TEXT, _C_HASH, _C_DIRECTIVE = range(3)
+
+# Names skipped while crawling: OS metadata, version control and Keil build output.
+# Keil's Objects/ folder is not pruned as a whole because uVision writes the .hex
+# there by default; its intermediate files are skipped by extension instead.
+CRAWL_IGNORE = ('__MACOSX', '.DS_Store', 'Thumbs.db', '.git', '.svn', 'Listings',
+                '*.obj', '*.lnp', '*.__i', '*._ia', '*.lst', '*.m51', '*.plg', '*.build_log.htm')
+# Deepest directory level entered below a student folder
+CRAWL_MAX_DEPTH = 8
+# Source, hex and archive files larger than this are skipped
+CRAWL_MAX_FILE_BYTES = 64 * 1024 * 1024
+# Files collected per student before the rest of the submission is skipped
+CRAWL_MAX_FILES = 1000
+
+# Input guards, so one pathological upload (e.g. a 40 MB listing) cannot stall a run.
+# Decoded source files longer than this are reduced according to the guard policy:
+#   'cap'         keep the beginning of the file
+#   'sample'      keep GUARD_SAMPLE_CHUNKS evenly spaced excerpts
+#   'fingerprint' keep only the content hash; the file is left out of the comparison
+GUARD_POLICIES = ('cap', 'sample', 'fingerprint')
+GUARD_POLICY = 'cap'
+GUARD_MAX_SOURCE_CHARS = 256 * 1024
+GUARD_SAMPLE_CHUNKS = 8
+# Cleaned source tokens compared per student in Step 2 (token LCS is O(m*n))
+GUARD_MAX_STUDENT_TOKENS = 5000
+
+def crawl_directory(root_path, **limits):
     """
     Recursively finds relevant files (.a51, .hex) in the directory.
     Returns a dictionary where keys are student IDs (folder names) and values are lists of file paths.
     Also tracks 'all_files' to help identify illegal submissions.
     Only .a51 files are considered valid source code.
+
+    Eager wrapper around iter_student_files; keyword arguments are passed through.
     """
-    student_files = {}
-    
-    # Walk through the directory
-    for root, dirs, files in os.walk(root_path):
-        # Assuming the immediate subdirectories of root_path are student folders
-        # We need to identify which folder belongs to which student
-        # The structure seems to be: root_path / student_folder / files...
-        
-        rel_path = os.path.relpath(root, root_path)
-        if rel_path == '.':
+    return dict(iter_student_files(root_path, **limits))
+
+
+def iter_student_files(root_path, ignore=CRAWL_IGNORE, max_depth=CRAWL_MAX_DEPTH,
+                       max_file_bytes=CRAWL_MAX_FILE_BYTES, max_files=CRAWL_MAX_FILES):
+    """
+    Lazily yields (student_id, files) for every submission under root_path, so
+    ingestion can start before the crawl has finished.
+
+    The immediate subdirectories of root_path are student folders. Submission
+    archives (.zip, .tar.gz) are opened in place: their members are listed with
+    virtual paths (archive path + member name) instead of being extracted.
+    An archive directly under root_path is treated as one student's submission.
+
+    Args:
+        root_path (str): Assignment directory
+        ignore (iterable of str): fnmatch globs, matched case-insensitively; matching files
+            are skipped and matching directories are not entered (also applied to archive members)
+        max_depth (int): Deepest directory level entered, counting the student folder as level 1
+        max_file_bytes (int): Source, hex and archive files larger than this are skipped
+        max_files (int): Files collected per student before the rest is skipped
+
+    Yields:
+        tuple: (student_id, {'source': [...], 'hex': [...], 'all_files': [...],
+                             'skipped': [(path, reason), ...]})
+    """
+    # Windows and macOS names vary in case (THUMBS.DB, .DS_STORE), so both sides are lowercased
+    ignore = tuple(pattern.lower() for pattern in ignore)
+    archives, folders = [], []
+    with os.scandir(root_path) as it:
+        for entry in it:
+            if _is_ignored(entry.name, ignore):
+                continue
+            if entry.is_dir():
+                if not entry.is_symlink():
+                    folders.append(entry)
+            elif is_archive(entry.name):
+                archives.append(entry)
+
+    limits = (ignore, max_depth, max_file_bytes, max_files)
+    folder_names = {entry.name for entry in folders}
+    merged = set()
+
+    # Top-level archives are whole student submissions (e.g. LMS exports)
+    for entry in archives:
+        student_id = strip_archive_extension(entry.name)
+        files = _new_student_files()
+        _add_file(files, entry.path, _entry_size(entry), limits)
+        if student_id in folder_names:
+            # Same student submitted a folder and an archive: report them together
+            _walk_student_folder(files, os.path.join(root_path, student_id), 1, limits)
+            merged.add(student_id)
+        yield student_id, files
+
+    for entry in folders:
+        if entry.name in merged:
             continue
-            
-        # Extract student ID from the first level folder
-        path_parts = rel_path.split(os.sep)
-        student_id = path_parts[0]
-        
-        if student_id not in student_files:
-            student_files[student_id] = {'source': [], 'hex': [], 'all_files': []}
-            
-        for file in files:
-            ext = os.path.splitext(file)[1].lower()
-            full_path = os.path.join(root, file)
-            
-            student_files[student_id]['all_files'].append(full_path)
-            
-            if ext in ['.a51', '.asm', '.c']:  # .a51, .asm, and .c files are valid source code
-                student_files[student_id]['source'].append(full_path)
-            elif ext == '.hex':
-                student_files[student_id]['hex'].append(full_path)
-                
-    return student_files
-
-def preprocess_c_code(content):
+        files = _new_student_files()
+        _walk_student_folder(files, entry.path, 1, limits)
+        yield entry.name, files
+
+
+def _new_student_files():
+    return {'source': [], 'hex': [], 'all_files': [], 'skipped': []}
+
+
+def _is_ignored(name, ignore):
+    name = name.lower()
+    return any(fnmatch.fnmatchcase(name, pattern) for pattern in ignore)
+
+
+def _entry_size(entry):
+    try:
+        return entry.stat().st_size
+    except OSError:
+        return 0
+
+
+def _walk_student_folder(files, folder, depth, limits):
     """
-    Enhanced C preprocessing that handles C preprocessor directives without requiring Keil C51.
+    Depth-first walk of one student folder: a directory's files are collected
+    before its subdirectories, in the same order as os.walk.
+    Returns False once the student's file cap is reached.
+    """
+    ignore, max_depth = limits[0], limits[1]
+    subdirs = []
+    try:
+        with os.scandir(folder) as it:
+            for entry in it:
+                if _is_ignored(entry.name, ignore):
+                    continue
+                if entry.is_dir():
+                    if not entry.is_symlink():
+                        subdirs.append(entry.path)
+                    continue
+                if not _add_file(files, entry.path, None, limits, entry):
+                    return False
+    except OSError as e:
+        print(f"Warning: Could not read directory {folder}: {e}")
+        return True
+
+    for subdir in subdirs:
+        if depth >= max_depth:
+            files['skipped'].append((subdir, f"超過最大目錄深度 {max_depth}"))
+            continue
+        if not _walk_student_folder(files, subdir, depth + 1, limits):
+            return False
+    return True
+
+
+def _add_file(files, full_path, size, limits, entry=None):
+    """
+    Classifies one file (or every member of an archive) into a student's file lists.
+    Only source, hex and archive files are size-checked, so other files cost no stat call.
+    Returns False once the student's file cap is reached.
     """
-    # First, handle line continuations (backslash at end of line)
-    content = re.sub(r'\\\s*\n', ' ', content)
+    ignore, _, max_file_bytes, max_files = limits
+    paths = [(full_path, size)]
+    if is_archive(full_path):
+        if entry is not None:
+            size = _entry_size(entry)
+        if size > max_file_bytes:
+            files['skipped'].append((full_path, f"檔案過大（{size} bytes）"))
+            return True
+        try:
+            members = list_archive_members(full_path)
+            paths = [(path, member_size) for path, member_size in members
+                     if not any(_is_ignored(part, ignore)
+                                for part in path[len(full_path) + 1:].split(os.sep))]
+        except (OSError, zipfile.BadZipFile, tarfile.TarError) as e:
+            print(f"Warning: Could not open archive {full_path}: {e}")
 
-    # Remove C comments (both single-line and multi-line) while preserving line structure
-    # Use a function to preserve line count for proper line numbers after preprocessing
-    def replace_comments(match):
-        return '\n' * match.group(0).count('\n')
+    for path, size in paths:
+        if len(files['all_files']) >= max_files:
+            files['skipped'].append((path, f"超過每位學生 {max_files} 個檔案上限，其餘檔案略過"))
+            print(f"Warning: File limit ({max_files}) reached at {path}, skipping the rest of the submission")
+            return False
 
-    # Handle multi-line comments first
-    content = re.sub(r'/\*.*?\*/', replace_comments, content, flags=re.DOTALL)
-    # Handle single-line comments
-    content = re.sub(r'//.*', '', content)
+        ext = os.path.splitext(path)[1].lower()
+        kind = None
+        if ext in ['.a51', '.asm', '.c']:  # .a51, .asm, and .c files are valid source code
+            kind = 'source'
+        elif ext == '.hex':
+            kind = 'hex'
 
-    # Process preprocessor directives
-    # Split content into lines to process directives that start lines
-    lines = content.split('\n')
-    processed_lines = []
+        if kind:
+            if size is None:
+                size = _entry_size(entry)
+            if size > max_file_bytes:
+                files['skipped'].append((path, f"檔案過大（{size} bytes）"))
+                continue
+            files[kind].append(path)
+        files['all_files'].append(path)
+    return True
+
+def preprocess_c_code(content, offsets=None):
+    """
+    Enhanced C preprocessing that handles C preprocessor directives without requiring Keil C51.
+    Single pass over the source: comments, directives and conditional blocks are
+    dropped, and whitespace, case and numeric literals are normalized line by line
+    as the text is emitted.
+    If an offsets array('I') is given, the (line, column) of every token is appended to it.
+    """
+    tokens = []
+    line = []  # Kept text of the current line
+    starts = []  # Offset in content of every piece of line
+    # Offsets of the newlines in content (plus a sentinel) and the number of them
+    # passed so far, to turn token offsets into lines
+    newlines = None
+    if offsets is not None:
+        newlines = [m.start() for m in _NEWLINE_RE.finditer(content)]
+        newlines.append(len(content))
+        newlines = [newlines, 0]
+    hash_pos = 0  # Offset of the leading '#' of a directive
     skip_nesting = 0  # Track nested #ifdef/#ifndef blocks
+    at_line_start = True  # Only whitespace and comments seen on this line so far
+    state = _C_TEXT
+    hash_space = False  # Whitespace between a leading '#' and the directive name
 
-    for line in lines:
-        # Check if the line starts with # at the beginning (ignoring leading whitespace)
-        if re.match(r'^\s*#', line):
-            # Extract the directive after the #
-            directive_match = re.match(r'^\s*#\s*(\w+)', line)
-            if directive_match:
-                cmd = directive_match.group(1).lower()
+    for match in _C_LEXEME_RE.finditer(content):
+        kind = match.lastgroup
+
+        if kind == 'space' or kind == 'splice':
+            if state == _C_TEXT:
+                line.append(' ')
+                starts.append(match.start())
+            elif state == _C_HASH:
+                hash_space = True
+            continue
+
+        text = match.group()
+        if kind == 'block':
+            # A comment that spans lines ends the current line, otherwise it vanishes
+            if '\\' in text:
+                text = _C_SPLICE_RE.sub(' ', text)
+            if '\n' not in text:
+                continue
+            kind = 'newline'
+        elif kind == 'line':
+            continue
 
+        if kind == 'newline':
+            if state == _C_HASH and skip_nesting == 0:
+                line.append('#')  # Lone '#' line is kept as-is
+                starts.append(hash_pos)
+            if line:
+                _flush_c_line(line, tokens, starts, offsets, newlines)
+            state = _C_TEXT
+            at_line_start = True
+        elif state == _C_TEXT:
+            if at_line_start:
+                at_line_start = False
+                if text == '#':
+                    state = _C_HASH
+                    hash_space = False
+                    hash_pos = match.start()
+                    continue
+            if skip_nesting == 0:
+                if kind == 'literal' and '\\' in text:
+                    text = _C_SPLICE_RE.sub(' ', text)
+                line.append(text)
+                starts.append(match.start())
+        elif state == _C_HASH:
+            state = _C_TEXT
+            cmd = _C_DIRECTIVE_NAME_RE.match(text) if kind == 'word' else None
+            if cmd:
+                cmd = cmd.group().lower()
                 # Handle conditional compilation directives
                 if cmd in ['ifdef', 'ifndef', 'if']:
                     skip_nesting += 1
-                    processed_lines.append('')  # Add empty line to preserve structure
-                    continue
+                    state = _C_DIRECTIVE
                 elif cmd in ['else', 'elif']:
                     if skip_nesting > 0:  # Only skip if inside a nested block
-                        processed_lines.append('')  # Add empty line to preserve structure
-                        continue
-                    else:
-                        processed_lines.append(line)  # Keep the line if not skipping
-                        continue
+                        state = _C_DIRECTIVE
                 elif cmd == 'endif':
                     if skip_nesting > 0:
                         skip_nesting -= 1
-                    processed_lines.append('')  # Add empty line to preserve structure
-                    continue
-                elif cmd == 'define':
-                    # Remove #define directives
-                    processed_lines.append('')
-                    continue
-                elif cmd in ['include', 'pragma', 'error', 'warning']:
-                    # Remove other preprocessor directives
-                    processed_lines.append('')
-                    continue
+                    state = _C_DIRECTIVE
                 else:
-                    # Remove other directives we don't specifically handle
-                    processed_lines.append('')
-                    continue
+                    # Remove #define, #include, #pragma and any other directive
+                    state = _C_DIRECTIVE
+            if state == _C_TEXT and skip_nesting == 0:
+                # Not a directive we drop (e.g. top-level #else): keep the line
+                line.append('# ' if hash_space else '#')
+                line.append(text)
+                starts.extend((hash_pos, match.start()))
+        # _C_DIRECTIVE: drop everything up to the end of the line
 
-        # If not in a conditional compilation block, add the line
-        if skip_nesting == 0:
-            # If the line had a preprocessor directive in the middle that wasn't at the start,
-            # we need to handle it specially. But normal case is line starts with #
-            processed_lines.append(line)
-        else:
-            processed_lines.append('')  # Add empty line to preserve structure
+    if state == _C_HASH and skip_nesting == 0:
+        line.append('#')
+        starts.append(hash_pos)
+    if line:
+        _flush_c_line(line, tokens, starts, offsets, newlines)
 
-    content = '\n'.join(processed_lines)
+    return ' '.join(tokens)
 
-    # Normalize all whitespace (newlines, tabs, spaces) to single spaces
-    content = re.sub(r'\s+', ' ', content)
 
-    # Convert to lowercase for case-insensitive comparison
-    content = content.lower()
+def _flush_c_line(line, tokens, starts, offsets=None, newlines=None):
+    """
+    Lowercases the buffered line, strips leading zeros in hex values
+    (C keeps the 0x format) and appends its words to tokens.
+    With offsets, also appends the (line, column) where each word starts in the
+    source; newlines is [newline offsets, newlines passed], advanced in place.
+    """
+    text = ''.join(line)
+    if offsets is not None:
+        # Neither lowercasing nor stripping zeros adds or removes whitespace, so
+        # the words of the raw text are the tokens appended below
+        positions, line_index = newlines
+        piece_ends = list(itertools.accumulate(map(len, line)))
+        for word in _NON_SPACE_RE.finditer(text):
+            piece = bisect.bisect_right(piece_ends, word.start())
+            pos = starts[piece] + word.start() - (piece_ends[piece] - len(line[piece]))
+            while positions[line_index] < pos:  # Tokens only move forward
+                line_index += 1
+            line_start = positions[line_index - 1] + 1 if line_index else 0
+            offsets.extend((line_index + 1, pos - line_start + 1))
+        newlines[1] = line_index
+    text = text.lower()
+    if '0' in text:
+        text = _C_LEADING_ZERO_RE.sub(r'\1', text)
+    tokens.extend(text.split())
+    line.clear()
+    starts.clear()
 
-    # For C code, keep hex in 0x format (don't convert to assembly h suffix)
-    # Just ensure consistent formatting
-    content = re.sub(r'\b0+([0-9a-f]+)', r'\1', content)  # Strip leading zeros in hex values
 
-    return content.strip()
+def _normalize_asm_token(token):
+    """
+    Lowercases a single assembly token and normalizes its hex literals.
+    Tokens never contain whitespace, so applying the rules per token gives the
+    same result as applying them to the whole file.
+    """
+    token = token.lower()
+    if '0' in token:
+        token = _ASM_HEX_PREFIX_RE.sub(r'\1h', token)
+        token = _ASM_LEADING_ZERO_RE.sub(r'\1', token)
+    return sys.intern(token)
+
+
+def iter_asm_tokens(content):
+    """
+    Single-pass lexer for .a51/.asm sources.
+    Yields normalized, interned tokens with comments already removed.
+    """
+    for match in _ASM_LEXEME_RE.finditer(content):
+        if match.lastgroup != 'word':
+            continue
+        word = match.group()
+        if "'" in word or '"' in word:
+            # A quoted literal may itself contain whitespace
+            for part in word.split():
+                yield _normalize_asm_token(part)
+        else:
+            yield _normalize_asm_token(word)
 
 
-def clean_code(content, file_extension):
+def clean_code(content, file_extension, offsets=None):
     """
     Removes comments and normalizes whitespace.
+
+    For .a51/.asm/.c files an offsets array('I') may be passed: the 1-based
+    (line, column) in content of every token of the result (split on whitespace)
+    is appended to it, two entries per token.
     """
     # Remove comments based on extension
     if file_extension in ['.a51', '.asm']:
-        # Assembly comments start with ;
-        content = re.sub(r';.*', '', content)
-        # Apply same normalization as before for assembly files
-        content = re.sub(r'\s+', ' ', content)
-        content = content.lower()
-        # Normalize hex immediates: 0x?? -> ??h (assembly-specific)
-        # But be careful not to double-convert values that already have h suffix
-        content = re.sub(r'\b0x([0-9a-f]+)(?!\w)', r'\1h', content)  # Only convert if not already followed by h or other word character
-        # Strip leading zeros from hex values ending in h
-        content = re.sub(r'\b0+([0-9a-f]+h)', r'\1', content)
+        if offsets is not None:
+            _asm_token_offsets(content, offsets)
+        return ' '.join(iter_asm_tokens(content))
     elif file_extension in ['.c']: # Enhanced C preprocessing
-        content = preprocess_c_code(content)
+        content = preprocess_c_code(content, offsets)
     else:
         # For other extensions, normalize whitespace and convert to lowercase
         content = re.sub(r'\s+', ' ', content)
@@ -155,95 +427,193 @@ def clean_code(content, file_extension):
 def normalize_hex(content):
     """
     Parses Intel HEX format, extracts data payload.
+    Accepts either str or bytes; each record is decoded with binascii.unhexlify
+    and its checksum verified.
     Returns: (data_payload, hex_info)
         - data_payload: extracted hex data
         - hex_info: dict with validation information
     """
-    data_payload = ""
-    lines = content.splitlines()
+    if isinstance(content, str):
+        content = content.encode('ascii', 'replace')
+
+    # Data bytes can never exceed half of the input characters
+    payload = bytearray(len(content) // 2)
+    payload_len = 0
     has_eof = False
     format_errors = []
     valid_lines = 0
-    
-    for line_num, line in enumerate(lines, 1):
+    checksum_errors = 0
+
+    for line_num, line in enumerate(content.splitlines(), 1):
         line = line.strip()
         if not line:
             continue
-        if not line.startswith(':'):
+        if not line.startswith(b':'):
             format_errors.append(f"Line {line_num}: Missing ':' prefix")
             continue
-            
+
         # Intel HEX format: :LLAAAATT[DD...]CC
+        if len(line) < 11:  # Minimum valid line length
+            format_errors.append(f"Line {line_num}: Line too short")
+            continue
+
         try:
-            if len(line) < 11:  # Minimum valid line length
-                format_errors.append(f"Line {line_num}: Line too short")
-                continue
-                
             byte_count = int(line[1:3], 16)
-            record_type = int(line[7:9], 16)
-            
-            # Record Type 00 is Data
-            if record_type == 0:
-                data_start = 9
-                data_end = 9 + (byte_count * 2)
-                # Be more lenient - just check we have enough data
-                if len(line) < data_end:
-                    format_errors.append(f"Line {line_num}: Insufficient data")
-                    continue
-                data = line[data_start:data_end]
-                data_payload += data
-                valid_lines += 1
-            # Record Type 01 is EOF
-            elif record_type == 1:
-                has_eof = True
-        except (ValueError, IndexError) as e:
+            record_end = 11 + byte_count * 2
+            # Be lenient about trailing characters - just check we have enough data
+            if len(line) < record_end:
+                format_errors.append(f"Line {line_num}: Insufficient data")
+                continue
+            record = binascii.unhexlify(line[1:record_end])
+        except (binascii.Error, ValueError) as e:
             format_errors.append(f"Line {line_num}: Parse error - {str(e)}")
             continue
-    
+
+        # All bytes including the checksum must sum to zero (mod 256)
+        if sum(record) & 0xFF:
+            checksum_errors += 1
+            format_errors.append(f"Line {line_num}: Checksum mismatch")
+
+        record_type = record[3]
+        # Record Type 00 is Data
+        if record_type == 0:
+            payload[payload_len:payload_len + byte_count] = record[4:4 + byte_count]
+            payload_len += byte_count
+            valid_lines += 1
+        # Record Type 01 is EOF
+        elif record_type == 1:
+            has_eof = True
+        # Extended segment / linear address records carry a 2-byte address
+        elif record_type in (2, 4):
+            if byte_count != 2:
+                format_errors.append(f"Line {line_num}: Bad address record length")
+        # Start segment / linear address records carry a 4-byte address
+        elif record_type in (3, 5):
+            if byte_count != 4:
+                format_errors.append(f"Line {line_num}: Bad start address record length")
+        else:
+            format_errors.append(f"Line {line_num}: Unknown record type {record_type:02X}")
+
+    data_payload = payload[:payload_len].hex()
     hex_info = {
         'has_eof': has_eof,
         'format_errors': format_errors,
         'valid_lines': valid_lines,
-        'data_length': len(data_payload)
+        'data_length': len(data_payload),
+        'checksum_errors': checksum_errors
     }
-    
-    return data_payload.lower(), hex_info
 
+    return data_payload, hex_info
 
-def validate_source_code(content, file_extension):
+
+def analyze_asm_source(content, offsets=None):
     """
-    Validates assembly source code quality.
-    Returns: list of anomalies
+    Fused clean + validate pass for .a51/.asm sources.
+    Walks the source once, emitting the normalized token stream (as iter_asm_tokens)
+    while classifying every line for validate_source_code.
+    If an offsets array('I') is given, the (line, column) of every token is appended to it.
+
+    Returns: (tokens, stats) where stats has 'total_lines', 'blank_lines',
+        'comment_lines', 'code_lines' and 'key_instructions' (set)
+    """
+    if _ASM_OTHER_LINE_BREAK_RE.search(content):
+        # splitlines() also breaks lines at characters the lexer treats as spaces;
+        # such files are rare enough to classify in a separate pass
+        if offsets is not None:
+            _asm_token_offsets(content, offsets)
+        return list(iter_asm_tokens(content)), _asm_line_stats(content)
+
+    tokens = []
+    append = tokens.append
+    blank_lines = comment_lines = code_lines = 0
+    found_instructions = set()
+    line_started = False  # A comment or word was already seen on the current line
+    line_no, line_start = 1, 0
+
+    for match in _ASM_LEXEME_RE.finditer(content):
+        kind = match.lastgroup
+        if kind == 'word':
+            word = match.group()
+            quoted = "'" in word or '"' in word
+            if quoted:
+                # A quoted literal may itself contain whitespace
+                for part in word.split():
+                    append(_normalize_asm_token(part))
+                if offsets is not None:
+                    column = match.start() - line_start + 1
+                    for part in _NON_SPACE_RE.finditer(word):
+                        offsets.extend((line_no, column + part.start()))
+            else:
+                token = _normalize_asm_token(word)
+                append(token)
+                if offsets is not None:
+                    offsets.extend((line_no, match.start() - line_start + 1))
+            if line_started:
+                continue
+            # The instruction is the line's first whitespace-delimited word minus a
+            # label colon; usually that is the token itself, which is already
+            # lowercased and cannot have been turned into a key instruction
+            line_started = True
+            code_lines += 1
+            end = match.end()
+            if quoted or content[end:end + 1] == ';':
+                instr = _NON_SPACE_RE.match(content, match.start()).group().lower()
+            else:
+                instr = token
+            instr = instr.rstrip(':')
+            if instr in _ASM_KEY_INSTRUCTIONS:
+                found_instructions.add(instr)
+        elif kind == 'newline':
+            if not line_started:
+                blank_lines += 1
+            line_started = False
+            line_no += 1
+            line_start = match.end()
+        elif not line_started:  # Comment
+            comment_lines += 1
+            line_started = True
+
+    if not line_started and content and not content.endswith('\n'):
+        blank_lines += 1  # Whitespace after the last newline
+    return tokens, {
+        'total_lines': blank_lines + comment_lines + code_lines,
+        'blank_lines': blank_lines,
+        'comment_lines': comment_lines,
+        'code_lines': code_lines,
+        'key_instructions': found_instructions
+    }
+
+
+def _asm_token_offsets(content, offsets):
+    """
+    Appends the 1-based (line, column) of every token of iter_asm_tokens(content) to offsets.
+    Lines are counted at '\n' only.
+    """
+    line_no, line_start = 1, 0
+    for match in _ASM_LEXEME_RE.finditer(content):
+        kind = match.lastgroup
+        if kind == 'newline':
+            line_no += 1
+            line_start = match.end()
+        elif kind == 'word':
+            column = match.start() - line_start + 1
+            for part in _NON_SPACE_RE.finditer(match.group()):
+                offsets.extend((line_no, column + part.start()))
+
+
+def _asm_line_stats(content):
+    """
+    Line statistics of an assembly source, one line at a time.
     """
-    anomalies = []
-    
-    if file_extension not in ['.a51', '.asm']:
-        return anomalies
-    
-    lines = content.splitlines()
-    total_lines = len(lines)
-    
-    if total_lines == 0:
-        anomalies.append({
-            'code': 'EMPTY_FILE',
-            'severity': 'error',
-            'message': '原始碼檔案為空'
-        })
-        return anomalies
-    
-    # Count different line types
     blank_lines = 0
     comment_lines = 0
     code_lines = 0
-    instructions = []
-    
-    # Key assembly instructions to look for
-    key_instructions = ['org', 'end', 'mov', 'jmp', 'call', 'ret']
     found_instructions = set()
-    
+    lines = content.splitlines()
+
     for line in lines:
         stripped = line.strip()
-        
+
         if not stripped:
             blank_lines += 1
         elif stripped.startswith(';'):
@@ -251,20 +621,67 @@ def validate_source_code(content, file_extension):
         else:
             code_lines += 1
             # Extract instruction (first word)
-            parts = stripped.lower().split()
-            if parts:
-                instr = parts[0].rstrip(':')  # Remove label colon
-                instructions.append(instr)
-                if instr in key_instructions:
-                    found_instructions.add(instr)
-    
+            instr = stripped.lower().split()[0].rstrip(':')  # Remove label colon
+            if instr in _ASM_KEY_INSTRUCTIONS:
+                found_instructions.add(instr)
+
+    return {
+        'total_lines': len(lines),
+        'blank_lines': blank_lines,
+        'comment_lines': comment_lines,
+        'code_lines': code_lines,
+        'key_instructions': found_instructions
+    }
+
+
+def clean_and_validate(content, file_extension, offsets=None):
+    """
+    clean_code and validate_source_code in one call; assembly sources are
+    processed in a single fused pass. Token offsets are filled in as by clean_code.
+    Returns: (cleaned, anomalies)
+    """
+    if file_extension in ['.a51', '.asm']:
+        tokens, stats = analyze_asm_source(content, offsets)
+        return ' '.join(tokens), _source_anomalies(stats)
+    return clean_code(content, file_extension, offsets), validate_source_code(content, file_extension)
+
+
+def validate_source_code(content, file_extension):
+    """
+    Validates assembly source code quality.
+    Returns: list of anomalies
+    """
+    if file_extension not in ['.a51', '.asm']:
+        return []
+    return _source_anomalies(_asm_line_stats(content))
+
+
+def _source_anomalies(stats):
+    """
+    Derives the source code anomalies from the line statistics.
+    """
+    anomalies = []
+    total_lines = stats['total_lines']
+    blank_lines = stats['blank_lines']
+    comment_lines = stats['comment_lines']
+    code_lines = stats['code_lines']
+    found_instructions = stats['key_instructions']
+
+    if total_lines == 0:
+        anomalies.append({
+            'code': 'EMPTY_FILE',
+            'severity': 'error',
+            'message': '原始碼檔案為空'
+        })
+        return anomalies
+
     # Check 1: Minimum instruction count
-    if len(instructions) < 10:
+    if code_lines < 10:
         anomalies.append({
             'code': 'FEW_INSTRUCTIONS',
             'severity': 'warning',
-            'message': f'指令數量過少 ({len(instructions)} 條)',
-            'details': {'count': len(instructions)}
+            'message': f'指令數量過少 ({code_lines} 條)',
+            'details': {'count': code_lines}
         })
     
     # Check 2: Key instructions existence
@@ -316,6 +733,135 @@ def validate_source_code(content, file_extension):
     return anomalies
 
 
+def span_to_lines(offsets, start, end):
+    """
+    Maps the tokens [start, end) of a student's compared source back to the
+    original files in O(end - start).
+
+    Args:
+        offsets: array('I') with (file index, line, column) per token, such as
+            student_data[student]['source_offsets']
+
+    Returns:
+        list of (file_index, first_line, last_line), one per run of tokens from the same file
+    """
+    ranges = []
+    for i in range(3 * start, 3 * end, 3):
+        file_index, line = offsets[i], offsets[i + 1]
+        if ranges and ranges[-1][0] == file_index:
+            ranges[-1][2] = line
+        else:
+            ranges.append([file_index, line, line])
+    return [tuple(r) for r in ranges]
+
+
+def guard_source(content, policy=GUARD_POLICY, max_chars=GUARD_MAX_SOURCE_CHARS):
+    """
+    Input guard for one decoded source file, applied before cleaning.
+    Returns: (content, anomaly) where an oversized file is reduced according to
+    the policy and reported as an OVERSIZED_FILE anomaly; otherwise anomaly is None.
+    A sampled file's anomaly details carry 'line_map', [line in content, line in
+    the file] where each excerpt starts (see remap_sampled_lines).
+    """
+    if policy not in GUARD_POLICIES:
+        raise ValueError(f"Unknown guard policy: {policy}")
+    length = len(content)
+    if length <= max_chars:
+        return content, None
+
+    details = {'length': length, 'limit': max_chars, 'policy': policy}
+    if policy == 'cap':
+        kept = _line_aligned_slice(content, 0, max_chars)[1]
+        action = '僅比對前段內容'
+    elif policy == 'sample':
+        # One character per excerpt is kept free for the newline that ends it
+        chunk = max_chars // GUARD_SAMPLE_CHUNKS - 1
+        stride = length // GUARD_SAMPLE_CHUNKS
+        pieces = []
+        line_map = []
+        kept_line = file_line = 1
+        counted = 0
+        for i in range(GUARD_SAMPLE_CHUNKS):
+            start, piece = _line_aligned_slice(content, i * stride, chunk)
+            if not piece:
+                continue
+            if not piece.endswith('\n'):
+                piece += '\n'  # Excerpts never share a line, so line_map stays exact
+            file_line += content.count('\n', counted, start)
+            counted = start
+            line_map.append([kept_line, file_line])
+            kept_line += piece.count('\n')
+            pieces.append(piece)
+        kept = ''.join(pieces)
+        details['line_map'] = line_map
+        action = '僅比對抽樣內容'
+    else:
+        kept = ''
+        action = '僅保留雜湊，不參與比對'
+
+    return kept, {
+        'code': 'OVERSIZED_FILE',
+        'severity': 'error',
+        'message': f'檔案過大 ({length} 字元)，{action}',
+        'details': details
+    }
+
+
+def _line_aligned_slice(content, start, length):
+    """
+    Returns (start, piece): about `length` characters of content from `start`,
+    trimmed to whole lines, and where the piece starts in content.
+    """
+    if start > 0:
+        newline = content.find('\n', start - 1)
+        if newline < 0:
+            return len(content), ''
+        start = newline + 1
+    piece = content[start:start + length]
+    end = piece.rfind('\n')
+    if end >= 0 and start + length < len(content):
+        piece = piece[:end + 1]
+    return start, piece
+
+
+def remap_sampled_lines(offsets, line_map):
+    """
+    Maps the (line, column) token offsets of a file sampled by guard_source back to
+    lines of the submitted file.
+
+    Args:
+        offsets: array('I') of (line, column) per token of the sampled content
+        line_map: [line in sampled content, line in the file] where each excerpt starts
+
+    Returns:
+        array('I'): offsets with file line numbers
+    """
+    kept_starts = [kept_line for kept_line, _ in line_map]
+    remapped = array('I', offsets)
+    for i in range(0, len(remapped), 2):
+        kept_line, file_line = line_map[bisect.bisect_right(kept_starts, remapped[i]) - 1]
+        remapped[i] += file_line - kept_line
+    return remapped
+
+
+def enforce_token_budget(text, max_tokens=GUARD_MAX_STUDENT_TOKENS):
+    """
+    Per-student token budget, enforced before Step 2.
+    Returns: (text, anomaly) where text over budget is truncated to its first
+    max_tokens tokens and reported as a TOKEN_BUDGET_EXCEEDED anomaly
+    """
+    parts = text.split(None, max_tokens)
+    if len(parts) <= max_tokens:
+        return text, None
+    total = max_tokens + len(parts[-1].split())
+    return ' '.join(parts[:max_tokens]), {
+        'code': 'TOKEN_BUDGET_EXCEEDED',
+        'severity': 'error',
+        'message': f'程式碼過長 ({total} 個 token)，僅比對前 {max_tokens} 個',
+        'details': {'count': total, 'limit': max_tokens}
+    }
+
+
 def check_hex_integrity(hex_info, hex_length, median_length):
     """
     Checks hex file integrity based on validation info.
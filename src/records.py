@@ -0,0 +1,110 @@
+"""
+Slotted record types passed between the pipeline stages.
+
+A Student holds one student's Step 1 output. A PairResult refers to its two
+students by id only, so each student's code is stored once no matter how many
+suspicious pairs it appears in; the reporter looks the code up by id.
+"""
+from array import array
+
+
+class Student:
+    """
+    Step 1 output for one student.
+
+    Attributes:
+        id (str): Student folder name
+        source (str): Cleaned source tokens compared in Step 2
+        hex (str): Normalized hex data
+        original_source (str): Source as submitted, shown in the report
+        asm_source (str): Compiled or raw assembly (compared in Keil mode)
+        illegal_submission (bool), illegal_reason (str): Missing or wrong file types
+        hex_anomalies (list), source_anomalies (list): Anomaly dicts
+        has_anomaly (bool): Any anomaly found
+        hex_length (int): Length of hex
+        source_offsets (array('I')): (file index, line, column) per source token
+        excluded_files (list): {'path', 'reference'} of files dropped by the allowlist
+        hex_info (dict): Hex validation info
+    """
+
+    __slots__ = ('id', 'source', 'hex', 'original_source', 'asm_source', 'illegal_submission',
+                 'illegal_reason', 'hex_anomalies', 'source_anomalies', 'has_anomaly', 'hex_length',
+                 'source_offsets', 'excluded_files', 'hex_info')
+
+    def __init__(self, id, source="", hex="", original_source="", asm_source="", illegal_submission=False,
+                 illegal_reason="", hex_anomalies=None, source_anomalies=None, has_anomaly=False, hex_length=0,
+                 source_offsets=None, excluded_files=None, hex_info=None):
+        self.id = id
+        self.source = source
+        self.hex = hex
+        self.original_source = original_source
+        self.asm_source = asm_source
+        self.illegal_submission = illegal_submission
+        self.illegal_reason = illegal_reason
+        self.hex_anomalies = hex_anomalies if hex_anomalies is not None else []
+        self.source_anomalies = source_anomalies if source_anomalies is not None else []
+        self.has_anomaly = has_anomaly
+        self.hex_length = hex_length
+        self.source_offsets = source_offsets if source_offsets is not None else array('I')
+        self.excluded_files = excluded_files if excluded_files is not None else []
+        self.hex_info = hex_info if hex_info is not None else {}
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(**data)
+
+    def __eq__(self, other):
+        if not isinstance(other, Student):
+            return NotImplemented
+        return self.to_dict() == other.to_dict()
+
+    def __repr__(self):
+        return f"Student({self.id!r})"
+
+
+class PairResult:
+    """
+    Scores of one student pair (Step 2) and, once analyzed, its verdict (Step 4).
+
+    Attributes:
+        student1, student2 (str): Student ids
+        source_similarity (dict): {'token_seq', 'levenshtein'}
+        hex_levenshtein (float), max_hex_sim (float): Hex similarity
+        avg_score (float): Mean of the two source metrics
+        llm_analysis (dict or None), llm_triggered (bool): LLM result, if asked
+        final_verdict (str or None), verdict_reason (str): Set by Step 4
+    """
+
+    __slots__ = ('student1', 'student2', 'source_similarity', 'hex_levenshtein', 'max_hex_sim', 'avg_score',
+                 'llm_analysis', 'llm_triggered', 'final_verdict', 'verdict_reason')
+
+    def __init__(self, student1, student2, source_similarity, hex_levenshtein, max_hex_sim, avg_score,
+                 llm_analysis=None, llm_triggered=False, final_verdict=None, verdict_reason=""):
+        self.student1 = student1
+        self.student2 = student2
+        self.source_similarity = source_similarity
+        self.hex_levenshtein = hex_levenshtein
+        self.max_hex_sim = max_hex_sim
+        self.avg_score = avg_score
+        self.llm_analysis = llm_analysis
+        self.llm_triggered = llm_triggered
+        self.final_verdict = final_verdict
+        self.verdict_reason = verdict_reason
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(**data)
+
+    def __eq__(self, other):
+        if not isinstance(other, PairResult):
+            return NotImplemented
+        return self.to_dict() == other.to_dict()
+
+    def __repr__(self):
+        return f"PairResult({self.student1!r}, {self.student2!r}, avg_score={self.avg_score!r})"
@@ -3,10 +3,17 @@ import os
 import html
 import json
 
+from llm_analyzer import is_llm_error, BUDGET_SKIPPED
+
 def generate_html_report(results, hex_threshold, src_threshold, illegal_students=[], anomaly_students=[], lab_name="Lab", 
-                        filter_mode="threshold", top_metric="max_score", top_percent=0.05, use_keil_compilation=False):
+                        filter_mode="threshold", top_metric="max_score", top_percent=0.05, use_keil_compilation=False,
+                        excluded_students=None, students=None):
     """
     Generates an HTML report from the plagiarism results.
+    results: PairResult list; their students' code is looked up in students
+    (dict id -> Student) and written to the report once per student
+    excluded_students: [{'student', 'files': [{'path', 'reference'}]}] for reference
+    files dropped by the allowlist
     """
     # Write reports under repository root `reports/` directory
     # src/reporter.py -> repo root is one level up
@@ -289,14 +296,46 @@ def generate_html_report(results, hex_threshold, src_threshold, illegal_students
             </div>
         """
     
+    # List reference files left out of the comparison
+    if excluded_students:
+        html_content += f"""
+            <div class="excluded-section" style="margin: 20px 0; padding: 15px; background: #eef6fb; border-left: 4px solid #3498db; border-radius: 4px;">
+                <h3 style="margin-top: 0; color: #2980b9;">📎 已排除的參考檔案 ({len(excluded_students)} 位學生)</h3>
+                <p>以下檔案與參考檔案（如 Keil 範本、課程提供的驅動程式）內容相同，未納入比對。</p>
+                <table style="width: 100%; margin-top: 10px;">
+                    <thead>
+                        <tr style="background: #3498db;">
+                            <th>Student</th>
+                            <th>Files</th>
+                        </tr>
+                    </thead>
+                    <tbody>
+        """
+        for student in excluded_students:
+            file_list = '<br>'.join(
+                f"{html.escape(os.path.basename(f['path']))} <small>(= {html.escape(f['reference'])})</small>"
+                for f in student['files']
+            )
+            html_content += f"""
+                        <tr>
+                            <td><strong>{html.escape(student['student'])}</strong></td>
+                            <td>{file_list}</td>
+                        </tr>
+            """
+        html_content += """
+                    </tbody>
+                </table>
+            </div>
+        """
+    
     # Add plagiarism summary section - only student names
-    plagiarized_pairs = [r for r in results if r.get('final_verdict') == '抄襲']
+    plagiarized_pairs = [r for r in results if r.final_verdict == '抄襲']
     if plagiarized_pairs:
         # Collect unique student names
         plagiarized_students = set()
         for pair in plagiarized_pairs:
-            plagiarized_students.add(pair['student1'])
-            plagiarized_students.add(pair['student2'])
+            plagiarized_students.add(pair.student1)
+            plagiarized_students.add(pair.student2)
         
         html_content += f"""
             <div style="margin: 20px 0; padding: 15px; background: #ffebee; border-left: 4px solid #e74c3c; border-radius: 4px;">
@@ -317,7 +356,7 @@ def generate_html_report(results, hex_threshold, src_threshold, illegal_students
     # Sort results by verdict priority: 抄襲 > 非法提交 > 未抄襲
     # Always sort by verdict priority first, then by score (which is already sorted in results)
     def verdict_priority(res):
-        verdict = res.get('final_verdict', '未知')
+        verdict = res.final_verdict or '未知'
         if verdict == '抄襲':
             return 0
         elif verdict == '無效提交':
@@ -346,6 +385,21 @@ def generate_html_report(results, hex_threshold, src_threshold, illegal_students
             <h2 style="margin-top: 30px;">詳細比對列表 ({len(sorted_results)} 組)</h2>
             <p style="color: #666;">{description_text}</p>
     """
+
+    # LLM coverage of the pairs that needed an LLM verdict
+    sources = [_verdict_source(res) for res in sorted_results]
+    llm_pairs = len(sources) - sources.count('rule')
+    if llm_pairs:
+        covered = sources.count('llm')
+        notes = []
+        if sources.count('budget'):
+            notes.append(f"{sources.count('budget')} 組超出 LLM 預算")
+        if sources.count('fallback') + sources.count('error'):
+            notes.append(f"{sources.count('fallback') + sources.count('error')} 組 LLM 無法使用或失敗")
+        note_text = f"（{'、'.join(notes)}）" if notes else ""
+        html_content += f"""
+            <p style="color: #666;">LLM 覆蓋率：{covered} / {llm_pairs} 組需 LLM 判定的配對由 LLM 判定{note_text}</p>
+    """
     
     # Determine table headers based on filter mode
     hex_header = "Hex Score"  # Always use "Hex Score" for consistency
@@ -370,6 +424,7 @@ def generate_html_report(results, hex_threshold, src_threshold, illegal_students
                         <th>{hex_header}</th>
                         <th>{src_header}</th>
                         <th>最終判定</th>
+                        <th>判定來源</th>
                         <th>Details</th>
                     </tr>
                 </thead>
@@ -377,22 +432,26 @@ def generate_html_report(results, hex_threshold, src_threshold, illegal_students
     """
     
     
+    students = students or {}
+    # Each student's code is emitted once; pair rows refer to it by index
+    student_refs = {}
+
     for i, res in enumerate(sorted_results):
-        hex_comp = res.get('max_hex_sim', 0)
-        src_comp = res.get('avg_score', 0) # Default to average score
+        hex_comp = res.max_hex_sim
+        src_comp = res.avg_score # Default to average score
         
         # Override displayed scores if in top_percent mode with specific metric
         if filter_mode == "top_percent":
             if top_metric == "token_seq":
-                src_comp = res['source_similarity']['token_seq']
-                hex_comp = res.get('hex_levenshtein', 0)
+                src_comp = res.source_similarity['token_seq']
+                hex_comp = res.hex_levenshtein
             elif top_metric == "levenshtein":
-                src_comp = res['source_similarity']['levenshtein']
-                hex_comp = res.get('hex_levenshtein', 0)
+                src_comp = res.source_similarity['levenshtein']
+                hex_comp = res.hex_levenshtein
             elif top_metric == "avg_score":
-                src_comp = res.get('avg_score', 0)
-                hex_comp = res.get('hex_levenshtein', 0)
-        verdict = res.get('final_verdict', '未知')
+                src_comp = res.avg_score
+                hex_comp = res.hex_levenshtein
+        verdict = res.final_verdict or '未知'
         
         # Color coding for verdict
         if verdict == '抄襲':
@@ -405,32 +464,26 @@ def generate_html_report(results, hex_threshold, src_threshold, illegal_students
             verdict_html = '<span style="color: #95a5a6; font-weight: bold;">🟡 未知</span>'
         
         # Escape strings for JS
-        s1 = html.escape(res['student1'])
-        s2 = html.escape(res['student2'])
-        
-        # Use original source if available, else cleaned
-        code1_content = res.get('original_source1') or res.get('source_code1', 'Source not available')
-        code2_content = res.get('original_source2') or res.get('source_code2', 'Source not available')
+        s1 = html.escape(res.student1)
+        s2 = html.escape(res.student2)
         
-        code1 = html.escape(code1_content)
-        code2 = html.escape(code2_content)
-        hex1 = html.escape(res.get('hex_code1', 'Hex not available'))
-        hex2 = html.escape(res.get('hex_code2', 'Hex not available'))
+        # Student code blocks, written the first time a student appears
+        student_blocks = ""
+        for student_id in (res.student1, res.student2):
+            if student_id not in student_refs:
+                student_refs[student_id] = len(student_refs)
+                student_blocks += _student_block(student_refs[student_id], student_id, students.get(student_id))
+        ref1 = student_refs[res.student1]
+        ref2 = student_refs[res.student2]
         
-        llm_analysis = res.get('llm_analysis') or {}
+        llm_analysis = res.llm_analysis or {}
         llm_reasoning = html.escape(llm_analysis.get('reasoning', ''))
-        verdict_reason = html.escape(res.get('verdict_reason', ''))
-        
-        # Illegal status
-        ill1 = "true" if res.get('illegal_submission1') else "false"
-        reason1 = html.escape(res.get('illegal_reason1', ''))
-        ill2 = "true" if res.get('illegal_submission2') else "false"
-        reason2 = html.escape(res.get('illegal_reason2', ''))
+        verdict_reason = html.escape(res.verdict_reason or '')
         
         # JSON data for chart - restructured format
         chart_data = {
-            'token_seq': [res['source_similarity']['token_seq'], 0],
-            'levenshtein': [res['source_similarity']['levenshtein'], res['hex_levenshtein']]
+            'token_seq': [res.source_similarity['token_seq'], 0],
+            'levenshtein': [res.source_similarity['levenshtein'], res.hex_levenshtein]
         }
         chart_json = html.escape(json.dumps(chart_data))
         
@@ -454,21 +507,15 @@ def generate_html_report(results, hex_threshold, src_threshold, illegal_students
                 <td>{hex_display}</td>
                 <td>{src_display}</td>
                 <td>{verdict_html}</td>
+                <td>{VERDICT_SOURCE_LABELS[sources[i]]}</td>
                 <td><button>View</button></td>
             </tr>
             
+            {student_blocks}
             <!-- Hidden data for modal -->
-            <div id="data-{i}" style="display:none;">
-                <div class="student1">{s1}</div>
-                <div class="student2">{s2}</div>
-                <div class="code1">{code1}</div>
-                <div class="code2">{code2}</div>
-                <div class="hex1">{hex1}</div>
-                <div class="hex2">{hex2}</div>
+            <div id="data-{i}" data-student1="{ref1}" data-student2="{ref2}" style="display:none;">
                 <div class="llm-reasoning">{llm_reasoning}</div>
                 <div class="verdict-reason">{verdict_reason}</div>
-                <div class="illegal1" data-is-illegal="{ill1}">{reason1}</div>
-                <div class="illegal2" data-is-illegal="{ill2}">{reason2}</div>
                 <div class="chart-data">{chart_json}</div>
             </div>
         """
@@ -557,11 +604,13 @@ def generate_html_report(results, hex_threshold, src_threshold, illegal_students
 
             function openModal(id) {
                 const data = document.getElementById('data-' + id);
-                document.getElementById('s1-name').innerText = data.querySelector('.student1').innerText;
-                document.getElementById('s2-name').innerText = data.querySelector('.student2').innerText;
+                const student1 = document.getElementById('student-' + data.dataset.student1);
+                const student2 = document.getElementById('student-' + data.dataset.student2);
+                document.getElementById('s1-name').innerText = student1.querySelector('.name').innerText;
+                document.getElementById('s2-name').innerText = student2.querySelector('.name').innerText;
                 
-                const code1Raw = data.querySelector('.code1').innerText;
-                const code2Raw = data.querySelector('.code2').innerText;
+                const code1Raw = student1.querySelector('.code').innerText;
+                const code2Raw = student2.querySelector('.code').innerText;
                 
                 // Remove comments from code before displaying
                 const code1 = removeComments(code1Raw);
@@ -573,13 +622,13 @@ def generate_html_report(results, hex_threshold, src_threshold, illegal_students
                 document.getElementById('ln1').innerText = generateLineNumbers(code1);
                 document.getElementById('ln2').innerText = generateLineNumbers(code2);
                 
-                document.getElementById('hex1-view').innerText = data.querySelector('.hex1').innerText;
-                document.getElementById('hex2-view').innerText = data.querySelector('.hex2').innerText;
+                document.getElementById('hex1-view').innerText = student1.querySelector('.hex').innerText;
+                document.getElementById('hex2-view').innerText = student2.querySelector('.hex').innerText;
                 
                 
                 // Handle Illegal Warnings
-                const ill1 = data.querySelector('.illegal1');
-                const ill2 = data.querySelector('.illegal2');
+                const ill1 = student1.querySelector('.illegal');
+                const ill2 = student2.querySelector('.illegal');
                 
                 if (ill1.dataset.isIllegal === "true") {
                     document.getElementById('s1-warning').style.display = 'block';
@@ -793,3 +842,42 @@ def generate_html_report(results, hex_threshold, src_threshold, illegal_students
     with open(output_file, 'w', encoding='utf-8') as f:
         f.write(html_content)
     print(f"Report generated: {output_file}")
+
+
+# How a pair's verdict was reached (see main._pair_verdict)
+VERDICT_SOURCE_LABELS = {
+    'rule': '📏 完全相同',
+    'llm': '🤖 LLM',
+    'error': '📊 演算法（LLM 錯誤）',
+    'budget': '📊 演算法（超出預算）',
+    'fallback': '📊 演算法',
+}
+
+
+def _verdict_source(res):
+    if not res.llm_triggered:
+        return 'rule'
+    llm_analysis = res.llm_analysis
+    if llm_analysis and 'is_plagiarized' in llm_analysis:
+        return 'error' if is_llm_error(llm_analysis) else 'llm'
+    return 'budget' if llm_analysis == BUDGET_SKIPPED else 'fallback'
+
+
+def _student_block(ref, student_id, student):
+    """
+    Hidden per-student data (code, hex, illegal status) shared by all of the student's pair rows.
+    """
+    if student is None:
+        code, hex_data, illegal, reason = 'Source not available', 'Hex not available', False, ''
+    else:
+        # Use original source if available, else cleaned
+        code = student.original_source or student.source
+        hex_data, illegal, reason = student.hex, student.illegal_submission, student.illegal_reason
+    return f"""
+            <div id="student-{ref}" style="display:none;">
+                <div class="name">{html.escape(student_id)}</div>
+                <div class="code">{html.escape(code)}</div>
+                <div class="hex">{html.escape(hex_data)}</div>
+                <div class="illegal" data-is-illegal="{'true' if illegal else 'false'}">{html.escape(reason)}</div>
+            </div>
+    """
@@ -0,0 +1,70 @@
+"""
+Unit tests for allowlist.py
+Tests building, saving and matching the reference file allowlist
+"""
+import unittest
+import sys
+import os
+import json
+import tempfile
+import shutil
+from contextlib import redirect_stdout
+from io import StringIO
+
+# Add src to path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from allowlist import text_hash, build_allowlist, save_allowlist, load_allowlist, main
+
+
+STARTUP = "; STARTUP.A51\nIDATALEN EQU 80H\nCSEG AT 0\n  LJMP STARTUP1\nEND\n"
+
+
+class TestAllowlist(unittest.TestCase):
+    """Test allowlist construction and lookups"""
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.ref_dir = os.path.join(self.test_dir, 'reference')
+        os.makedirs(os.path.join(self.ref_dir, 'drivers'))
+        with open(os.path.join(self.ref_dir, 'STARTUP.A51'), 'w', encoding='utf-8') as f:
+            f.write(STARTUP)
+        with open(os.path.join(self.ref_dir, 'drivers', 'lcd.c'), 'w', encoding='utf-8') as f:
+            f.write("void lcd_init(void) {}\n")
+        with open(os.path.join(self.ref_dir, 'README.txt'), 'w', encoding='utf-8') as f:
+            f.write("not a source file")
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def test_build(self):
+        allowlist = build_allowlist(self.ref_dir)
+        self.assertEqual(sorted(allowlist.values()), ['STARTUP.A51', 'drivers/lcd.c'])
+        self.assertEqual(allowlist[text_hash(STARTUP)], 'STARTUP.A51')
+
+    def test_hash_ignores_line_endings_and_trailing_space(self):
+        self.assertEqual(text_hash(STARTUP), text_hash(STARTUP.replace('\n', '  \n') + '\n\n'))
+        self.assertNotEqual(text_hash(STARTUP), text_hash(STARTUP.replace('80H', '81H')))
+
+    def test_save_and_load(self):
+        path = os.path.join(self.test_dir, 'allowlist.json')
+        allowlist = build_allowlist(self.ref_dir)
+        save_allowlist(allowlist, path)
+        self.assertEqual(load_allowlist(path), allowlist)
+
+    def test_load_rejects_unknown_version(self):
+        path = os.path.join(self.test_dir, 'allowlist.json')
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({'version': 99, 'files': {}}, f)
+        with self.assertRaises(ValueError):
+            load_allowlist(path)
+
+    def test_command(self):
+        path = os.path.join(self.test_dir, 'out.json')
+        with redirect_stdout(StringIO()):
+            self.assertEqual(main([self.ref_dir, '-o', path]), 0)
+        self.assertEqual(len(load_allowlist(path)), 2)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,72 @@
+"""
+Unit tests for artifacts.py
+Tests saving and loading stage artifacts of the staged CLI
+"""
+import unittest
+import sys
+import os
+import json
+import tempfile
+import shutil
+from array import array
+
+# Add src to path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from artifacts import save_artifact, load_artifact, artifact_path, students_fingerprint, ArtifactError
+
+
+class TestArtifacts(unittest.TestCase):
+    """Test artifact round trips and version checks"""
+
+    def setUp(self):
+        self.run_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.run_dir)
+
+    def test_round_trip(self):
+        data = {'alice': {'source': "mov a , #1h", 'source_offsets': array('I', [0, 1, 1, 0, 1, 5]),
+                          'hex_anomalies': [], 'hex_length': 4}}
+        params = {'root_path': '/data/Lab 6', 'use_keil_compilation': False}
+        save_artifact(self.run_dir, 'ingest', data, params)
+        loaded, loaded_params = load_artifact(self.run_dir, 'ingest')
+        self.assertEqual(loaded, data)
+        self.assertIsInstance(loaded['alice']['source_offsets'], array)
+        self.assertEqual(loaded_params, params)
+
+    def test_missing_stage(self):
+        with self.assertRaises(FileNotFoundError):
+            load_artifact(self.run_dir, 'score')
+
+    def test_rejects_other_version(self):
+        save_artifact(self.run_dir, 'score', [], {})
+        path = artifact_path(self.run_dir, 'score')
+        with open(path, 'r', encoding='utf-8') as f:
+            artifact = json.load(f)
+        artifact['version'] = -1
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(artifact, f)
+        with self.assertRaises(ValueError):
+            load_artifact(self.run_dir, 'score')
+
+    def test_rejects_stale_artifact(self):
+        students = {'alice': {'source': "mov a , #1h", 'asm_source': "", 'hex': "0102"}}
+        fingerprint = students_fingerprint(students)
+        save_artifact(self.run_dir, 'score', [], {'students_fingerprint': fingerprint})
+        self.assertEqual(load_artifact(self.run_dir, 'score', fingerprint)[0], [])
+
+        students['alice']['source'] = "mov a , #2h"
+        self.assertNotEqual(students_fingerprint(students), fingerprint)
+        with self.assertRaises(ArtifactError):
+            load_artifact(self.run_dir, 'score', students_fingerprint(students))
+
+    def test_rejects_unreadable_artifact(self):
+        with open(artifact_path(self.run_dir, 'score'), 'w', encoding='utf-8') as f:
+            f.write('{"artifact": "score", "vers')
+        with self.assertRaises(ArtifactError):
+            load_artifact(self.run_dir, 'score')
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,70 @@
+"""
+Unit tests for cache.py
+Tests the SQLite-backed disk cache: lookups, counters, LRU eviction and TTL
+"""
+import unittest
+import sys
+import os
+import tempfile
+import shutil
+import time
+from unittest.mock import patch
+
+# Add src to path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from cache import DiskCache
+
+
+class TestDiskCache(unittest.TestCase):
+    """Test DiskCache behaviour"""
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.test_dir, 'sub', 'cache.sqlite')
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def test_put_and_get(self):
+        with DiskCache(self.path) as cache:
+            cache.put('k', {'cleaned': 'mov a, #55h', 'anomalies': []})
+            self.assertEqual(cache.get('k'), {'cleaned': 'mov a, #55h', 'anomalies': []})
+
+    def test_hit_miss_counters(self):
+        with DiskCache(self.path) as cache:
+            self.assertIsNone(cache.get('missing'))
+            cache.put('k', 1)
+            cache.get('k')
+            self.assertEqual((cache.hits, cache.misses), (1, 1))
+            self.assertAlmostEqual(cache.hit_rate(), 0.5)
+
+    def test_persistence(self):
+        with DiskCache(self.path) as cache:
+            cache.put('k', [1, 2, 3])
+        with DiskCache(self.path) as cache:
+            self.assertEqual(cache.get('k'), [1, 2, 3])
+
+    def test_lru_eviction(self):
+        with DiskCache(self.path, max_bytes=25) as cache:
+            cache.put('a', 'x' * 8)
+            time.sleep(0.01)
+            cache.put('b', 'y' * 8)
+            time.sleep(0.01)
+            cache.get('a')  # 'b' is now least recently used
+            time.sleep(0.01)
+            cache.put('c', 'z' * 8)
+            self.assertIsNone(cache.get('b'))
+            self.assertIsNotNone(cache.get('a'))
+            self.assertIsNotNone(cache.get('c'))
+
+    def test_ttl_expiry(self):
+        with DiskCache(self.path, ttl=60) as cache:
+            cache.put('k', 'v')
+            self.assertEqual(cache.get('k'), 'v')
+            with patch('cache.time.time', return_value=time.time() + 120):
+                self.assertIsNone(cache.get('k'))
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
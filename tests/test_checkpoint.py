@@ -0,0 +1,104 @@
+"""
+Unit tests for checkpoint.py
+Tests appending Step 2 scores and resuming an interrupted run
+"""
+import unittest
+import sys
+import os
+import tempfile
+import shutil
+from contextlib import redirect_stdout, redirect_stderr
+from io import StringIO
+from unittest.mock import patch
+
+# Add src to path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import main
+from checkpoint import load_checkpoint, CheckpointWriter
+from manifest import student_fingerprint
+from records import Student
+
+
+class TestCheckpoint(unittest.TestCase):
+    """Test checkpoint writes and loads"""
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.test_dir, 'run', 'comparisons.ckpt.jsonl')
+        self.fingerprints = {
+            'alice': student_fingerprint("mov a, #1h", "0102"),
+            'bob': student_fingerprint("mov a, #2h", "0103"),
+            'carol': student_fingerprint("", ""),
+        }
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def test_round_trip(self):
+        with CheckpointWriter(self.path, self.fingerprints, batch_size=2) as writer:
+            writer.add('alice', 'bob', (0.5, 0.75, 0.8))
+            writer.add('alice', 'carol', (0, 0, 0))
+            writer.add('bob', 'carol', (0, 0, 0))
+        scores = load_checkpoint(self.path, self.fingerprints)
+        self.assertEqual(scores, {('alice', 'bob'): (0.5, 0.75, 0.8),
+                                  ('alice', 'carol'): (0, 0, 0), ('bob', 'carol'): (0, 0, 0)})
+
+    def test_batches_written_before_close(self):
+        writer = CheckpointWriter(self.path, self.fingerprints, batch_size=2)
+        writer.add('alice', 'bob', (0.5, 0.75, 0.8))
+        self.assertEqual(load_checkpoint(self.path, self.fingerprints), {})
+        writer.add('alice', 'carol', (0, 0, 0))
+        self.assertEqual(len(load_checkpoint(self.path, self.fingerprints)), 2)
+        writer.close()
+
+    def test_torn_last_line_ignored(self):
+        with CheckpointWriter(self.path, self.fingerprints, fsync='never') as writer:
+            writer.add('alice', 'bob', (0.5, 0.75, 0.8))
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write('["alice", "carol", 0.2')
+        self.assertEqual(list(load_checkpoint(self.path, self.fingerprints)), [('alice', 'bob')])
+
+    def test_changed_student_dropped(self):
+        with CheckpointWriter(self.path, self.fingerprints) as writer:
+            writer.add('alice', 'bob', (0.5, 0.75, 0.8))
+            writer.add('alice', 'carol', (0, 0, 0))
+        fingerprints = dict(self.fingerprints, bob=student_fingerprint("mov a, #3h", "0103"))
+        self.assertEqual(list(load_checkpoint(self.path, fingerprints)), [('alice', 'carol')])
+        self.assertEqual(load_checkpoint(os.path.join(self.test_dir, 'missing'), fingerprints), {})
+
+    def test_resume_rebuilds_identical_results(self):
+        student_data = {}
+        for i in range(6):
+            source = " ".join(["mov", "a", ",", f"#{i % 3}h", "add", "a", ",", "r1"] * (i + 1))
+            student_data[f"s{i}"] = Student(f"s{i}", source=source, hex="0102030" + str(i % 2))
+
+        with redirect_stdout(StringIO()), redirect_stderr(StringIO()):
+            expected = main.score_pairs(student_data, cache_dir=None)
+
+            # Interrupt the run after 7 of the 15 pairs
+            calls = []
+            real = main.calculate_levenshtein_similarity
+
+            def interrupted(s1, s2):
+                calls.append(1)
+                if len(calls) > 7:
+                    raise KeyboardInterrupt
+                return real(s1, s2)
+
+            with patch('main.calculate_levenshtein_similarity', side_effect=interrupted):
+                with self.assertRaises(KeyboardInterrupt):
+                    main.score_pairs(student_data, cache_dir=None, checkpoint_path=self.path, checkpoint_batch=3)
+            fingerprints = {s: student_fingerprint(d.source, d.hex) for s, d in student_data.items()}
+            self.assertEqual(len(load_checkpoint(self.path, fingerprints)), 7)
+
+            with patch('main.calculate_combined_similarity', wraps=main.calculate_combined_similarity) as scored:
+                resumed = main.score_pairs(student_data, cache_dir=None, checkpoint_path=self.path, resume=True)
+            self.assertEqual(scored.call_count, 8)
+
+        self.assertEqual(resumed, expected)
+        self.assertFalse(os.path.exists(self.path))
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,112 @@
+"""
+Unit tests for cli.py
+Tests running the pipeline stage by stage through saved artifacts
+"""
+import unittest
+import sys
+import os
+import tempfile
+import shutil
+from contextlib import redirect_stdout, redirect_stderr
+from io import StringIO
+from unittest.mock import patch
+
+# Add src to path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from cli import main
+from artifacts import load_artifact
+
+
+class TestStagedCli(unittest.TestCase):
+    """Test the ingest -> score -> analyze stages"""
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.lab = os.path.join(self.test_dir, 'Lab 1')
+        self.run_dir = os.path.join(self.test_dir, 'run')
+        for student, value in (('alice', '1'), ('bob', '1'), ('carol', '2')):
+            os.makedirs(os.path.join(self.lab, student))
+            with open(os.path.join(self.lab, student, 'main.a51'), 'w') as f:
+                f.write(f"MOV A, #{value}H\nMOV P1, A\nSJMP $\nEND\n")
+            with open(os.path.join(self.lab, student, 'main.hex'), 'w') as f:
+                f.write(":0300000074" + value.zfill(2) + "F500\n:00000001FF\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def run_cli(self, *argv):
+        with redirect_stdout(StringIO()), redirect_stderr(StringIO()):
+            return main(['--run-dir', self.run_dir, *argv])
+
+    def test_stages(self):
+        self.run_cli('ingest', self.lab, '--workers', '1', '--no-cache')
+        self.run_cli('score', '--no-cache')
+        comparisons, params = load_artifact(self.run_dir, 'score')
+        self.assertEqual(len(comparisons), 3)
+        self.assertEqual(params['root_path'], os.path.abspath(self.lab))
+
+        # Only the identical pair passes; it is decided without the LLM
+        self.run_cli('analyze', '--src-threshold', '0.99', '--hex-threshold', '0.99', '--no-llm-cache')
+        data, params = load_artifact(self.run_dir, 'analyze')
+        self.assertEqual([{r['student1'], r['student2']} for r in data['results']], [{'alice', 'bob'}])
+        self.assertNotIn('source_code1', data['results'][0])
+        self.assertEqual(data['results'][0]['final_verdict'], "抄襲")
+        self.assertEqual(params['src_threshold'], 0.99)
+
+    def test_debug_log_in_run_dir(self):
+        cwd_log = os.path.join(os.getcwd(), 'debug.log')
+        existed = os.path.exists(cwd_log)
+        for _ in range(2):
+            self.run_cli('ingest', self.lab, '--workers', '1', '--no-cache')
+        with open(os.path.join(self.run_dir, 'debug.log'), encoding='utf-8') as f:
+            self.assertEqual(f.read().count("DEBUG: Student"), 3)  # Replaced by each ingest run
+        self.assertEqual(os.path.exists(cwd_log), existed)
+
+    def test_crawl_limits(self):
+        os.makedirs(os.path.join(self.lab, 'alice', 'old'))
+        with open(os.path.join(self.lab, 'alice', 'old', 'main.a51'), 'w') as f:
+            f.write("MOV A, #3H\n")
+        self.run_cli('ingest', self.lab, '--workers', '1', '--no-cache', '--ignore', 'OLD')
+        data, params = load_artifact(self.run_dir, 'ingest')
+        self.assertNotIn('MOV A, #3H', data['alice']['original_source'])
+        self.assertEqual(params['crawl_limits']['ignore'][-1], 'OLD')
+        self.run_cli('ingest', self.lab, '--workers', '1', '--no-cache', '--max-depth', '1')
+        data, _ = load_artifact(self.run_dir, 'ingest')
+        self.assertNotIn('MOV A, #3H', data['alice']['original_source'])
+        self.run_cli('ingest', self.lab, '--workers', '1', '--no-cache')
+        data, _ = load_artifact(self.run_dir, 'ingest')
+        self.assertIn('MOV A, #3H', data['alice']['original_source'])
+
+    def test_stage_order(self):
+        with self.assertRaises(SystemExit):
+            self.run_cli('score')
+
+    def test_stale_artifacts_rejected(self):
+        self.run_cli('ingest', self.lab, '--workers', '1', '--no-cache')
+        self.run_cli('score', '--no-cache')
+        self.run_cli('analyze', '--no-llm-cache')
+        # Step 1 rerun alone after a student was removed
+        shutil.rmtree(os.path.join(self.lab, 'carol'))
+        self.run_cli('ingest', self.lab, '--workers', '1', '--no-cache')
+
+        for stage in ('analyze', 'report'):
+            stderr = StringIO()
+            with redirect_stdout(StringIO()), redirect_stderr(stderr), self.assertRaises(SystemExit):
+                main(['--run-dir', self.run_dir, stage])
+            self.assertIn("Stale artifact", stderr.getvalue())
+
+        # Unchanged Step 1 output is not stale
+        self.run_cli('score', '--no-cache')
+        self.run_cli('ingest', self.lab, '--workers', '1', '--no-cache')
+        self.run_cli('analyze', '--no-llm-cache')
+
+    def test_bugs_not_reported_as_usage_errors(self):
+        self.run_cli('ingest', self.lab, '--workers', '1', '--no-cache')
+        self.run_cli('score', '--no-cache')
+        with patch('cli.filter_pairs', side_effect=ValueError("bug")), self.assertRaises(ValueError):
+            self.run_cli('analyze', '--no-llm-cache')
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
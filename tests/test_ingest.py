@@ -0,0 +1,197 @@
+"""
+Unit tests for ingest.py
+Tests the Step 1 pipeline: serial and parallel ingestion must produce identical student_data
+"""
+import unittest
+import sys
+import os
+import tempfile
+import shutil
+import mmap
+from unittest.mock import patch
+
+# Add src to path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import loader
+from preprocessor import crawl_directory
+from ingest import ingest_students, preprocess_files
+from allowlist import text_hash
+
+
+ASM_CODE = "ORG 0000H\r\nMAIN: MOV A, #0x55 ; 註解\r\nMOV P1, A\r\nSJMP MAIN\r\nEND\r\n"
+HEX_CODE = ":03000000020003F8\n:00000001FF\n"
+
+
+class TestIngestStudents(unittest.TestCase):
+    """Test Step 1 ingestion"""
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.root = os.path.join(self.test_dir, 'lab')
+        for i in range(6):
+            student_dir = os.path.join(self.root, f'student{i}')
+            os.makedirs(student_dir)
+            encoding = 'cp950' if i % 2 else 'utf-8'
+            with open(os.path.join(student_dir, 'main.a51'), 'wb') as f:
+                f.write((ASM_CODE + f"MOV R{i}, #{i}\r\n").encode(encoding))
+            if i != 3:
+                with open(os.path.join(student_dir, 'main.hex'), 'w') as f:
+                    f.write(HEX_CODE)
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def test_parallel_matches_serial(self):
+        student_files = crawl_directory(self.root)
+        serial, _ = ingest_students(student_files, workers=1)
+        parallel, _ = ingest_students(student_files, workers=2)
+        self.assertEqual(serial, parallel)
+        self.assertEqual(list(serial), list(parallel))
+
+    def test_large_sources_memory_mapped(self):
+        student_files = crawl_directory(self.root)
+        expected, _ = ingest_students(student_files, workers=1)
+        with patch.object(loader, 'MMAP_THRESHOLD', 1), \
+                patch('loader.mmap.mmap', wraps=mmap.mmap) as mock_mmap:
+            mapped, _ = ingest_students(student_files, workers=1)
+        self.assertEqual(mock_mmap.call_count, 6)  # One per source file; hex files are kept as bytes
+        self.assertEqual(mapped, expected)
+
+    def test_latin1_fallback_not_carried_forward(self):
+        student_dir = os.path.join(self.test_dir, 'mixed')
+        os.makedirs(student_dir)
+        paths = [os.path.join(student_dir, name) for name in ('a.a51', 'b.a51')]
+        with open(paths[0], 'wb') as f:
+            f.write(b"MOV A, #1 ; \xff\xfe\r\n")  # Neither UTF-8 nor Big5
+        with open(paths[1], 'wb') as f:
+            f.write("DELAY: MOV R7, #0x10 ; 延遲副程式\r\n".encode('cp950'))
+        files = {'source': paths, 'hex': [], 'all_files': paths, 'skipped': []}
+        student_data, _ = ingest_students({'mixed': files}, workers=1)
+        self.assertIn("延遲副程式", student_data['mixed'].original_source)
+
+    def test_sampled_file_offsets(self):
+        student_dir = os.path.join(self.test_dir, 'huge')
+        os.makedirs(student_dir)
+        path = os.path.join(student_dir, 'main.a51')
+        with open(path, 'w') as f:
+            f.write(''.join(f"MOV R{i % 8}, #{i}\n" for i in range(1000)))
+        files = {'source': [path], 'hex': [], 'all_files': [path], 'skipped': []}
+        student_data, _ = ingest_students({'huge': files}, workers=1, guard_policy='sample', max_source_chars=800)
+        entry = student_data['huge']
+        self.assertEqual(entry.source_anomalies[0]['details']['policy'], 'sample')
+        # Line i + 1 of the submitted file is "MOV RN, #i"
+        lines = [(int(token[1:]), entry.source_offsets[3 * k + 1])
+                 for k, token in enumerate(entry.source.split()) if token.startswith('#')]
+        self.assertGreater(lines[-1][0], 875)
+        self.assertTrue(all(line == value + 1 for value, line in lines))
+
+    def test_student_entry(self):
+        student_data, stats = ingest_students(crawl_directory(self.root), workers=1)
+        entry = student_data['student1']
+        self.assertIn('mov a, #55h', entry.source)
+        self.assertEqual(entry.source, entry.asm_source)
+        self.assertIn('註解', entry.original_source)
+        self.assertEqual(entry.hex, '020003')
+        self.assertFalse(entry.illegal_submission)
+        self.assertEqual(stats['files'], 11)
+
+    def test_source_offsets(self):
+        student_data, _ = ingest_students(crawl_directory(self.root), workers=1)
+        entry = student_data['student1']
+        tokens = entry.source.split()
+        self.assertEqual(len(entry.source_offsets), 3 * len(tokens))
+        # Second token of the file is "main:" on line 2, column 1
+        self.assertEqual(tokens[2], 'main:')
+        self.assertEqual(list(entry.source_offsets[6:9]), [0, 2, 1])
+
+    def test_cached_run_matches_uncached(self):
+        student_files = crawl_directory(self.root)
+        cache_dir = os.path.join(self.test_dir, 'cache')
+        uncached, _ = ingest_students(student_files, workers=1)
+        first, stats1 = ingest_students(student_files, workers=1, cache_dir=cache_dir)
+        second, stats2 = ingest_students(student_files, workers=1, cache_dir=cache_dir)
+        self.assertEqual(uncached, first)
+        self.assertEqual(uncached, second)
+        self.assertGreater(stats1['cache_misses'], 0)
+        self.assertEqual(stats2['cache_hits'], 11)
+        self.assertEqual(stats2['cache_misses'], 0)
+
+    def test_oversized_source_guarded(self):
+        with open(os.path.join(self.root, 'student0', 'listing.a51'), 'w') as f:
+            f.write("MOV A, #1\n" * 5000)
+        student_data, _ = ingest_students(crawl_directory(self.root), workers=1,
+                                          max_source_chars=1000, max_student_tokens=300)
+        entry = student_data['student0']
+        codes = [a['code'] for a in entry.source_anomalies]
+        self.assertIn('OVERSIZED_FILE', codes)
+        self.assertIn('TOKEN_BUDGET_EXCEEDED', codes)
+        self.assertEqual(len(entry.source.split()), 300)
+        self.assertLess(len(entry.original_source), 2000)
+
+    def test_fingerprint_policy_skips_file(self):
+        with open(os.path.join(self.root, 'student0', 'listing.a51'), 'w') as f:
+            f.write("MOV A, #1\n" * 5000)
+        student_data, _ = ingest_students(crawl_directory(self.root), workers=1,
+                                          guard_policy='fingerprint', max_source_chars=1000)
+        entry = student_data['student0']
+        self.assertNotIn('listing.a51', entry.original_source)
+        guard = [a for a in entry.source_anomalies if a['code'] == 'OVERSIZED_FILE'][0]
+        self.assertEqual(guard['details']['file'], 'listing.a51')
+        self.assertEqual(len(guard['details']['sha256']), 64)
+
+    def test_allowlisted_files_dropped(self):
+        startup = "; STARTUP.A51\r\nCSEG AT 0\r\nLJMP STARTUP1\r\nEND\r\n"
+        for i in (0, 1):
+            with open(os.path.join(self.root, f'student{i}', 'STARTUP.A51'), 'wb') as f:
+                f.write(startup.encode('utf-8'))
+        allowlist = {text_hash(startup.replace('\r\n', '\n')): 'STARTUP.A51'}
+        with_vendor, _ = ingest_students(crawl_directory(self.root), workers=1)
+        student_data, _ = ingest_students(crawl_directory(self.root), workers=1, allowlist=allowlist)
+        entry = student_data['student0']
+        self.assertEqual(len(entry.excluded_files), 1)
+        self.assertEqual(entry.excluded_files[0]['reference'], 'STARTUP.A51')
+        self.assertNotIn('startup1', entry.source)
+        self.assertNotIn('STARTUP', entry.original_source)
+        self.assertLess(len(entry.source), len(with_vendor['student0'].source))
+        self.assertEqual(student_data['student2'].excluded_files, [])
+
+    def test_only_allowlisted_sources_is_illegal(self):
+        startup = "; STARTUP.A51\nCSEG AT 0\nLJMP STARTUP1\nEND\n"
+        os.remove(os.path.join(self.root, 'student0', 'main.a51'))
+        with open(os.path.join(self.root, 'student0', 'STARTUP.A51'), 'w') as f:
+            f.write(startup)
+        allowlist = {text_hash(startup): 'STARTUP.A51'}
+        student_data, _ = ingest_students(crawl_directory(self.root), workers=1, allowlist=allowlist)
+        entry = student_data['student0']
+        self.assertTrue(entry.illegal_submission)
+        self.assertIn('STARTUP.A51', entry.illegal_reason)
+        anomaly = [a for a in entry.source_anomalies if a['code'] == 'ONLY_REFERENCE_FILES'][0]
+        self.assertEqual([f['reference'] for f in anomaly['details']['files']], ['STARTUP.A51'])
+        self.assertEqual(entry.source, "")
+        self.assertFalse(student_data['student1'].illegal_submission)
+
+    def test_missing_hex_is_illegal(self):
+        student_data, _ = ingest_students(crawl_directory(self.root), workers=1)
+        self.assertTrue(student_data['student3'].illegal_submission)
+        self.assertIn('hex', student_data['student3'].illegal_reason)
+
+
+class TestPreprocessFiles(unittest.TestCase):
+    """Test the worker function"""
+
+    def test_source_and_hex_jobs(self):
+        results = preprocess_files([
+            ('source', '.a51', "; 註解\nMOV A, #0x1"),
+            ('source', '.txt', "notes"),
+            ('hex', '.hex', HEX_CODE.encode('ascii')),
+        ])
+        self.assertEqual(results[0]['cleaned'], "mov a, #1h")
+        self.assertIn('anomalies', results[0])
+        self.assertIsNone(results[1]['cleaned'])
+        self.assertEqual(results[2]['hex'], '020003')
+        self.assertTrue(results[2]['hex_info']['has_eof'])
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,451 @@
+"""
+Unit tests for llm_analyzer.py
+Tests rate limiting, retries, the circuit breaker and the concurrent analyzer (no network access)
+"""
+import unittest
+import sys
+import os
+import asyncio
+import random
+import time
+from contextlib import redirect_stdout
+from io import StringIO
+from types import SimpleNamespace
+from unittest.mock import patch
+
+# Add src to path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import llm_analyzer
+import llm_backends
+from llm_analyzer import (
+    TokenBucket, call_with_retries, is_retryable, classify_error, analyze_pair_with_llm_async,
+    AsyncLLMAnalyzer, LLMClient, parse_llm_response, llm_cache_key, is_llm_error, _api_error,
+    build_llm_prompt, get_llm_prompt, estimate_tokens, group_llm_batches, parse_batch_response,
+    LLMBudget, BUDGET_SKIPPED
+)
+
+
+class ApiError(Exception):
+    def __init__(self, code):
+        super().__init__(f"HTTP {code}")
+        self.code = code
+
+
+class FakeModel:
+    """GenerativeModel stand-in raising the queued errors before replying"""
+
+    def __init__(self, errors=(), batch_reply=None):
+        self.errors = list(errors)
+        self.batch_reply = batch_reply
+        self.calls = 0
+        self.batch_prompts = []
+
+    def reply(self, prompt, generation_config):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        if generation_config:
+            self.batch_prompts.append(prompt)
+            return SimpleNamespace(text=self.batch_reply(prompt))
+        return SimpleNamespace(text='{"is_plagiarized": true, "reasoning": "ok"}')
+
+    def generate_content(self, prompt, request_options=None, generation_config=None):
+        return self.reply(prompt, generation_config)
+
+    async def generate_content_async(self, prompt, generation_config=None):
+        return self.reply(prompt, generation_config)
+
+
+def fake_genai(model):
+    return SimpleNamespace(configure=lambda api_key: None, GenerativeModel=lambda name: model)
+
+
+class TestRetries(unittest.TestCase):
+    """Test backoff on throttling and server errors"""
+
+    def test_retryable(self):
+        self.assertTrue(is_retryable(ApiError(429)))
+        self.assertTrue(is_retryable(ApiError(503)))
+        self.assertTrue(is_retryable(asyncio.TimeoutError()))
+        self.assertFalse(is_retryable(ApiError(400)))
+        self.assertFalse(is_retryable(ValueError("bad")))
+
+    def test_classify(self):
+        self.assertEqual(classify_error(ApiError(429)), 'throttled')
+        self.assertEqual(classify_error(ApiError(403)), 'auth')
+        self.assertEqual(classify_error(ApiError(404)), 'client')
+        self.assertEqual(classify_error(ApiError(502)), 'server')
+        self.assertEqual(classify_error(TimeoutError()), 'timeout')
+        self.assertEqual(classify_error(ConnectionResetError()), 'network')
+        self.assertEqual(classify_error(ValueError("bad")), 'unknown')
+
+    def test_retries_then_succeeds(self):
+        errors = [ApiError(429), ApiError(500)]
+
+        async def request():
+            if errors:
+                raise errors.pop(0)
+            return "ok"
+
+        result = asyncio.run(call_with_retries(request, backoff_base=0.001))
+        self.assertEqual(result, "ok")
+        self.assertEqual(errors, [])
+
+    def test_gives_up(self):
+        calls = []
+
+        async def request():
+            calls.append(1)
+            raise ApiError(503)
+
+        with self.assertRaises(ApiError):
+            asyncio.run(call_with_retries(request, max_retries=2, backoff_base=0.001))
+        self.assertEqual(len(calls), 3)
+
+    def test_client_error_not_retried(self):
+        calls = []
+
+        async def request():
+            calls.append(1)
+            raise ApiError(400)
+
+        with self.assertRaises(ApiError):
+            asyncio.run(call_with_retries(request, backoff_base=0.001))
+        self.assertEqual(len(calls), 1)
+
+    def test_timeout(self):
+        async def request():
+            await asyncio.sleep(1)
+
+        with self.assertRaises(asyncio.TimeoutError):
+            asyncio.run(call_with_retries(request, timeout=0.01, max_retries=1, backoff_base=0.001))
+
+
+class TestLLMClient(unittest.TestCase):
+    """Test the shared client and its circuit breaker"""
+
+    def make_client(self, model, **kwargs):
+        with patch.object(llm_backends, 'genai', fake_genai(model)):
+            return LLMClient(api_key="test", max_retries=0, **kwargs)
+
+    def test_model_created_once(self):
+        created = []
+        genai = SimpleNamespace(configure=lambda api_key: None,
+                                GenerativeModel=lambda name: created.append(name) or FakeModel())
+        with patch.object(llm_backends, 'genai', genai):
+            client = LLMClient(api_key="test")
+        for _ in range(3):
+            self.assertTrue(client.analyze("mov a", "mov b")['is_plagiarized'])
+        self.assertEqual(created, [llm_analyzer.LLM_MODEL])
+        self.assertEqual(client.requests, 3)
+
+    def test_breaker_opens_after_consecutive_failures(self):
+        model = FakeModel([ApiError(503)] * 10)
+        client = self.make_client(model, failure_threshold=3)
+        with redirect_stdout(StringIO()):
+            results = [client.analyze("a", "b") for _ in range(5)]
+        self.assertTrue(all(is_llm_error(r) for r in results[:3]))
+        self.assertEqual(results[3:], [None, None])
+        self.assertEqual(model.calls, 3)
+        self.assertTrue(client.breaker_open)
+        self.assertIn('circuit breaker open', client.summary())
+
+    def test_success_resets_failures(self):
+        model = FakeModel([ApiError(503), ApiError(503)])
+        client = self.make_client(model, failure_threshold=3)
+        for _ in range(2):
+            client.analyze("a", "b")
+        self.assertTrue(client.analyze("a", "b")['is_plagiarized'])
+        self.assertEqual(client.consecutive_failures, 0)
+        self.assertFalse(client.breaker_open)
+
+    def test_auth_error_opens_at_once(self):
+        client = self.make_client(FakeModel([ApiError(401)]))
+        with redirect_stdout(StringIO()):
+            client.analyze("a", "b")
+        self.assertTrue(client.breaker_open)
+        self.assertIsNone(asyncio.run(client.analyze_async("a", "b")))
+
+    def test_client_errors_do_not_count(self):
+        client = self.make_client(FakeModel([ApiError(400)] * 5), failure_threshold=2)
+        for _ in range(5):
+            self.assertTrue(is_llm_error(client.analyze("a", "b")))
+        self.assertFalse(client.breaker_open)
+        self.assertEqual(client.errors, {'client': 5})
+
+    def test_async_retries(self):
+        model = FakeModel([ApiError(429)])
+        with patch.object(llm_backends, 'genai', fake_genai(model)):
+            client = LLMClient(api_key="test")
+        with patch('llm_analyzer.random.uniform', return_value=0.001):
+            self.assertTrue(asyncio.run(client.analyze_async("a", "b"))['is_plagiarized'])
+        self.assertEqual(model.calls, 2)
+
+
+def long_code(n, seed):
+    words = ["mov", "add", "inc", "djnz", "xrl", "anl", "subb"] + [f"r{i}" for i in range(8)] + \
+            [f"#{i}" for i in range(32)] + [f"l{i}:" for i in range(32)]
+    rng = random.Random(seed)
+    return ' '.join(rng.choice(words) for _ in range(n))
+
+
+class TestPromptBuilder(unittest.TestCase):
+    """Test token-budgeted, diff-focused prompts"""
+
+    def setUp(self):
+        self.code1 = long_code(3000, 1)
+        tokens = self.code1.split()
+        tokens[1500:1510] = ["setb", "p1.0"] * 3
+        self.code2 = ' '.join(tokens)
+
+    def test_short_pair_sent_in_full(self):
+        prompt, full_tokens = build_llm_prompt("mov a , #1", "mov a , #2")
+        self.assertEqual(prompt, get_llm_prompt("mov a , #1", "mov a , #2"))
+        self.assertEqual(full_tokens, estimate_tokens(prompt))
+
+    def test_long_pair_within_budget(self):
+        prompt, full_tokens = build_llm_prompt(self.code1, self.code2, budget=2000)
+        self.assertGreater(full_tokens, 2000)
+        self.assertLessEqual(estimate_tokens(prompt), 2000)
+        self.assertIn("左部分 3000 tokens，右部分 2996 tokens", prompt)
+        # The differing region is shown with both sides
+        self.assertIn("~ 左[1500:1510] 右[1500:1506]", prompt)
+        self.assertIn("右: setb p1.0 setb p1.0 setb p1.0", prompt)
+
+    def test_regions_omitted_past_budget(self):
+        tokens = self.code1.split()
+        tokens[::50] = ["setb"] * len(tokens[::50])
+        prompt, _ = build_llm_prompt(self.code1, ' '.join(tokens), budget=1000)
+        self.assertLessEqual(estimate_tokens(prompt), 1000)
+        self.assertIn("相異區段 60 段", prompt)
+        self.assertIn("因長度限制省略", prompt)
+
+    def test_estimate_tokens(self):
+        self.assertEqual(estimate_tokens("mov a, #1"), 3)
+        self.assertEqual(estimate_tokens("左部分"), 3)
+
+    def test_client_reports_saved_tokens(self):
+        client = TestLLMClient.make_client(None, FakeModel(), token_budget=2000)
+        client.analyze(self.code1, self.code2)
+        client.analyze("mov a", "mov b")
+        self.assertEqual(client.diff_prompts, 1)
+        self.assertLess(client.prompt_tokens, client.full_prompt_tokens)
+        self.assertIn(f"saved ~{client.full_prompt_tokens - client.prompt_tokens} of", client.summary())
+
+
+def ring(names):
+    return [(a, b) for i, a in enumerate(names) for b in names[i + 1:]]
+
+
+class TestBatching(unittest.TestCase):
+    """Test batched multi-pair requests"""
+
+    def test_groups_related_pairs(self):
+        pairs = [("x", "y")] + ring(["a", "b", "c", "d", "e"]) + [("y", "z")]
+        batches = group_llm_batches(pairs, batch_size=10)
+        # The ring of 5 (10 pairs) shares one request, the x-y-z chain another
+        self.assertEqual(batches, [[0, 11], list(range(1, 11))])
+        self.assertEqual(group_llm_batches(pairs, batch_size=4),
+                         [[0, 11], [1, 2, 3, 4], [5, 6, 7, 8], [9, 10]])
+
+    def test_long_pairs_not_batched(self):
+        long1, long2 = long_code(3000, 1), long_code(3000, 2)
+        pairs = [("a", "b"), ("c", "d"), (long1, long2)]
+        self.assertEqual(group_llm_batches(pairs, batch_size=10, budget=2000), [[0, 1], [2]])
+
+    def test_parse_maps_verdicts(self):
+        reply = """```json
+        {"verdicts": [
+            {"pair": "c2 - C1", "reasoning": "同", "is_plagiarized": true},
+            {"pair": ["C1", "C3"], "reasoning": "異", "is_plagiarized": "false"},
+            {"pair": "C1-C2", "reasoning": "重複", "is_plagiarized": false},
+            {"pair": "C9-C1", "reasoning": "未知", "is_plagiarized": true},
+            {"pair": "C2-C3", "reasoning": "缺少判定"}
+        ]}
+        ```"""
+        verdicts = parse_batch_response(reply, ["C1-C2", "C1-C3", "C2-C3"])
+        self.assertEqual(verdicts, {
+            "C1-C2": {"is_plagiarized": True, "reasoning": "同"},
+            "C1-C3": {"is_plagiarized": False, "reasoning": "異"},
+        })
+        self.assertEqual(parse_batch_response("not json", ["C1-C2"]), {})
+        self.assertEqual(parse_batch_response('[{"pair": "C1-C2", "is_plagiarized": true}]', ["C1-C2"]),
+                         {"C1-C2": {"is_plagiarized": True, "reasoning": ""}})
+
+    def make_client(self, batch_reply):
+        model = FakeModel(batch_reply=batch_reply)
+        with patch.object(llm_backends, 'genai', fake_genai(model)):
+            return LLMClient(api_key="test"), model
+
+    def test_missing_pairs_asked_one_at_a_time(self):
+        def reply(prompt):
+            # A verdict for the first pair only
+            return '{"verdicts": [{"pair": "C1-C2", "reasoning": "batch", "is_plagiarized": false}]}'
+
+        client, model = self.make_client(reply)
+        pairs = ring(["mov a", "mov b", "mov c"])
+        results = client.analyze_batch(pairs)
+        self.assertEqual([r['reasoning'] for r in results], ["batch", "ok", "ok"])
+        self.assertEqual(len(model.batch_prompts), 1)
+        # Each snippet is sent once, each pair listed once
+        self.assertEqual(model.batch_prompts[0].count("mov b"), 1)
+        self.assertIn("- C2-C3: C2 與 C3", model.batch_prompts[0])
+        self.assertEqual((client.requests, client.batched_pairs, client.batch_fallbacks), (3, 3, 2))
+
+        async_client, model = self.make_client(reply)
+        self.assertEqual(asyncio.run(async_client.analyze_batch_async(pairs)), results)
+
+    def test_failed_batch_returns_errors(self):
+        client, model = self.make_client(None)
+        model.errors = [ApiError(404)]
+        results = client.analyze_batch(ring(["a", "b", "c"]))
+        self.assertEqual(len(results), 3)
+        self.assertTrue(all(is_llm_error(r) for r in results))
+        self.assertEqual(model.calls, 1)
+
+    def test_submit_batch(self):
+        async def fake(pairs, limiter=None):
+            return [{'is_plagiarized': code1 == code2, 'reasoning': code1} for code1, code2 in pairs]
+
+        client = SimpleNamespace(analyze_batch_async=fake)
+        with AsyncLLMAnalyzer(client) as analyzer:
+            futures = analyzer.submit_batch([("a", "a"), ("b", "c")])
+            self.assertEqual([f.result(timeout=5)['is_plagiarized'] for f in futures], [True, False])
+
+
+class TestBudget(unittest.TestCase):
+    """Test the per-run cap on LLM requests, tokens and time"""
+
+    def make_client(self, budget):
+        with patch.object(llm_backends, 'genai', fake_genai(FakeModel(batch_reply=lambda prompt: '{"verdicts": []}'))):
+            return LLMClient(api_key="test", max_retries=0, budget=budget)
+
+    def test_request_limit(self):
+        budget = LLMBudget(max_requests=2)
+        self.assertEqual([budget.charge(10) for _ in range(3)], [True, True, False])
+        self.assertEqual(budget.exhausted, 'requests')
+
+    def test_token_limit_stays_exhausted(self):
+        budget = LLMBudget(max_tokens=100)
+        self.assertTrue(budget.charge(60))
+        self.assertFalse(budget.charge(60))
+        # A smaller request would fit, but the pairs after it are less suspicious
+        self.assertFalse(budget.charge(10))
+        self.assertEqual((budget.exhausted, budget.tokens), ('tokens', 60))
+
+    def test_time_limit(self):
+        budget = LLMBudget(max_seconds=0.02)
+        self.assertTrue(budget.charge(1))
+        time.sleep(0.05)
+        self.assertFalse(budget.charge(1))
+        self.assertEqual(budget.exhausted, 'time')
+
+    def test_client_skips_past_budget(self):
+        client = self.make_client(LLMBudget(max_requests=1))
+        self.assertTrue(client.analyze("a", "b")['is_plagiarized'])
+        self.assertEqual(client.analyze("a", "c"), BUDGET_SKIPPED)
+        self.assertEqual(client.analyze_batch([("a", "d"), ("a", "e")]), [BUDGET_SKIPPED] * 2)
+        # Never cached as a verdict
+        self.assertTrue(is_llm_error(BUDGET_SKIPPED))
+        self.assertEqual((client.requests, client.over_budget), (1, 3))
+        self.assertIn('requests budget used up, 3 pairs used the fallback', client.summary())
+
+
+class TestTokenBucket(unittest.TestCase):
+    """Test the request rate limiter"""
+
+    def test_rate(self):
+        async def run():
+            bucket = TokenBucket(rate=100, capacity=2)
+            start = time.monotonic()
+            for _ in range(6):
+                await bucket.acquire()
+            return time.monotonic() - start
+
+        # 2 requests in the burst, the other 4 at 100/s
+        elapsed = asyncio.run(run())
+        self.assertGreaterEqual(elapsed, 0.035)
+        self.assertLess(elapsed, 1.0)
+
+    def test_shared_by_sync_and_async(self):
+        bucket = TokenBucket(rate=100, capacity=2)
+        start = time.monotonic()
+        for _ in range(3):
+            bucket.acquire_sync()
+
+        async def run():
+            for _ in range(3):
+                await bucket.acquire()
+
+        asyncio.run(run())
+        # Both paths draw on the same bucket: 2 in the burst, the other 4 at 100/s
+        self.assertGreaterEqual(time.monotonic() - start, 0.035)
+
+
+class TestAsyncAnalyzer(unittest.TestCase):
+    """Test the concurrent analyzer"""
+
+    def test_unavailable_api_keeps_result_shape(self):
+        with patch.object(llm_backends, 'genai', None):
+            result = asyncio.run(analyze_pair_with_llm_async("mov a", "mov b"))
+        self.assertFalse(result['is_plagiarized'])
+        self.assertIn('not installed', result['reasoning'])
+
+    def test_bounded_concurrency(self):
+        in_flight = []
+        peak = []
+
+        async def fake(code1, code2, limiter=None):
+            in_flight.append(1)
+            peak.append(len(in_flight))
+            await asyncio.sleep(0.01)
+            in_flight.pop()
+            return {'is_plagiarized': code1 == code2, 'reasoning': code1}
+
+        client = SimpleNamespace(analyze_async=fake)
+        with AsyncLLMAnalyzer(client, concurrency=3) as analyzer:
+            futures = [analyzer.submit(str(i), str(i % 2)) for i in range(12)]
+            results = [f.result(timeout=5) for f in futures]
+        self.assertEqual([r['reasoning'] for r in results], [str(i) for i in range(12)])
+        self.assertEqual(max(peak), 3)
+
+    def test_parse_response(self):
+        self.assertEqual(parse_llm_response('```json\n{"is_plagiarized": true}\n```'), {'is_plagiarized': True})
+        self.assertEqual(parse_llm_response('Result: {"is_plagiarized": false} done'), {'is_plagiarized': False})
+        self.assertIn('Failed to parse', parse_llm_response('no json')['reasoning'])
+
+
+class TestVerdictCache(unittest.TestCase):
+    """Test cache keys and which results may be cached"""
+
+    def test_key_order_insensitive(self):
+        self.assertEqual(llm_cache_key("mov a", "mov b"), llm_cache_key("mov b", "mov a"))
+        self.assertNotEqual(llm_cache_key("mov a", "mov b"), llm_cache_key("mov a", "mov c"))
+
+    def test_key_includes_prompt_and_model(self):
+        key = llm_cache_key("mov a", "mov b")
+        self.assertNotEqual(key, llm_cache_key("mov a", "mov b", prompt_version=-1))
+        self.assertNotEqual(key, llm_cache_key("mov a", "mov b", model="other-model"))
+
+    def test_key_includes_prompt_budget_and_kind(self):
+        key = llm_cache_key("mov a", "mov b")
+        self.assertEqual(key, llm_cache_key("mov a", "mov b", kind='single'))
+        self.assertNotEqual(key, llm_cache_key("mov a", "mov b", token_budget=100))
+        self.assertNotEqual(key, llm_cache_key("mov a", "mov b", kind='batch'))
+        # A pair over the budget is sent as a diff-focused prompt
+        long1, long2 = "mov a , #1 " * 500, "mov a , #2 " * 500
+        self.assertEqual(llm_cache_key(long1, long2, token_budget=500),
+                         llm_cache_key(long1, long2, token_budget=500, kind='diff'))
+
+    def test_errors_detected(self):
+        self.assertFalse(is_llm_error({'is_plagiarized': False, 'reasoning': "邏輯不同"}))
+        self.assertTrue(is_llm_error(_api_error(RuntimeError("503"))))
+        self.assertTrue(is_llm_error(parse_llm_response("no json")))
+        self.assertTrue(is_llm_error({'reasoning': "missing verdict"}))
+        with patch.object(llm_backends, 'genai', None):
+            self.assertTrue(is_llm_error(asyncio.run(analyze_pair_with_llm_async("a", "b"))))
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
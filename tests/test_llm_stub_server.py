@@ -0,0 +1,141 @@
+"""
+Unit tests for llm_stub_server.py and llm_backends.HttpBackend
+Runs LLMClient against a local stub server (no network access)
+"""
+import unittest
+import sys
+import os
+import json
+import time
+import urllib.request
+from contextlib import redirect_stdout
+from io import StringIO
+from unittest.mock import patch
+
+# Add src to path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from llm_analyzer import LLMClient, AsyncLLMAnalyzer, is_llm_error
+from llm_backends import HttpBackend
+from llm_stub_server import StubConfig, start_stub_server
+
+
+class StubServerTestCase(unittest.TestCase):
+
+    def start(self, **config):
+        server = start_stub_server(StubConfig(seed=1, **config))
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return server
+
+    def client(self, server, **kwargs):
+        kwargs.setdefault('max_retries', 0)
+        return LLMClient(backend=HttpBackend(server.url), **kwargs)
+
+    def stats(self, server):
+        with urllib.request.urlopen(server.url + 'stats') as response:
+            return json.loads(response.read())
+
+
+class TestHttpBackend(StubServerTestCase):
+    """Test the HTTP/JSON backend against the stub"""
+
+    def test_single_verdict(self):
+        server = self.start()
+        client = self.client(server)
+        result = client.analyze("mov a , #1", "mov a , #2")
+        self.assertFalse(is_llm_error(result))
+        self.assertIn("Stub verdict", result['reasoning'])
+        # Verdicts are deterministic
+        self.assertEqual(client.analyze("mov a , #1", "mov a , #2"), result)
+        self.assertEqual(self.stats(server), {'requests': 2, 'ok': 2, 'errors': 0, 'throttled': 0})
+
+    def test_cache_key_names_endpoint(self):
+        server = self.start()
+        self.assertEqual(self.client(server).model_name, f"default@{server.url}")
+
+    def test_batch(self):
+        server = self.start()
+        pairs = [("a", "b"), ("a", "c"), ("b", "c")]
+        results = self.client(server).analyze_batch(pairs)
+        self.assertEqual(len(results), 3)
+        self.assertFalse(any(is_llm_error(r) for r in results))
+        self.assertEqual(self.stats(server)['requests'], 1)
+
+    def test_dropped_pairs_asked_again(self):
+        server = self.start(drop_rate=1.0)
+        client = self.client(server)
+        results = client.analyze_batch([("a", "b"), ("a", "c")])
+        self.assertFalse(any(is_llm_error(r) for r in results))
+        self.assertEqual(client.batch_fallbacks, 2)
+        self.assertEqual(self.stats(server)['requests'], 3)
+
+
+class TestFailureModes(StubServerTestCase):
+    """Test throttling, injected errors and latency"""
+
+    def test_throttled_then_retried(self):
+        server = self.start(rate_limit=20, burst=1)
+        client = self.client(server, max_retries=6)
+        with patch('llm_analyzer.random.uniform', return_value=0.05):
+            results = [client.analyze("a", str(i)) for i in range(3)]
+        self.assertFalse(any(is_llm_error(r) for r in results))
+        stats = self.stats(server)
+        self.assertEqual(stats['ok'], 3)
+        self.assertEqual(stats['requests'], 3 + stats['throttled'])
+
+    def test_client_limiter_avoids_throttling(self):
+        server = self.start(rate_limit=20, burst=1)
+        # One quota for inline and concurrent requests
+        client = self.client(server, requests_per_second=15, burst=1)
+        results = [client.analyze("a", str(i)) for i in range(3)]
+        with AsyncLLMAnalyzer(client, concurrency=4) as analyzer:
+            results += [f.result(timeout=5) for f in [analyzer.submit("b", str(i)) for i in range(4)]]
+        self.assertFalse(any(is_llm_error(r) for r in results))
+        self.assertEqual(self.stats(server)['throttled'], 0)
+
+    def test_default_rate_keeps_concurrency(self):
+        server = self.start(latency=0.2)
+        client = self.client(server)
+        start = time.monotonic()
+        with AsyncLLMAnalyzer(client, concurrency=4) as analyzer:
+            results = [f.result(timeout=5) for f in [analyzer.submit("a", str(i)) for i in range(12)]]
+        elapsed = time.monotonic() - start
+        self.assertFalse(any(is_llm_error(r) for r in results))
+        # One at a time would take 12 * 0.2s
+        self.assertLess(elapsed, 1.5)
+
+    def test_throttled_classified(self):
+        server = self.start(rate_limit=0.001, burst=1)
+        client = self.client(server)
+        client.analyze("a", "b")
+        self.assertTrue(is_llm_error(client.analyze("a", "c")))
+        self.assertEqual(client.errors, {'throttled': 1})
+
+    def test_errors_open_breaker(self):
+        server = self.start(error_rate=1.0)
+        client = self.client(server, failure_threshold=3)
+        with redirect_stdout(StringIO()):
+            results = [client.analyze("a", str(i)) for i in range(5)]
+        self.assertEqual(results[3:], [None, None])
+        self.assertEqual(client.errors, {'server': 3})
+        self.assertEqual(self.stats(server)['errors'], 3)
+
+    def test_timeout(self):
+        server = self.start(latency=1.0)
+        client = self.client(server, timeout=0.05)
+        self.assertTrue(is_llm_error(client.analyze("a", "b")))
+        self.assertEqual(list(client.errors), ['timeout'])
+
+    def test_concurrent_requests(self):
+        server = self.start(latency=0.1)
+        client = self.client(server)
+        with AsyncLLMAnalyzer(client, concurrency=8) as analyzer:
+            futures = [analyzer.submit("a", str(i)) for i in range(8)]
+            results = [f.result(timeout=5) for f in futures]
+        self.assertFalse(any(is_llm_error(r) for r in results))
+        self.assertEqual(self.stats(server)['ok'], 8)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,121 @@
+"""
+Unit tests for loader.py
+Tests read-once file loading, in-memory encoding detection and content hashing
+"""
+import unittest
+import sys
+import os
+import io
+import tempfile
+import shutil
+import tarfile
+import zipfile
+from unittest.mock import patch
+
+# Add src to path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import loader
+from loader import decode_content, load_text_file, hash_content, read_file_bytes, read_files_bytes
+
+
+class TestDecodeContent(unittest.TestCase):
+    """Test in-memory encoding detection"""
+
+    def test_utf8(self):
+        text, enc = decode_content("mov a, #55h ; 註解".encode('utf-8'))
+        self.assertEqual(text, "mov a, #55h ; 註解")
+        self.assertEqual(enc, 'utf-8')
+
+    def test_big5(self):
+        text, enc = decode_content("mov a, #55h ; 註解".encode('cp950'))
+        self.assertEqual(text, "mov a, #55h ; 註解")
+        self.assertEqual(enc, 'cp950')
+
+    def test_latin1_fallback(self):
+        text, enc = decode_content(b"mov a \xff\xfe")
+        self.assertEqual(enc, 'latin-1')
+
+    def test_utf8_preferred_over_remembered_encoding(self):
+        # A remembered Big5 encoding must not turn UTF-8 files into garbage
+        text, enc = decode_content("註解".encode('utf-8'), preferred_encoding='cp950')
+        self.assertEqual(text, "註解")
+        self.assertEqual(enc, 'utf-8')
+
+    def test_fallback_encoding_not_preferred(self):
+        # A student's earlier latin-1 fallback must not turn their Big5 files into mojibake
+        text, enc = decode_content("; 延遲副程式".encode('cp950'), preferred_encoding='latin-1')
+        self.assertEqual(text, "; 延遲副程式")
+        self.assertEqual(enc, 'cp950')
+
+    def test_line_endings_normalized(self):
+        text, _ = decode_content(b"mov a\r\nadd a\rret")
+        self.assertEqual(text, "mov a\nadd a\nret")
+
+
+class TestLoadTextFile(unittest.TestCase):
+    """Test reading files from disk"""
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.test_dir, 'main.a51')
+        with open(self.path, 'wb') as f:
+            f.write("ORG 0000H ; 開始".encode('cp950'))
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def test_returns_text_hash_and_encoding(self):
+        text, content_hash, enc = load_text_file(self.path)
+        self.assertEqual(text, "ORG 0000H ; 開始")
+        self.assertEqual(content_hash, hash_content("ORG 0000H ; 開始".encode('cp950')))
+        self.assertEqual(enc, 'cp950')
+
+    def test_file_opened_once(self):
+        with patch('builtins.open', wraps=open) as mock_open:
+            load_text_file(self.path)
+            self.assertEqual(mock_open.call_count, 1)
+
+    def test_mmap_path_matches_read_path(self):
+        expected = load_text_file(self.path)
+        with patch.object(loader, 'MMAP_THRESHOLD', 1):
+            self.assertEqual(load_text_file(self.path), expected)
+
+    def test_archive_member(self):
+        archive = os.path.join(self.test_dir, 'student.zip')
+        with zipfile.ZipFile(archive, 'w') as zf:
+            zf.writestr('lab/main.a51', "ORG 0000H ; 開始".encode('cp950'))
+        member_path = os.path.join(archive, 'lab', 'main.a51')
+        self.assertEqual(read_file_bytes(member_path), "ORG 0000H ; 開始".encode('cp950'))
+        text, _, enc = load_text_file(member_path)
+        self.assertEqual(text, "ORG 0000H ; 開始")
+        self.assertEqual(enc, 'cp950')
+
+    def test_archive_read_in_one_pass(self):
+        archive = os.path.join(self.test_dir, 'student.tar.gz')
+        with tarfile.open(archive, 'w:gz') as tf:
+            for name in ('main.a51', 'util.a51', 'main.hex'):
+                data = name.encode('utf-8')
+                info = tarfile.TarInfo(f'lab/{name}')
+                info.size = len(data)
+                tf.addfile(info, io.BytesIO(data))
+        members = [os.path.join(archive, 'lab', name) for name in ('main.hex', 'main.a51', 'util.a51', 'gone.a51')]
+        missing = os.path.join(self.test_dir, 'missing.a51')
+
+        with patch('archives.tarfile.open', wraps=tarfile.open) as mock_open:
+            contents = read_files_bytes(members + [self.path, missing])
+            self.assertEqual(mock_open.call_count, 1)
+        self.assertEqual([contents[path] for path in members[:3]], [b'main.hex', b'main.a51', b'util.a51'])
+        self.assertIsInstance(contents[members[3]], OSError)
+        self.assertEqual(contents[self.path], "ORG 0000H ; 開始".encode('cp950'))
+        self.assertIsInstance(contents[missing], OSError)
+
+    def test_missing_file(self):
+        text, content_hash, enc = load_text_file(os.path.join(self.test_dir, 'missing.a51'))
+        self.assertEqual(text, "")
+        self.assertIsNone(content_hash)
+        self.assertIsNone(enc)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,261 @@
+"""
+Unit tests for main.py
+Tests the streaming Step 2-4 pipeline
+"""
+import unittest
+import sys
+import os
+import asyncio
+import json
+import random
+import tempfile
+import threading
+from contextlib import ExitStack, redirect_stdout, redirect_stderr
+from io import StringIO
+from unittest.mock import patch
+
+# Add src to path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import main
+from main import iter_pair_scores, score_pairs, filter_pairs, analyze_pairs, pair_count
+from records import Student, PairResult
+from llm_analyzer import open_llm_cache, LLMClient, LLMBudget, BUDGET_SKIPPED
+
+
+def make_students(n):
+    students = {}
+    for i in range(n):
+        source = " ".join(["mov", "a", ",", f"#{i % 3}h", "add", "a", ",", "r1"] * (i % 4 + 1))
+        students[f"s{i}"] = Student(f"s{i}", source=source, hex="0102030" + str(i % 2))
+    return students
+
+
+class TestPairPipeline(unittest.TestCase):
+    """Test that the streaming pipeline matches the materialized one"""
+
+    def setUp(self):
+        # Silence the step messages and progress bars
+        self.quiet = ExitStack()
+        self.quiet.enter_context(redirect_stdout(StringIO()))
+        self.quiet.enter_context(redirect_stderr(StringIO()))
+
+    def tearDown(self):
+        self.quiet.close()
+
+    def test_top_percent_heap_matches_sort(self):
+        rng = random.Random(0)
+        comparisons = []
+        for i in range(500):
+            # Few distinct values, so many ties
+            token_seq, levenshtein = rng.choice([0.2, 0.5, 0.8]), rng.choice([0.25, 0.5, 1.0])
+            comparisons.append(PairResult(f"a{i}", f"b{i}", {'token_seq': token_seq, 'levenshtein': levenshtein},
+                                          0, 0, (token_seq + levenshtein) / 2.0))
+        for metric in ('avg_score', 'token_seq', 'levenshtein'):
+            expected_key = {
+                'avg_score': lambda c: c.avg_score,
+                'token_seq': lambda c: c.source_similarity['token_seq'],
+                'levenshtein': lambda c: c.source_similarity['levenshtein'],
+            }[metric]
+            expected = sorted(comparisons, key=expected_key, reverse=True)[:25]
+            streamed = filter_pairs(iter(comparisons), 'top_percent', top_metric=metric, top_percent=0.05,
+                                    total_pairs=len(comparisons))
+            self.assertEqual([(c.student1, c.student2) for c in streamed],
+                             [(c.student1, c.student2) for c in expected])
+
+    def test_threshold_filters_while_scoring(self):
+        students = make_students(6)
+        scored = []
+
+        def tracked():
+            for comp in iter_pair_scores(students, cache_dir=None):
+                scored.append(comp)
+                yield comp
+
+        filtered = filter_pairs(tracked(), 'threshold', hex_threshold=0.99, src_threshold=0.5)
+        first = next(filtered)
+        # The first suspicious pair is available before all pairs are scored
+        self.assertLess(len(scored), pair_count(len(students)))
+        rest = list(filtered)
+
+        expected = [c for c in score_pairs(students, cache_dir=None)
+                    if c.max_hex_sim > 0.99 or c.avg_score > 0.5]
+        self.assertEqual([first] + rest, expected)
+
+    def test_step_banners_in_order(self):
+        students = make_students(6)
+        llm = FakeClient(lambda code1, code2: {'is_plagiarized': False, 'reasoning': ""})
+        for mode in ('threshold', 'top_percent'):
+            output = StringIO()
+            with redirect_stdout(output):
+                filtered = filter_pairs(iter_pair_scores(students, cache_dir=None), mode, 0.5, 0.3,
+                                        total_pairs=pair_count(len(students)))
+                analyze_pairs(filtered, students, llm_client=llm)
+            banners = [line[:6] for line in output.getvalue().splitlines() if line.startswith("Step")]
+            self.assertEqual(banners, ["Step 2", "Step 3", "Step 4"])
+
+
+class FakeClient:
+    """LLMClient stand-in calling llm(code1, code2)"""
+
+    token_budget = 6000
+    model_name = "fake"
+
+    def __init__(self, llm):
+        self.llm = llm
+        self.batches = []
+
+    def analyze(self, code1, code2):
+        return self.llm(code1, code2)
+
+    async def analyze_async(self, code1, code2, limiter=None):
+        return await asyncio.get_running_loop().run_in_executor(None, self.llm, code1, code2)
+
+    def analyze_batch(self, pairs):
+        self.batches.append(len(pairs))
+        return [self.llm(code1, code2) for code1, code2 in pairs]
+
+    async def analyze_batch_async(self, pairs, limiter=None):
+        return self.analyze_batch(pairs)
+
+    def summary(self):
+        return ""
+
+
+class FakeBackend:
+    """llm_backends backend stand-in judging every pair plagiarized"""
+
+    name = "fake"
+    unavailable = None
+
+    def __init__(self):
+        self.prompts = []
+
+    def generate(self, prompt, timeout, schema=None):
+        self.prompts.append(prompt)
+        return json.dumps({'is_plagiarized': True, 'reasoning': "ok"})
+
+    async def generate_async(self, prompt, timeout, schema=None):
+        return self.generate(prompt, timeout, schema)
+
+
+class TestAnalyzePairs(unittest.TestCase):
+    """Test LLM calls overlapped with scoring"""
+
+    def setUp(self):
+        self.quiet = ExitStack()
+        self.quiet.enter_context(redirect_stdout(StringIO()))
+        self.quiet.enter_context(redirect_stderr(StringIO()))
+        self.students = make_students(8)
+        self.students['s3'].illegal_submission = True
+
+    def tearDown(self):
+        self.quiet.close()
+
+    def fake_llm(self, code1, code2):
+        return {'is_plagiarized': len(code1) == len(code2), 'reasoning': f"{len(code1)} vs {len(code2)}"}
+
+    def run_pipeline(self, llm_workers, llm, client=None, **kwargs):
+        comparisons = main.iter_pair_scores(self.students, cache_dir=None)
+        filtered = filter_pairs(comparisons, 'threshold', hex_threshold=0.5, src_threshold=0.3)
+        return analyze_pairs(filtered, self.students, llm_workers=llm_workers, llm_client=client or FakeClient(llm),
+                             **kwargs)
+
+    def test_background_matches_inline(self):
+        inline = self.run_pipeline(0, self.fake_llm)
+        self.assertTrue(any(r.llm_triggered for r in inline))
+        self.assertEqual(self.run_pipeline(4, self.fake_llm), inline)
+
+    def test_batched_matches_single(self):
+        single = self.run_pipeline(0, self.fake_llm)
+        for llm_workers in (0, 2):
+            client = FakeClient(self.fake_llm)
+            self.assertEqual(self.run_pipeline(llm_workers, None, client, llm_batch_size=4), single)
+            self.assertEqual(sum(client.batches), sum(r.llm_triggered for r in single))
+            self.assertLessEqual(max(client.batches), 4)
+            self.assertGreater(max(client.batches), 1)
+
+    def test_budget_sends_most_suspicious_first(self):
+        for llm_workers in (0, 2):
+            backend = FakeBackend()
+            results = self.run_pipeline(llm_workers, None, LLMClient(backend=backend),
+                                        llm_budget=LLMBudget(max_requests=2))
+            triggered = [r for r in results if r.llm_triggered]
+            self.assertGreater(len(triggered), 2)
+            self.assertEqual(len(backend.prompts), 2)
+
+            judged = [r for r in triggered if r.llm_analysis != BUDGET_SKIPPED]
+            skipped = [r for r in triggered if r.llm_analysis == BUDGET_SKIPPED]
+            self.assertEqual(len(judged), 2)
+            # Pairs of the illegal s3 are explained as invalid submissions instead
+            legal_skipped = [r for r in skipped if 's3' not in (r.student1, r.student2)]
+            self.assertTrue(legal_skipped)
+            self.assertTrue(all(r.verdict_reason.startswith("LLM預算已用完") for r in legal_skipped))
+            self.assertGreaterEqual(min(main.llm_priority(r) for r in judged),
+                                    max(main.llm_priority(r) for r in skipped))
+
+    def test_llm_calls_overlap_scoring(self):
+        scored = threading.Event()
+        real_scores = main.iter_pair_scores
+
+        def tracked(*args, **kwargs):
+            yield from real_scores(*args, **kwargs)
+            scored.set()
+
+        def slow_llm(code1, code2):
+            # Only returns once Step 2 has finished; inline calls would time out instead
+            return {'is_plagiarized': scored.wait(5), 'reasoning': ""}
+
+        with patch('main.iter_pair_scores', side_effect=tracked):
+            results = self.run_pipeline(2, slow_llm)
+        self.assertTrue(all(r.llm_analysis['is_plagiarized'] for r in results if r.llm_triggered))
+
+    def test_verdict_cache(self):
+        calls = []
+
+        def counting_llm(code1, code2):
+            calls.append(1)
+            return self.fake_llm(code1, code2)
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            for expected_calls in (True, False):
+                calls.clear()
+                with open_llm_cache(cache_dir) as llm_cache:
+                    comparisons = main.iter_pair_scores(self.students, cache_dir=None)
+                    filtered = filter_pairs(comparisons, 'threshold', hex_threshold=0.5, src_threshold=0.3)
+                    results = analyze_pairs(filtered, self.students, llm_cache=llm_cache,
+                                            llm_client=FakeClient(counting_llm))
+                self.assertEqual(bool(calls), expected_calls)
+                self.assertEqual(results, self.run_pipeline(0, self.fake_llm))
+
+    def test_errors_use_fallback(self):
+        def failing_llm(code1, code2):
+            return {"is_plagiarized": False, "reasoning": "LLM API Error: 503 Service Unavailable"}
+
+        results = self.run_pipeline(0, failing_llm)
+        legal = [r for r in results if r.llm_triggered and 's3' not in (r.student1, r.student2)]
+        self.assertTrue(legal)
+        for r in legal:
+            self.assertTrue(r.verdict_reason.startswith("LLM分析不可用 - 演算法分析"))
+            self.assertEqual(r.final_verdict, "抄襲" if r.avg_score > 0.85 else "未抄襲")
+
+    def test_errors_not_cached(self):
+        def failing_llm(code1, code2):
+            return {"is_plagiarized": False, "reasoning": "LLM API Error: 503 Service Unavailable"}
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            with open_llm_cache(cache_dir) as llm_cache:
+                client = FakeClient(failing_llm)
+                comparisons = main.iter_pair_scores(self.students, cache_dir=None)
+                analyze_pairs(filter_pairs(comparisons, 'threshold', 0.5, 0.3), self.students,
+                              llm_cache=llm_cache, llm_client=client)
+                # A second run asks again
+                comparisons = main.iter_pair_scores(self.students, cache_dir=None)
+                analyze_pairs(filter_pairs(comparisons, 'threshold', 0.5, 0.3), self.students,
+                              llm_cache=llm_cache, llm_client=client)
+                self.assertEqual(llm_cache.hits, 0)
+                self.assertGreater(llm_cache.misses, 0)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
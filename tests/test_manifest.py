@@ -0,0 +1,102 @@
+"""
+Unit tests for manifest.py
+Tests reuse of previous pair scores for incremental runs
+"""
+import unittest
+import sys
+import os
+import json
+import tempfile
+import shutil
+
+# Add src to path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from manifest import (
+    default_manifest_path, student_fingerprint, load_manifest, reusable_scores, save_manifest,
+    ManifestWriter
+)
+
+
+class TestManifest(unittest.TestCase):
+    """Test manifest round trips and score reuse"""
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.test_dir, 'manifests', 'lab.json')
+        self.fingerprints = {
+            'alice': student_fingerprint("mov a, #1h", "0102"),
+            'bob': student_fingerprint("mov a, #2h", "0103"),
+            'carol': student_fingerprint("", ""),
+        }
+        self.scores = {
+            ('alice', 'bob'): (0.5, 0.75, 0.8),
+            ('alice', 'carol'): (0, 0, 0),
+            ('bob', 'carol'): (0, 0, 0),
+        }
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def test_round_trip_unchanged(self):
+        save_manifest(self.path, self.fingerprints, self.scores)
+        scores, changed = reusable_scores(load_manifest(self.path), self.fingerprints)
+        self.assertEqual(scores, self.scores)
+        self.assertEqual(changed, set())
+
+    def test_changed_student_pairs_not_reused(self):
+        save_manifest(self.path, self.fingerprints, self.scores)
+        fingerprints = dict(self.fingerprints, bob=student_fingerprint("mov a, #3h", "0103"))
+        scores, changed = reusable_scores(load_manifest(self.path), fingerprints)
+        self.assertEqual(changed, {'bob'})
+        self.assertEqual(list(scores), [('alice', 'carol')])
+
+    def test_new_and_removed_students(self):
+        save_manifest(self.path, self.fingerprints, self.scores)
+        fingerprints = {'alice': self.fingerprints['alice'], 'dave': student_fingerprint("x", "")}
+        scores, changed = reusable_scores(load_manifest(self.path), fingerprints)
+        self.assertEqual(changed, {'dave'})
+        self.assertEqual(scores, {})
+
+    def test_score_types_preserved(self):
+        save_manifest(self.path, self.fingerprints, self.scores)
+        scores, _ = reusable_scores(load_manifest(self.path), self.fingerprints)
+        self.assertIsInstance(scores[('alice', 'carol')][0], int)
+        self.assertIsInstance(scores[('alice', 'bob')][0], float)
+
+    def test_missing_or_outdated_manifest(self):
+        self.assertIsNone(load_manifest(self.path))
+        save_manifest(self.path, self.fingerprints, self.scores)
+        with open(self.path, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+        manifest['version'] = -1
+        with open(self.path, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f)
+        self.assertIsNone(load_manifest(self.path))
+        scores, changed = reusable_scores(None, self.fingerprints)
+        self.assertEqual(scores, {})
+        self.assertEqual(changed, set(self.fingerprints))
+
+    def test_writer_streams_pairs(self):
+        with ManifestWriter(self.path, self.fingerprints) as writer:
+            for (student1, student2), value in self.scores.items():
+                writer.add(student1, student2, value)
+            writer.commit()
+        self.assertEqual(reusable_scores(load_manifest(self.path), self.fingerprints)[0], self.scores)
+
+    def test_uncommitted_writer_keeps_previous_manifest(self):
+        save_manifest(self.path, self.fingerprints, self.scores)
+        with ManifestWriter(self.path, self.fingerprints) as writer:
+            writer.add('alice', 'bob', (1.0, 1.0, 1.0))
+        self.assertEqual(reusable_scores(load_manifest(self.path), self.fingerprints)[0], self.scores)
+        self.assertEqual(os.listdir(os.path.dirname(self.path)), ['lab.json'])
+
+    def test_default_path_per_directory(self):
+        path1 = default_manifest_path(self.test_dir, '/data/Lab 6')
+        path2 = default_manifest_path(self.test_dir, '/other/Lab 6')
+        self.assertNotEqual(path1, path2)
+        self.assertTrue(os.path.basename(path1).startswith('Lab 6-'))
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
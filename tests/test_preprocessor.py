@@ -7,18 +7,140 @@ import sys
 import os
 import tempfile
 import shutil
+import zipfile
+import tarfile
+import io
+from array import array
 
 # Add src to path
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
 
 from preprocessor import (
+    crawl_directory,
+    iter_student_files,
     clean_code,
+    iter_asm_tokens,
     normalize_hex,
     validate_source_code,
+    clean_and_validate,
+    analyze_asm_source,
+    guard_source,
+    span_to_lines,
+    remap_sampled_lines,
+    enforce_token_budget,
     check_hex_integrity
 )
 
 
+class TestCrawlDirectory(unittest.TestCase):
+    """Test file discovery, including submission archives"""
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.root, 'alice', 'sub'))
+        with open(os.path.join(self.root, 'alice', 'main.A51'), 'w') as f:
+            f.write("mov a, #1")
+        with open(os.path.join(self.root, 'alice', 'sub', 'out.hex'), 'w') as f:
+            f.write(":00000001FF")
+        # LMS export: one zip per student at the top level
+        with zipfile.ZipFile(os.path.join(self.root, 'bob.zip'), 'w') as zf:
+            zf.writestr('lab/main.asm', "mov a, #2")
+            zf.writestr('lab/out.hex', ":00000001FF")
+            zf.writestr('lab/notes.txt', "hi")
+        # Archive inside a student folder
+        os.makedirs(os.path.join(self.root, 'carol'))
+        with tarfile.open(os.path.join(self.root, 'carol', 'submission.tar.gz'), 'w:gz') as tf:
+            data = b"void main(void) {}"
+            info = tarfile.TarInfo('src/main.c')
+            info.size = len(data)
+            tf.addfile(info, io.BytesIO(data))
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_student_folders(self):
+        files = crawl_directory(self.root)
+        self.assertEqual([os.path.basename(p) for p in files['alice']['source']], ['main.A51'])
+        self.assertEqual([os.path.basename(p) for p in files['alice']['hex']], ['out.hex'])
+
+    def test_top_level_zip_is_student(self):
+        files = crawl_directory(self.root)
+        self.assertIn('bob', files)
+        self.assertEqual(len(files['bob']['source']), 1)
+        self.assertEqual(len(files['bob']['hex']), 1)
+        self.assertEqual(len(files['bob']['all_files']), 3)
+        self.assertTrue(files['bob']['source'][0].endswith(os.path.join('bob.zip', 'lab', 'main.asm')))
+
+    def test_archive_inside_student_folder(self):
+        files = crawl_directory(self.root)
+        self.assertEqual(len(files['carol']['source']), 1)
+        self.assertTrue(files['carol']['source'][0].endswith('main.c'))
+
+    def _write(self, *parts, data="x"):
+        path = os.path.join(self.root, *parts)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(data)
+        return path
+
+    def test_ignore_rules(self):
+        self._write('__MACOSX', 'alice', '._main.A51')
+        self._write('alice', '__MACOSX', '._main.A51')
+        self._write('alice', '.git', 'objects', 'ab.c')
+        self._write('alice', 'Listings', 'main.lst')
+        self._write('alice', 'Objects', 'main.obj')
+        hex_path = self._write('alice', 'Objects', 'main.hex')
+        files = crawl_directory(self.root)
+        self.assertNotIn('__MACOSX', files)
+        self.assertEqual(len(files['alice']['source']), 1)
+        self.assertIn(hex_path, files['alice']['hex'])
+        self.assertFalse(any('Listings' in p or p.endswith('.obj') for p in files['alice']['all_files']))
+
+    def test_ignore_case_insensitive(self):
+        self._write('alice', 'LISTINGS', 'main.a51')
+        self._write('alice', 'THUMBS.DB')
+        self._write('alice', 'Backup', 'old.a51')
+        files = crawl_directory(self.root, ignore=('thumbs.db', 'listings', 'BACKUP'))
+        self.assertEqual(sorted(os.path.basename(p) for p in files['alice']['all_files']), ['main.A51', 'out.hex'])
+        # The default patterns match whatever case the OS wrote
+        all_files = crawl_directory(self.root)['alice']['all_files']
+        self.assertFalse(any('LISTINGS' in p or 'THUMBS' in p for p in all_files))
+
+    def test_max_depth(self):
+        self._write('alice', 'a', 'b', 'deep.c')
+        files = crawl_directory(self.root, max_depth=2)
+        self.assertEqual(len(files['alice']['source']), 1)
+        self.assertEqual(len(files['alice']['skipped']), 1)
+        self.assertEqual(len(crawl_directory(self.root)['alice']['source']), 2)
+
+    def test_file_size_cap(self):
+        self._write('alice', 'big.a51', data="x" * 100)
+        files = crawl_directory(self.root, max_file_bytes=50)
+        self.assertEqual([os.path.basename(p) for p in files['alice']['source']], ['main.A51'])
+        self.assertTrue(files['alice']['skipped'][0][0].endswith('big.a51'))
+
+    def test_file_count_cap(self):
+        for i in range(5):
+            self._write('dave', f'f{i}.txt')
+        files = crawl_directory(self.root, max_files=3)
+        self.assertEqual(len(files['dave']['all_files']), 3)
+        self.assertEqual(len(files['dave']['skipped']), 1)
+
+    def test_yields_lazily(self):
+        students = iter_student_files(self.root)
+        student_id, files = next(students)
+        self.assertEqual(student_id, 'bob')  # Top-level archives come first
+        self.assertEqual(len(files['source']), 1)
+
+    def test_matches_os_walk_order(self):
+        self._write('alice', 'sub', 'z.a51')
+        self._write('alice', 'b.a51')
+        expected = []
+        for root, _, names in os.walk(os.path.join(self.root, 'alice')):
+            expected.extend(os.path.join(root, name) for name in names)
+        self.assertEqual(crawl_directory(self.root)['alice']['all_files'], expected)
+
+
 class TestCleanCode(unittest.TestCase):
     """Test code cleaning functionality"""
     
@@ -85,6 +207,40 @@ class TestCleanCode(unittest.TestCase):
         # Should remove the macro definition
         self.assertNotIn('#define', cleaned)
 
+    def test_assembly_semicolon_inside_string(self):
+        code = "DB 'a;b' ; real comment\nMOV A, #0x0F"
+        cleaned = clean_code(code, '.asm')
+        self.assertEqual(cleaned, "db 'a;b' mov a, #fh")
+
+    def test_assembly_hex_normalization(self):
+        code = "MOV A, #0x1F\nMOV B, #00FFH\nMOV R0, #0x0"
+        cleaned = clean_code(code, '.a51')
+        self.assertEqual(cleaned, "mov a, #1fh mov b, #ffh mov r0, #0h")
+
+    def test_asm_tokens_match_cleaned_text(self):
+        code = "ORG 0000H ; start\n\tLJMP MAIN\r\nMAIN: MOV A, #0x55"
+        self.assertEqual(list(iter_asm_tokens(code)), clean_code(code, '.a51').split())
+
+    def test_c_comment_markers_inside_string(self):
+        code = 'char *url = "http://x/*y*/";\nint z;'
+        cleaned = clean_code(code, '.c')
+        self.assertEqual(cleaned, 'char *url = "http://x/*y*/"; int z;')
+
+    def test_c_nested_conditionals(self):
+        code = "#ifdef A\n#ifndef B\nint x;\n#endif\nint y;\n#endif\nint z;"
+        cleaned = clean_code(code, '.c')
+        self.assertEqual(cleaned, "int z;")
+
+    def test_c_line_comment_continuation(self):
+        code = "int a; // comment \\\nint b;\nint c;"
+        cleaned = clean_code(code, '.c')
+        self.assertEqual(cleaned, "int a; int c;")
+
+    def test_c_directive_after_multiline_comment(self):
+        code = "/* header\n */ #define X 1\nint y = 007;"
+        cleaned = clean_code(code, '.c')
+        self.assertEqual(cleaned, "int y = 7;")
+
     def test_unknown_extension(self):
         code = "some code"
         cleaned = clean_code(code, '.txt')
@@ -125,6 +281,34 @@ class TestNormalizeHex(unittest.TestCase):
         self.assertEqual(normalized, normalized.upper())
 
 
+    def test_checksum_mismatch(self):
+        hex_data = ":03000000020003F7\n:00000001FF"  # Checksum should be F8
+        normalized, info = normalize_hex(hex_data)
+        self.assertEqual(info['checksum_errors'], 1)
+        self.assertEqual(len(info['format_errors']), 1)
+        # Data is still extracted
+        self.assertEqual(normalized, "020003")
+
+    def test_bytes_input(self):
+        normalized, info = normalize_hex(b":03000000020003F8\r\n:00000001FF\r\n")
+        self.assertEqual(normalized, "020003")
+        self.assertEqual(info['checksum_errors'], 0)
+        self.assertTrue(info['has_eof'])
+
+    def test_extended_address_records(self):
+        hex_data = ":020000040001F9\n:0400000500000100F6\n:03000000020003F8\n:00000001FF"
+        normalized, info = normalize_hex(hex_data)
+        self.assertEqual(normalized, "020003")
+        self.assertEqual(info['format_errors'], [])
+        self.assertEqual(info['valid_lines'], 1)
+
+    def test_insufficient_data(self):
+        hex_data = ":10000000020003"  # Declares 16 data bytes
+        normalized, info = normalize_hex(hex_data)
+        self.assertEqual(normalized, "")
+        self.assertIn("Insufficient data", info['format_errors'][0])
+
+
 class TestValidateSourceCode(unittest.TestCase):
     """Test source code anomaly detection"""
     
@@ -201,6 +385,35 @@ class TestValidateSourceCode(unittest.TestCase):
         self.assertGreater(len(anomalies), 0)
 
 
+class TestCleanAndValidate(unittest.TestCase):
+    """Test the fused clean + validate pass"""
+
+    SAMPLES = [
+        "ORG 0000H\nMAIN: MOV A, #0x55 ; comment\n\n; only comment\n  \nDB 'a; b'\nmov;x\nEND",
+        "",
+        "   ",
+        "; a\n; b\n",
+        "LOOP:MOV A,#1\r\nSJMP LOOP\x0c\nend",
+    ]
+
+    def test_matches_separate_passes(self):
+        for code in self.SAMPLES:
+            for ext in ['.a51', '.asm', '.c']:
+                with self.subTest(code=code, ext=ext):
+                    self.assertEqual(clean_and_validate(code, ext),
+                                     (clean_code(code, ext), validate_source_code(code, ext)))
+
+    def test_line_stats(self):
+        tokens, stats = analyze_asm_source(self.SAMPLES[0])
+        self.assertEqual(tokens, clean_code(self.SAMPLES[0], '.a51').split())
+        self.assertEqual(stats['total_lines'], 8)
+        self.assertEqual(stats['blank_lines'], 2)
+        self.assertEqual(stats['comment_lines'], 1)
+        self.assertEqual(stats['code_lines'], 5)
+        # "mov;x" is not a MOV instruction, and "MAIN:" is a label
+        self.assertEqual(stats['key_instructions'], {'org', 'end'})
+
+
 class TestCheckHexIntegrity(unittest.TestCase):
     """Test hex file integrity checking"""
     
@@ -276,6 +489,105 @@ class TestCheckHexIntegrity(unittest.TestCase):
         self.assertGreater(len(anomalies), 2)
 
 
+class TestTokenOffsets(unittest.TestCase):
+    """Test token -> (line, column) offset tables"""
+
+    def test_asm_offsets(self):
+        code = "ORG 0000H\n; comment\n  MOV A, #0x55 ; x\nDB 'a b'\nEND"
+        offsets = array('I')
+        cleaned = clean_code(code, '.a51', offsets)
+        self.assertEqual(cleaned.split(), ['org', '0h', 'mov', 'a,', '#55h', 'db', "'a", "b'", 'end'])
+        self.assertEqual(list(offsets), [1, 1, 1, 5, 3, 3, 3, 7, 3, 10, 4, 1, 4, 4, 4, 7, 5, 1])
+
+    def test_fused_pass_offsets_match(self):
+        code = "MAIN:\tMOV A, #1\n\nSJMP MAIN"
+        offsets1, offsets2 = array('I'), array('I')
+        clean_code(code, '.asm', offsets1)
+        clean_and_validate(code, '.asm', offsets2)
+        self.assertEqual(offsets1, offsets2)
+
+    def test_c_offsets(self):
+        code = "#include <reg51.h>\n/* block\n comment */ int x = 0x0A;\n#ifdef DEBUG\nfoo();\n#endif\n  void main() {\n}"
+        offsets = array('I')
+        cleaned = clean_code(code, '.c', offsets)
+        tokens = cleaned.split()
+        self.assertEqual(tokens, ['int', 'x', '=', '0x0a;', 'void', 'main()', '{', '}'])
+        self.assertEqual(list(offsets), [3, 13, 3, 17, 3, 19, 3, 21, 7, 3, 7, 8, 7, 15, 8, 1])
+
+    def test_offsets_not_required(self):
+        code = "int x; // c\nx = 1;"
+        self.assertEqual(clean_code(code, '.c'), clean_code(code, '.c', array('I')))
+
+    def test_span_to_lines(self):
+        # (file index, line, column) per token: two tokens in file 0, three in file 1
+        offsets = array('I', [0, 1, 1, 0, 4, 2, 1, 2, 1, 1, 2, 5, 1, 7, 1])
+        self.assertEqual(span_to_lines(offsets, 0, 5), [(0, 1, 4), (1, 2, 7)])
+        self.assertEqual(span_to_lines(offsets, 1, 3), [(0, 4, 4), (1, 2, 2)])
+        self.assertEqual(span_to_lines(offsets, 2, 2), [])
+
+
+class TestInputGuards(unittest.TestCase):
+    """Test oversized input handling"""
+
+    def setUp(self):
+        self.content = ''.join(f"mov r{i % 8}, #{i}\n" for i in range(1000))
+
+    def test_small_file_untouched(self):
+        self.assertEqual(guard_source("mov a, #1\n", max_chars=100), ("mov a, #1\n", None))
+
+    def test_cap_keeps_whole_lines_from_start(self):
+        kept, anomaly = guard_source(self.content, 'cap', max_chars=100)
+        self.assertLessEqual(len(kept), 100)
+        self.assertTrue(self.content.startswith(kept))
+        self.assertTrue(kept.endswith('\n'))
+        self.assertEqual(anomaly['code'], 'OVERSIZED_FILE')
+        self.assertEqual(anomaly['details']['length'], len(self.content))
+
+    def test_sample_spans_file(self):
+        kept, anomaly = guard_source(self.content, 'sample', max_chars=800)
+        self.assertLessEqual(len(kept), 800)
+        self.assertIn("mov r0, #0\n", kept)
+        last_line = kept.splitlines()[-1]
+        self.assertGreaterEqual(int(last_line.split('#')[1]), 875)  # Last excerpt starts at 7/8 of the file
+        self.assertEqual(anomaly['details']['policy'], 'sample')
+
+    def test_sample_line_map(self):
+        kept, anomaly = guard_source(self.content, 'sample', max_chars=800)
+        line_map = anomaly['details']['line_map']
+        self.assertEqual(line_map[0], [1, 1])
+        file_lines = self.content.splitlines()
+        kept_lines = kept.splitlines()
+        for (kept_line, file_line), following in zip(line_map, line_map[1:] + [[len(kept_lines) + 1, None]]):
+            for k in range(kept_line, following[0]):
+                self.assertEqual(kept_lines[k - 1], file_lines[file_line + k - kept_line - 1])
+
+    def test_sampled_offsets_point_into_file(self):
+        kept, anomaly = guard_source(self.content, 'sample', max_chars=800)
+        offsets = array('I')
+        tokens = clean_code(kept, '.a51', offsets).split()
+        remapped = remap_sampled_lines(offsets, anomaly['details']['line_map'])
+        # Line i + 1 of the file is "mov rN, #i"
+        immediates = [(int(token[1:]), remapped[2 * k]) for k, token in enumerate(tokens) if token.startswith('#')]
+        self.assertGreater(immediates[-1][0], 875)
+        self.assertTrue(all(line == value + 1 for value, line in immediates))
+
+    def test_fingerprint_drops_content(self):
+        kept, anomaly = guard_source(self.content, 'fingerprint', max_chars=100)
+        self.assertEqual(kept, '')
+        self.assertEqual(anomaly['severity'], 'error')
+
+    def test_unknown_policy(self):
+        with self.assertRaises(ValueError):
+            guard_source(self.content, 'drop')
+
+    def test_token_budget(self):
+        self.assertEqual(enforce_token_budget("a b c", 3), ("a b c", None))
+        text, anomaly = enforce_token_budget("a b  c\nd e", 3)
+        self.assertEqual(text, "a b c")
+        self.assertEqual(anomaly['code'], 'TOKEN_BUDGET_EXCEEDED')
+        self.assertEqual(anomaly['details'], {'count': 5, 'limit': 3})
+
+
 class TestEdgeCases(unittest.TestCase):
     """Test edge cases and boundary conditions"""
     
@@ -0,0 +1,40 @@
+"""
+Unit tests for records.py
+Tests the slotted Student and PairResult record types
+"""
+import unittest
+import sys
+import os
+from array import array
+
+# Add src to path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from records import Student, PairResult
+
+
+class TestRecords(unittest.TestCase):
+    """Test record defaults, slots and dict round trips"""
+
+    def test_student_defaults(self):
+        student = Student('alice', source="mov a , #1h")
+        self.assertEqual(student.hex_anomalies, [])
+        self.assertIsNot(student.hex_anomalies, Student('bob').hex_anomalies)
+        self.assertEqual(student.source_offsets, array('I'))
+
+    def test_slotted(self):
+        with self.assertRaises(AttributeError):
+            Student('alice').source_code = ""
+        self.assertFalse(hasattr(PairResult('a', 'b', {}, 0, 0, 0), '__dict__'))
+
+    def test_round_trip(self):
+        student = Student('alice', source="mov a , #1h", hex="0102", source_offsets=array('I', [0, 1, 1]))
+        self.assertEqual(Student.from_dict(student.to_dict()), student)
+        pair = PairResult('alice', 'bob', {'token_seq': 0.5, 'levenshtein': 0.7}, 0.9, 0.9, 0.6,
+                          final_verdict="未抄襲")
+        self.assertEqual(PairResult.from_dict(pair.to_dict()), pair)
+        self.assertEqual(set(pair.to_dict()) & {'source_code1', 'hex_code1'}, set())
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)